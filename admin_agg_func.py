@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for aggregating impacts to sub-national administrative
+units (admin-1, admin-2).
+
+The mapping from exposure points to admin units is computed once per country
+with a spatial join against local boundary files (GADM) and persisted as a
+sparse matrix (exposure point x admin unit). The per-member admin impacts are
+then a single sparse matrix product with the impact matrix.
+
+@author: Pui Man (Mannie) Kam
+"""
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from typing import Union, Tuple
+from pathlib import Path
+from scipy import sparse
+
+from climada.entity import Exposures
+from climada.engine import Impact
+
+from checkpoint_func import atomic_file
+from writer_func import AsyncWriter, write_bytes
+
+# GADM boundary files, one per country and admin level
+BOUNDARIES_FILE_NAME = "gadm41_{country_iso3}_{admin_level}.json"
+BOUNDARIES_ID_COLUMN = "GID_{admin_level}"
+BOUNDARIES_NAME_COLUMN = "NAME_{admin_level}"
+
+N_ENSEMBLE = 51
+
+def make_admin_index_file_name(country_iso3: str, admin_level: int):
+    """File name of the persisted admin index of a country."""
+    return f"admin{admin_level}-index_{country_iso3}.npz"
+
+def make_admin_units_file_name(country_iso3: str, admin_level: int):
+    """File name of the admin units table belonging to the admin index."""
+    return f"admin{admin_level}-units_{country_iso3}.csv"
+
+def _exposure_checksum(exp: Exposures) -> str:
+    """Checksum of the exposure coordinates, to detect outdated admin indices."""
+    coords = np.ascontiguousarray(
+        np.stack([exp.gdf.geometry.y.values, exp.gdf.geometry.x.values], axis=1))
+    return hashlib.sha1(coords.tobytes()).hexdigest()
+
+def build_admin_index(exp: Exposures,
+                      country_iso3: str,
+                      admin_level: int,
+                      boundaries_dir: Union[str, Path],
+                      index_dir: Union[str, Path]) -> Tuple[sparse.csr_matrix, pd.DataFrame]:
+    """
+    Map the exposure points of a country to its admin units with a spatial
+    join and save the mapping as a sparse matrix. Points that do not lie
+    within any admin unit (e.g. along the coast) are assigned to the
+    nearest one. A boundary file without units gives an empty index (no
+    columns and no units).
+
+    Parameters
+    ----------
+    exp : climada.entity.Exposures
+        Exposures of a single country.
+    country_iso3 : str
+        Single country in ISO3 alpha.
+    admin_level : int
+        Admin level of the boundaries (1 or 2).
+    boundaries_dir : Union[str, Path]
+        Directory with the boundary files (see BOUNDARIES_FILE_NAME).
+    index_dir : Union[str, Path]
+        Directory where the admin index is saved to.
+
+    Returns
+    -------
+    agg_mat : scipy.sparse.csr_matrix
+        Aggregation matrix (exposure point x admin unit).
+    admin_units : pd.DataFrame
+        Id and name of each admin unit (column of agg_mat).
+    """
+    id_col = BOUNDARIES_ID_COLUMN.format(admin_level=admin_level)
+    name_col = BOUNDARIES_NAME_COLUMN.format(admin_level=admin_level)
+
+    boundaries_file = os.path.join(
+        boundaries_dir,
+        BOUNDARIES_FILE_NAME.format(country_iso3=country_iso3, admin_level=admin_level))
+    if not os.path.exists(boundaries_file):
+        raise FileNotFoundError(f"No boundary file found: {boundaries_file}")
+
+    boundaries = gpd.read_file(boundaries_file)
+    boundaries = boundaries[[id_col, name_col, 'geometry']].to_crs(exp.gdf.crs)
+    boundaries = boundaries.reset_index(drop=True)
+
+    n_exp = exp.gdf.shape[0]
+    if boundaries.empty:
+        # no units to join with, e.g. small island states without admin-1 polygons
+        agg_mat = sparse.csr_matrix((n_exp, 0))
+    else:
+        points = gpd.GeoDataFrame(geometry=exp.gdf.geometry.values, crs=exp.gdf.crs)
+        joined = gpd.sjoin(points, boundaries, how='left', predicate='within')
+        # points on the border of two units appear twice, keep the first unit
+        joined = joined[~joined.index.duplicated(keep='first')]
+        unit_idx = joined['index_right'].values
+
+        missing = np.isnan(unit_idx)
+        if missing.any():
+            nearest = gpd.sjoin_nearest(points[missing], boundaries, how='left')
+            nearest = nearest[~nearest.index.duplicated(keep='first')]
+            unit_idx[missing] = nearest['index_right'].values
+        unit_idx = unit_idx.astype(int)
+
+        agg_mat = sparse.csr_matrix((np.ones(n_exp), (np.arange(n_exp), unit_idx)),
+                                    shape=(n_exp, len(boundaries)))
+    admin_units = pd.DataFrame({'admin_id': boundaries[id_col].values,
+                                'admin_name': boundaries[name_col].values})
+
+    os.makedirs(index_dir, exist_ok=True)
+    with atomic_file(os.path.join(index_dir, make_admin_index_file_name(country_iso3, admin_level))) as tmp_file:
+        sparse.save_npz(tmp_file, agg_mat)
+    with atomic_file(os.path.join(index_dir, make_admin_units_file_name(country_iso3, admin_level))) as tmp_file:
+        admin_units.assign(exp_checksum=_exposure_checksum(exp)).to_csv(tmp_file, index=False)
+
+    return agg_mat, admin_units
+
+def get_admin_index(exp: Exposures,
+                    country_iso3: str,
+                    admin_level: int,
+                    boundaries_dir: Union[str, Path],
+                    index_dir: Union[str, Path]) -> Tuple[sparse.csr_matrix, pd.DataFrame]:
+    """
+    Load the persisted admin index of a country. The index is (re)built if it
+    does not exist yet or if the exposure points have changed since it was
+    built. See build_admin_index for the parameters. A country without admin
+    units gives an empty index.
+    """
+    index_file = os.path.join(index_dir, make_admin_index_file_name(country_iso3, admin_level))
+    units_file = os.path.join(index_dir, make_admin_units_file_name(country_iso3, admin_level))
+
+    if os.path.exists(index_file) and os.path.exists(units_file):
+        admin_units = pd.read_csv(units_file, keep_default_na=False)
+        agg_mat = sparse.load_npz(index_file).tocsr()
+        if admin_units.empty:
+            # no units, hence no checksum to compare and nothing that depends on the exposure
+            return sparse.csr_matrix((exp.gdf.shape[0], 0)), admin_units.drop(columns='exp_checksum')
+        if agg_mat.shape[0] == exp.gdf.shape[0] \
+                and admin_units['exp_checksum'].iloc[0] == _exposure_checksum(exp):
+            return agg_mat, admin_units.drop(columns='exp_checksum')
+
+    return build_admin_index(exp, country_iso3, admin_level, boundaries_dir, index_dir)
+
+def aggregate_impact_admin(impact: Impact,
+                           agg_mat: sparse.csr_matrix,
+                           admin_units: pd.DataFrame,
+                           n_members: int = N_ENSEMBLE) -> pd.DataFrame:
+    """
+    Aggregate the impact of each ensemble member to the admin units.
+    Members missing from the impact (less than n_members) count as zero
+    impact in the mean and median, as in the national summary
+    (impact_calc_func.summarize_forecast).
+
+    Parameters
+    ----------
+    impact : climada.engine.Impact
+        Impact of a single country with the impact matrix (imp_mat) saved.
+    agg_mat : scipy.sparse.csr_matrix
+        Aggregation matrix (exposure point x admin unit) of the country.
+    admin_units : pd.DataFrame
+        Id and name of each admin unit.
+    n_members : int
+        Number of ensemble members of the forecast. Default: 51
+
+    Returns
+    -------
+    imp_admin : pd.DataFrame
+        Impact per admin unit (rows) and ensemble member (columns), together
+        with the ensemble mean and median.
+    """
+    imp_admin_mat = (impact.imp_mat @ agg_mat).toarray().T
+
+    imp_admin_padded = np.pad(imp_admin_mat,
+                              ((0, 0), (0, max(n_members - imp_admin_mat.shape[1], 0))))
+
+    imp_admin = admin_units.copy()
+    imp_admin['mean'] = imp_admin_padded.mean(axis=1)
+    imp_admin['median'] = np.median(imp_admin_padded, axis=1)
+    members = pd.DataFrame(imp_admin_mat, columns=[f"ensemble_{event_id}"
+                                                   for event_id in impact.event_id])
+
+    return pd.concat([imp_admin, members], axis=1)
+
+def save_impact_admin(save_dir: Union[str, Path],
+                      imp_summary_dict: dict,
+                      imp_admin: pd.DataFrame,
+                      admin_level: int,
+                      writer: AsyncWriter = None):
+    """
+    Save the impact per admin unit and ensemble member into a CSV file.
+    Written in the background if an AsyncWriter is given.
+    """
+    save_file_name = (
+        f'impact-admin{admin_level}_TC_ECMWF_ens_{imp_summary_dict["eventName"]}_{imp_summary_dict["initializationTime"]}'
+        f'_{imp_summary_dict["countryISO3"]}_{imp_summary_dict["impactType"]}.csv'
+        )
+    return write_bytes(save_dir +save_file_name, imp_admin.to_csv(index=False).encode(), writer)
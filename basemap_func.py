@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline basemap for the impact maps, from a local store of pre-fetched
+XYZ tiles (CartoDB Positron) instead of contextily fetching them over the
+network for every map.
+
+The tiles are stored as {cache_dir}/{z}/{x}/{y}.png, prefetched for the
+zoom levels and regions of the maps (see basemap_prefetch.py). Only
+basemap_prefetch.py evicts tiles (by least recent use above a size limit,
+see evict_tiles), after each prefetch; drawing the maps never deletes any,
+so the store can exceed the limit between two prefetch runs. add_basemap
+mosaics the cached tiles of the map extent (decoded tiles are kept in
+memory) and never touches the network: tiles that are not cached are drawn
+in the background colour of the basemap, and picked up as soon as a
+prefetch has stored them.
+
+@author: Pui Man (Mannie) Kam
+"""
+import os
+import functools
+import numpy as np
+import matplotlib.image as mpimg
+import contextily as ctx
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, List, Tuple
+from pathlib import Path
+
+from download_func import download_file, DOWNLOAD_WORKERS
+
+BASEMAP_URL = "https://a.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png"
+BASEMAP_ATTRIBUTION = "(C) OpenStreetMap contributors (C) CARTO"
+BASEMAP_BACKGROUND = (0.98, 0.98, 0.97, 1.)
+
+TILE_SIZE = 256
+MAX_ZOOM = 12
+
+# size limit of the tile store
+MAX_CACHE_GB = 2.
+
+# half of the extent of the Web Mercator projection, in m
+HALF_EXTENT_M = 20037508.342789244
+
+# set with set_tile_cache_dir, None fetches the tiles online with contextily
+_tile_cache = {'dir': None}
+
+def set_tile_cache_dir(cache_dir: Union[str, Path, None]) -> None:
+    """
+    Draw the basemaps from the local tile store in cache_dir, or online with
+    contextily if None.
+    """
+    _tile_cache['dir'] = None if cache_dir is None else str(cache_dir)
+
+def auto_zoom(west: float, south: float, east: float, north: float) -> int:
+    """Zoom level of a map extent (in degrees), as chosen by contextily."""
+    zoom_lon = np.ceil(np.log2(360 * 2. / max(abs(east - west), 1e-9)))
+    zoom_lat = np.ceil(np.log2(360 * 2. / max(abs(north - south), 1e-9)))
+    return int(np.clip(min(zoom_lon, zoom_lat), 0, MAX_ZOOM))
+
+def lonlat_to_tile(lon: np.ndarray, lat: np.ndarray, zoom: int):
+    """Fractional XYZ tile coordinates of points."""
+    n = 2 ** zoom
+    lat = np.clip(lat, -85.0511, 85.0511)
+    x = (np.asarray(lon) + 180.) / 360. * n
+    y = (1. - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2. * n
+    return x, y
+
+def mercator_to_tile(x_m: np.ndarray, y_m: np.ndarray, zoom: int):
+    """Fractional XYZ tile coordinates of Web Mercator coordinates."""
+    n = 2 ** zoom
+    return ((np.asarray(x_m) / HALF_EXTENT_M + 1.) / 2. * n,
+            (1. - np.asarray(y_m) / HALF_EXTENT_M) / 2. * n)
+
+def tiles_in_bounds(west: float, south: float, east: float, north: float,
+                    zoom: int) -> List[Tuple[int, int, int]]:
+    """(z, x, y) of the tiles covering an extent in degrees."""
+    x, y = lonlat_to_tile(np.array([west, east]), np.array([north, south]), zoom)
+    n = 2 ** zoom
+    x0, x1 = int(np.clip(np.floor(x[0]), 0, n - 1)), int(np.clip(np.floor(x[1]), 0, n - 1))
+    y0, y1 = int(np.clip(np.floor(y[0]), 0, n - 1)), int(np.clip(np.floor(y[1]), 0, n - 1))
+    return [(zoom, tx, ty) for tx in range(x0, x1 + 1) for ty in range(y0, y1 + 1)]
+
+def tile_file(cache_dir: Union[str, Path], z: int, x: int, y: int) -> str:
+    """File of a tile in the store."""
+    return os.path.join(cache_dir, str(z), str(x), f"{y}.png")
+
+def prefetch_tiles(cache_dir: Union[str, Path],
+                   tiles: List[Tuple[int, int, int]],
+                   url: str = BASEMAP_URL,
+                   n_workers: int = DOWNLOAD_WORKERS,
+                   **kwargs) -> dict:
+    """
+    Download the tiles missing from the store, concurrently with retries
+    (see download_func.download_file).
+
+    Returns
+    -------
+    stats : dict
+        Number of tiles downloaded, already cached and failed, and bytes.
+    """
+    to_fetch = [(z, x, y) for z, x, y in set(tiles)
+                if not os.path.exists(tile_file(cache_dir, z, x, y))]
+
+    def _fetch(tile):
+        z, x, y = tile
+        file_name = tile_file(cache_dir, z, x, y)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        try:
+            return download_file(url.format(z=z, x=x, y=y), file_name, **kwargs)['bytes']
+        except OSError as err:
+            print(f"Tile {z}/{x}/{y} failed: {err}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="tile-download") as executor:
+        n_bytes = list(executor.map(_fetch, to_fetch))
+
+    return {'downloaded': sum(b is not None for b in n_bytes),
+            'cached': len(set(tiles)) - len(to_fetch),
+            'failed': sum(b is None for b in n_bytes),
+            'bytes': sum(b for b in n_bytes if b is not None)}
+
+def evict_tiles(cache_dir: Union[str, Path], max_gb: float = MAX_CACHE_GB) -> int:
+    """
+    Delete the least recently used tiles (by modification time, which is
+    refreshed when a tile is drawn) until the store is below max_gb.
+
+    Returns
+    -------
+    n_evicted : int
+    """
+    files = []
+    for root, _, file_names in os.walk(cache_dir):
+        for file_name in file_names:
+            if file_name.endswith('.png'):
+                stat = os.stat(os.path.join(root, file_name))
+                files.append((stat.st_mtime, stat.st_size, os.path.join(root, file_name)))
+
+    total = sum(size for _, size, _ in files)
+    n_evicted = 0
+    for _, size, file_name in sorted(files):
+        if total <= max_gb * 1e9:
+            break
+        os.remove(file_name)
+        total -= size
+        n_evicted += 1
+    return n_evicted
+
+def _read_tile(file_name: str) -> np.ndarray:
+    """
+    Decoded RGBA tile, None if not cached. Marks the tile as used. Missing
+    tiles are not remembered, so that tiles prefetched later are drawn.
+    """
+    try:
+        os.utime(file_name)
+        return _decode_tile(file_name)
+    except FileNotFoundError:
+        return None
+
+@functools.lru_cache(maxsize=4096)
+def _decode_tile(file_name: str) -> np.ndarray:
+    """Decoded RGBA tile, kept in memory."""
+    tile = mpimg.imread(file_name)
+    if tile.ndim == 2:
+        tile = np.stack([tile] * 3, axis=-1)
+    if tile.shape[-1] == 3:
+        tile = np.concatenate([tile, np.ones(tile.shape[:2] + (1,), tile.dtype)], axis=-1)
+    return tile.astype(np.float32)
+
+def tile_mosaic(cache_dir: Union[str, Path], x_range: Tuple[int, int],
+                y_range: Tuple[int, int], zoom: int) -> Tuple[np.ndarray, int]:
+    """
+    Mosaic of the cached tiles x_range[0]..x_range[1], y_range[0]..y_range[1]
+    at a zoom level, in the background colour where a tile is not cached.
+
+    Returns
+    -------
+    mosaic : np.ndarray
+        RGBA image.
+    n_missing : int
+        Number of tiles not in the store.
+    """
+    (x0, x1), (y0, y1) = x_range, y_range
+    mosaic = np.empty(((y1 - y0 + 1) * TILE_SIZE, (x1 - x0 + 1) * TILE_SIZE, 4), np.float32)
+    mosaic[:] = BASEMAP_BACKGROUND
+    n_missing = 0
+    for tx in range(x0, x1 + 1):
+        for ty in range(y0, y1 + 1):
+            tile = _read_tile(tile_file(cache_dir, zoom, tx % 2 ** zoom, ty))
+            if tile is None or tile.shape[:2] != (TILE_SIZE, TILE_SIZE):
+                n_missing += 1
+                continue
+            mosaic[(ty - y0) * TILE_SIZE:(ty - y0 + 1) * TILE_SIZE,
+                   (tx - x0) * TILE_SIZE:(tx - x0 + 1) * TILE_SIZE] = tile
+    return mosaic, n_missing
+
+def add_basemap(ax, crs: str = None, zoom: int = None):
+    """
+    Add the Positron basemap under the plot of an axis in Web Mercator
+    (crs None) or in lon/lat (crs 'EPSG:4326'), from the local tile store
+    if set with set_tile_cache_dir, otherwise with contextily.
+    """
+    if _tile_cache['dir'] is None:
+        if crs is None:
+            return ctx.add_basemap(ax, source=ctx.providers.CartoDB.Positron)
+        return ctx.add_basemap(ax, crs=crs, source=ctx.providers.CartoDB.Positron)
+
+    xlim, ylim = ax.get_xlim(), ax.get_ylim()
+    is_lonlat = crs is not None and str(crs).upper() in ('EPSG:4326', 'WGS84')
+    if is_lonlat:
+        west, east, south, north = min(xlim), max(xlim), min(ylim), max(ylim)
+    else:
+        west, east = np.degrees(np.array([min(xlim), max(xlim)]) / 6378137.)
+        south, north = np.degrees(2 * np.arctan(np.exp(
+            np.array([min(ylim), max(ylim)]) / 6378137.)) - np.pi / 2)
+    if zoom is None:
+        zoom = auto_zoom(west, south, east, north)
+
+    tx, ty = lonlat_to_tile(np.array([west, east]), np.array([north, south]), zoom)
+    x_range = (int(np.floor(tx[0])), int(np.floor(tx[1])))
+    y_range = (int(np.clip(np.floor(ty[0]), 0, 2 ** zoom - 1)),
+               int(np.clip(np.floor(ty[1]), 0, 2 ** zoom - 1)))
+    mosaic, n_missing = tile_mosaic(_tile_cache['dir'], x_range, y_range, zoom)
+    if n_missing:
+        print(f"Basemap: {n_missing} tiles at zoom {zoom} not in the tile store, "
+              f"run basemap_prefetch.py")
+
+    # Web Mercator bounds of the mosaic
+    n = 2 ** zoom
+    x_min_m = (x_range[0] / n * 2. - 1.) * HALF_EXTENT_M
+    x_max_m = ((x_range[1] + 1) / n * 2. - 1.) * HALF_EXTENT_M
+    y_max_m = (1. - y_range[0] / n * 2.) * HALF_EXTENT_M
+    y_min_m = (1. - (y_range[1] + 1) / n * 2.) * HALF_EXTENT_M
+
+    if is_lonlat:
+        # the columns are linear in longitude, resample the rows to latitude
+        lat_rows = np.linspace(north, south, mosaic.shape[0])
+        _, y_rows = mercator_to_tile(0., 6378137. * np.arcsinh(np.tan(np.radians(lat_rows))), zoom)
+        rows = np.clip(((y_rows - y_range[0]) * TILE_SIZE).astype(int), 0, mosaic.shape[0] - 1)
+        extent = (np.degrees(x_min_m / 6378137.), np.degrees(x_max_m / 6378137.), south, north)
+        ax.imshow(mosaic[rows], extent=extent, interpolation='bilinear')
+    else:
+        ax.imshow(mosaic, extent=(x_min_m, x_max_m, y_min_m, y_max_m),
+                  interpolation='bilinear')
+
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    ax.text(0.005, 0.005, BASEMAP_ATTRIBUTION, transform=ax.transAxes, size=6,
+            ha='left', va='bottom', zorder=10)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prefetch of the basemap tiles of the impact maps into the local tile store
+(see basemap_func), so that the maps are rendered without network access.
+
+The maps of a country are zoomed to its exposure, so the tiles are fetched
+over the bounds of every country of the impact functions (iso3_to_basin),
+at the zoom level contextily picks for these bounds and one level around
+it. Other extents can be added with --bounds. The least recently used tiles
+are evicted above the size limit afterwards.
+
+e.g. python basemap_prefetch.py --cache-dir ./basemap_tiles
+     python basemap_prefetch.py --countries PHL JPN --bounds 100 0 150 40 --zooms 4 5 6
+
+@author: Pui Man (Mannie) Kam
+"""
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+
+import climada.util.coordinates as u_coord
+
+from impact_calc_func import iso3_to_basin
+from basemap_func import (
+    auto_zoom, tiles_in_bounds, prefetch_tiles, evict_tiles, MAX_ZOOM, MAX_CACHE_GB
+)
+
+BASEMAP_TILE_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/basemap_tiles/"
+
+# zoom levels around the automatic zoom of each country
+ZOOM_MARGIN = 1
+
+def country_tiles(country_iso3: list, zoom_margin: int = ZOOM_MARGIN) -> list:
+    """Tiles of the maps of the given countries."""
+    geometries = u_coord.get_country_geometries(country_names=country_iso3)
+    tiles = []
+    for west, south, east, north in geometries.geometry.bounds.values:
+        zoom = auto_zoom(west, south, east, north)
+        for z in range(max(zoom - zoom_margin, 0), min(zoom + zoom_margin, MAX_ZOOM) + 1):
+            tiles += tiles_in_bounds(west, south, east, north, z)
+    return tiles
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prefetch the basemap tiles of the impact maps")
+    parser.add_argument("--cache-dir", default=BASEMAP_TILE_DIR, help="Tile store")
+    parser.add_argument("--countries", nargs="*", default=None,
+                        help="ISO3 codes of the countries. Default: all countries of iso3_to_basin")
+    parser.add_argument("--bounds", nargs=4, type=float, action="append", default=[],
+                        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+                        help="Additional extent in degrees, can be repeated")
+    parser.add_argument("--zooms", nargs="+", type=int, default=None,
+                        help="Zoom levels of the additional extents. Default: automatic zoom")
+    parser.add_argument("--max-gb", type=float, default=MAX_CACHE_GB,
+                        help="Size limit of the tile store")
+    parser.add_argument("--n-workers", type=int, default=8, help="Concurrent downloads")
+    args = parser.parse_args()
+
+    countries = args.countries if args.countries is not None else sorted(
+        {iso3 for iso3_list in iso3_to_basin.values() for iso3 in iso3_list})
+    tiles = country_tiles(countries) if countries else []
+    for west, south, east, north in args.bounds:
+        for zoom in args.zooms or [auto_zoom(west, south, east, north)]:
+            tiles += tiles_in_bounds(west, south, east, north, zoom)
+
+    stats = prefetch_tiles(args.cache_dir, tiles, n_workers=args.n_workers)
+    n_evicted = evict_tiles(args.cache_dir, args.max_gb)
+    print(f"Basemap tiles: {stats['downloaded']} downloaded ({stats['bytes'] / 1e6:.1f} MB), "
+          f"{stats['cached']} already cached, {stats['failed']} failed, {n_evicted} evicted")
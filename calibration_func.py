@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for the calibration of the displacement impact functions.
+
+The displacement of each member is evaluated for a whole grid of v_half
+values at once. The Emanuel impact function is piecewise linear in the
+intensity, on a fixed grid of intensity points, so the impact of any v_half
+is the product of its mean damage ratio on these points with a matrix of
+interpolation weights (intensity point x member), which only depends on the
+hazard and the exposure and is computed once.
+
+@author: Pui Man (Mannie) Kam
+"""
+import numpy as np
+from typing import Tuple
+
+from climada.hazard import Hazard
+from climada.entity import Exposures, ImpfTropCyclone
+
+# intensity points of ImpfTropCyclone.from_emanuel_usa, in m/s
+EMANUEL_INTENSITY = np.arange(0, 121, 5)
+
+def exposure_per_centroid(exp: Exposures, tc_haz: Hazard) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sum the exposure values onto the hazard centroids.
+
+    Returns
+    -------
+    centr_idx : np.ndarray
+        Centroids with exposure.
+    exp_totals : np.ndarray
+        Total exposure value at each of these centroids.
+    """
+    if 'centr_TC' not in exp.gdf.columns:
+        exp.assign_centroids(tc_haz)
+    centr = exp.gdf['centr_TC'].values
+    assigned = centr >= 0
+    totals = np.bincount(centr[assigned], weights=exp.gdf['value'].values[assigned],
+                         minlength=tc_haz.intensity.shape[1])
+    [centr_idx] = totals.nonzero()
+
+    return centr_idx, totals[centr_idx]
+
+def interpolation_weights(tc_haz: Hazard,
+                          centr_idx: np.ndarray,
+                          exp_totals: np.ndarray,
+                          intensity_points: np.ndarray = EMANUEL_INTENSITY) -> np.ndarray:
+    """
+    Exposure-weighted linear interpolation weights of the non-zero
+    intensities on the intensity points of an impact function, per member.
+    Intensities above the last point get the weight of the last point, as in
+    the interpolation of the impact functions.
+
+    Returns
+    -------
+    weights : np.ndarray
+        Array of shape (intensity point, member).
+    """
+    intensity = tc_haz.intensity[:, centr_idx].tocoo()
+    n_points, n_members = intensity_points.size, intensity.shape[0]
+
+    idx = np.clip(np.searchsorted(intensity_points, intensity.data, side='right') - 1,
+                  0, n_points - 2)
+    frac = np.clip((intensity.data - intensity_points[idx])
+                   / (intensity_points[idx + 1] - intensity_points[idx]), 0, 1)
+    value = exp_totals[intensity.col]
+
+    weights = np.bincount(idx * n_members + intensity.row, weights=(1 - frac) * value,
+                          minlength=n_points * n_members)
+    weights += np.bincount((idx + 1) * n_members + intensity.row, weights=frac * value,
+                           minlength=n_points * n_members)
+
+    return weights.reshape(n_points, n_members)
+
+def displacement_v_half_sweep(exp: Exposures,
+                              tc_haz: Hazard,
+                              v_half_values: np.ndarray) -> np.ndarray:
+    """
+    Displacement per member for a grid of v_half values of the Emanuel
+    impact function, in one matrix product. Equals the at_event of
+    ImpactCalc with ImpfTropCyclone.from_emanuel_usa(v_half=v_half) for
+    each value, since the impact function is zero at zero intensity.
+
+    Parameters
+    ----------
+    exp : climada.entity.Exposures
+        Exposures of the region to calibrate.
+    tc_haz : climada.hazard.Hazard
+        Wind field of the storm.
+    v_half_values : np.ndarray
+        Values of v_half to evaluate, in m/s.
+
+    Returns
+    -------
+    displacement : np.ndarray
+        Array of shape (v_half, member).
+    """
+    centr_idx, exp_totals = exposure_per_centroid(exp, tc_haz)
+    weights = interpolation_weights(tc_haz, centr_idx, exp_totals, EMANUEL_INTENSITY)
+
+    mdr_table = np.stack([
+        ImpfTropCyclone.from_emanuel_usa(v_half=v_half, intensity=EMANUEL_INTENSITY)
+        .calc_mdr(EMANUEL_INTENSITY)
+        for v_half in np.atleast_1d(v_half_values)
+    ])
+
+    return mdr_table @ weights
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite catalog of the forecast runs, storms, impacts and output files.
+
+Each stage registers what it wrote: tc_windfield_compute.py the wind files
+of every storm (and of its lead-time checkpoints) with their member count
+and statistics, impact_calculate.py the status and summary statistics of
+every (storm, country, impact type) unit and the paths of its outputs.
+The wind files of a run and the latest forecast for a country are then
+indexed lookups instead of directory scans and file name parsing.
+
+Every call opens its own short-lived connection. The catalog has a single
+writer process at a time: the stages run one after the other, worker
+processes do not write to it but return what to register to their parent,
+and within a process the calls are serialized by a lock, so the writer
+threads never write concurrently. SQLite locking is unreliable on NFS, so
+the catalog keeps the rollback journal (journal_mode=DELETE) instead of WAL,
+which needs shared memory between the processes, and is best kept on a
+local disk of the node that runs the stages.
+
+@author: Pui Man (Mannie) Kam
+"""
+import sqlite3
+import threading
+import pandas as pd
+from contextlib import contextmanager
+from typing import Union, List, Tuple, Dict
+from pathlib import Path
+
+from climada.hazard import Hazard
+
+# seconds to wait for a lock held by another stage
+CATALOG_TIMEOUT = 60.
+
+SUMMARY_STATS = ["mean", "median", "05perc", "25perc", "75perc", "95perc"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    forecast_time TEXT PRIMARY KEY,
+    n_storms INTEGER,
+    wind_completed_at TEXT,
+    impact_completed_at TEXT
+);
+CREATE TABLE IF NOT EXISTS storms (
+    forecast_time TEXT NOT NULL,
+    storm_name TEXT NOT NULL,
+    n_members INTEGER,
+    n_centroids INTEGER,
+    max_intensity REAL,
+    wind_file TEXT NOT NULL,
+    PRIMARY KEY (forecast_time, storm_name)
+);
+CREATE TABLE IF NOT EXISTS lead_times (
+    forecast_time TEXT NOT NULL,
+    storm_name TEXT NOT NULL,
+    lead_time_h INTEGER NOT NULL,
+    max_intensity REAL,
+    wind_file TEXT NOT NULL,
+    PRIMARY KEY (forecast_time, storm_name, lead_time_h)
+);
+CREATE TABLE IF NOT EXISTS impacts (
+    forecast_time TEXT NOT NULL,
+    storm_name TEXT NOT NULL,
+    country_iso3 TEXT NOT NULL,
+    impact_type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    mean REAL, median REAL,
+    perc05 REAL, perc25 REAL, perc75 REAL, perc95 REAL,
+    PRIMARY KEY (forecast_time, storm_name, country_iso3, impact_type)
+);
+CREATE INDEX IF NOT EXISTS impacts_country ON impacts (country_iso3, forecast_time);
+CREATE TABLE IF NOT EXISTS outputs (
+    file_path TEXT PRIMARY KEY,
+    forecast_time TEXT NOT NULL,
+    storm_name TEXT NOT NULL,
+    country_iso3 TEXT,
+    impact_type TEXT
+);
+CREATE INDEX IF NOT EXISTS outputs_storm ON outputs (forecast_time, storm_name);
+CREATE TABLE IF NOT EXISTS schedule (
+    forecast_time TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    storm_name TEXT NOT NULL,
+    rank INTEGER,
+    priority REAL,
+    cost REAL,
+    predicted_s REAL,
+    actual_s REAL,
+    published_at TEXT,
+    PRIMARY KEY (forecast_time, stage, storm_name)
+);
+"""
+
+_initialized = set()
+
+# one connection at a time per process (single writer, see above)
+_lock = threading.RLock()
+
+@contextmanager
+def _connect(catalog_file: Union[str, Path]):
+    """Connection to the catalog, committed and closed at the end of the block."""
+    catalog_file = str(catalog_file)
+    with _lock:
+        conn = sqlite3.connect(catalog_file, timeout=CATALOG_TIMEOUT)
+        try:
+            if catalog_file not in _initialized:
+                conn.execute("PRAGMA journal_mode=DELETE")
+                conn.executescript(_SCHEMA)
+                _initialized.add(catalog_file)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+def _now() -> str:
+    return pd.Timestamp.now(tz='UTC').isoformat()
+
+def wind_file_stats(tc_haz: Hazard) -> Tuple[int, int, float]:
+    """
+    Number of members, number of centroids and maximum intensity of a wind
+    field, to register its file (see register_storm), e.g. computed in a
+    worker process and registered by the parent.
+    """
+    return (int(tc_haz.intensity.shape[0]), int(tc_haz.intensity.shape[1]),
+            float(tc_haz.intensity.max()) if tc_haz.intensity.nnz else 0.)
+
+def register_run(catalog_file: Union[str, Path], forecast_time: str,
+                 stage: str, n_storms: int = None) -> None:
+    """
+    Record the completion of a stage ('wind' or 'impact') of a run.
+    """
+    with _connect(catalog_file) as conn:
+        conn.execute("INSERT OR IGNORE INTO runs (forecast_time) VALUES (?)", (forecast_time,))
+        conn.execute(f"UPDATE runs SET {stage}_completed_at = ? WHERE forecast_time = ?",
+                     (_now(), forecast_time))
+        if n_storms is not None:
+            conn.execute("UPDATE runs SET n_storms = ? WHERE forecast_time = ?",
+                         (n_storms, forecast_time))
+
+def register_storm(catalog_file: Union[str, Path], forecast_time: str, storm_name: str,
+                   wind_stats: Tuple[int, int, float], wind_file: Union[str, Path]) -> None:
+    """
+    Record the wind file of a storm, once written, with its statistics (see
+    wind_file_stats).
+    """
+    n_members, n_centroids, max_intensity = wind_stats
+    with _connect(catalog_file) as conn:
+        conn.execute("INSERT OR IGNORE INTO runs (forecast_time) VALUES (?)", (forecast_time,))
+        conn.execute("INSERT OR REPLACE INTO storms VALUES (?, ?, ?, ?, ?, ?)",
+                     (forecast_time, storm_name, n_members, n_centroids, max_intensity,
+                      str(wind_file)))
+
+def register_lead_time(catalog_file: Union[str, Path], forecast_time: str, storm_name: str,
+                       lead_time_h: float, wind_stats: Tuple[int, int, float],
+                       wind_file: Union[str, Path]) -> None:
+    """
+    Record the wind file of a storm up to a lead-time checkpoint, once
+    written, with its statistics (see wind_file_stats).
+    """
+    with _connect(catalog_file) as conn:
+        conn.execute("INSERT OR REPLACE INTO lead_times VALUES (?, ?, ?, ?, ?)",
+                     (forecast_time, storm_name, int(lead_time_h), wind_stats[2],
+                      str(wind_file)))
+
+def register_impact(catalog_file: Union[str, Path], forecast_time: str, storm_name: str,
+                    country_iso3: str, impact_type: str, status: str,
+                    imp_summary_dict: dict = None) -> None:
+    """
+    Record the status of a (storm, country, impact type) unit (see
+    checkpoint_func.record_progress) and its summary statistics, if saved.
+    """
+    stats = [imp_summary_dict[stat] if imp_summary_dict else None for stat in SUMMARY_STATS]
+    with _connect(catalog_file) as conn:
+        conn.execute("INSERT OR REPLACE INTO impacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (forecast_time, storm_name, country_iso3, impact_type, status, *stats))
+
+def register_ledger(catalog_file: Union[str, Path], forecast_time: str, ledger: dict) -> None:
+    """
+    Record all units of the progress ledger of a run (see
+    checkpoint_func.load_progress_ledger) in one transaction.
+    """
+    rows = [(forecast_time, tc_name, country_iso3, impact_type, record['status'],
+             *[record['summary'][stat] if record['summary'] else None for stat in SUMMARY_STATS])
+            for (tc_name, country_iso3, impact_type), record in list(ledger.items())]
+    with _connect(catalog_file) as conn:
+        conn.executemany("INSERT OR REPLACE INTO impacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         rows)
+
+def register_outputs(catalog_file: Union[str, Path], forecast_time: str, storm_name: str,
+                     file_names: List[Union[str, Path]], country_iso3: str = None,
+                     impact_type: str = None) -> None:
+    """
+    Record output files of a storm, or of a (storm, country, impact type)
+    unit, once written.
+    """
+    with _connect(catalog_file) as conn:
+        conn.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)",
+                         [(str(file_name), forecast_time, storm_name, country_iso3, impact_type)
+                          for file_name in file_names])
+
+def register_schedule(catalog_file: Union[str, Path], forecast_time: str, stage: str,
+                      schedule: List[Tuple[str, float, float, float]]) -> None:
+    """
+    Record the order in which the storms of a stage ('wind' or 'impact') are
+    processed, as (storm name, priority, cost, predicted seconds) in order.
+    """
+    with _connect(catalog_file) as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO schedule (forecast_time, stage, storm_name, rank, priority, "
+            "cost, predicted_s) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(forecast_time, stage, storm_name, rank, priority, cost, predicted_s)
+             for rank, (storm_name, priority, cost, predicted_s) in enumerate(schedule)])
+
+def update_schedule_cost(catalog_file: Union[str, Path], forecast_time: str, stage: str,
+                         storm_name: str, cost: float, predicted_s: float) -> None:
+    """
+    Record the cost and the predicted runtime of a storm in a stage once
+    they are known, e.g. in the impact stage from the exposures of its
+    countries.
+    """
+    with _connect(catalog_file) as conn:
+        conn.execute("UPDATE schedule SET cost = ?, predicted_s = ? "
+                     "WHERE forecast_time = ? AND stage = ? AND storm_name = ?",
+                     (cost, predicted_s, forecast_time, stage, storm_name))
+
+def register_published(catalog_file: Union[str, Path], forecast_time: str, stage: str,
+                       storm_name: str, actual_s: float) -> None:
+    """
+    Record that the products of a storm in a stage are complete, with the
+    actual runtime.
+    """
+    with _connect(catalog_file) as conn:
+        conn.execute("UPDATE schedule SET actual_s = ?, published_at = ? "
+                     "WHERE forecast_time = ? AND stage = ? AND storm_name = ?",
+                     (actual_s, _now(), forecast_time, stage, storm_name))
+
+def get_schedule(catalog_file: Union[str, Path], forecast_time: str, stage: str) -> pd.DataFrame:
+    """Schedule of a stage of a run, with the predicted and actual runtimes."""
+    with _connect(catalog_file) as conn:
+        return pd.read_sql_query("SELECT * FROM schedule WHERE forecast_time = ? AND stage = ? "
+                                 "ORDER BY rank", conn, params=(forecast_time, stage))
+
+def seconds_per_cost(catalog_file: Union[str, Path], stage: str, n_last: int = 200) -> float:
+    """
+    Median runtime per unit of cost of the last storms of a stage, to predict
+    the runtime from the cost. None without history.
+    """
+    with _connect(catalog_file) as conn:
+        ratios = [ratio for (ratio,) in conn.execute(
+            "SELECT actual_s / cost FROM schedule WHERE stage = ? AND actual_s IS NOT NULL "
+            "AND cost > 0 ORDER BY published_at DESC LIMIT ?", (stage, n_last))]
+    return float(pd.Series(ratios).median()) if ratios else None
+
+def get_storm_wind_files(catalog_file: Union[str, Path],
+                         forecast_time: pd.Timestamp,
+                         previous_forecast_time: pd.Timestamp) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Get the storms and their wind files for the given forecast time, or for
+    the previous forecast time if there are none.
+
+    Returns
+    -------
+    forecast_time_str : str
+        Forecast time of the wind files.
+    storm_wind_files : List[Tuple[str, str]]
+        Storm name and wind file of each storm.
+    """
+    for run_time in [forecast_time, previous_forecast_time]:
+        forecast_time_str = run_time.strftime('%Y-%m-%d_%HUTC')
+        with _connect(catalog_file) as conn:
+            storm_wind_files = conn.execute(
+                "SELECT storm_name, wind_file FROM storms WHERE forecast_time = ? ORDER BY storm_name",
+                (forecast_time_str,)).fetchall()
+        if storm_wind_files:
+            break
+        print(f"No TC activities at {forecast_time_str} in the catalog.")
+
+    return forecast_time_str, storm_wind_files
+
+def get_lead_time_wind_files(catalog_file: Union[str, Path], forecast_time: str,
+                             storm_name: str) -> Dict[int, str]:
+    """
+    Wind files of a storm up to each lead-time checkpoint (hours).
+    """
+    with _connect(catalog_file) as conn:
+        return dict(conn.execute(
+            "SELECT lead_time_h, wind_file FROM lead_times "
+            "WHERE forecast_time = ? AND storm_name = ? ORDER BY lead_time_h",
+            (forecast_time, storm_name)).fetchall())
+
+def latest_forecast_for_country(catalog_file: Union[str, Path], country_iso3: str,
+                                impact_type: str = None) -> pd.DataFrame:
+    """
+    Impacts of all storms on a country in the latest forecast that has any
+    (status and summary statistics, one row per storm and impact type).
+    """
+    type_filter = "" if impact_type is None else " AND impact_type = ?"
+    type_args = () if impact_type is None else (impact_type,)
+    with _connect(catalog_file) as conn:
+        return pd.read_sql_query(
+            "SELECT * FROM impacts WHERE country_iso3 = ?" + type_filter +
+            " AND forecast_time = (SELECT MAX(forecast_time) FROM impacts"
+            " WHERE country_iso3 = ?" + type_filter + ") ORDER BY storm_name, impact_type",
+            conn, params=(country_iso3, *type_args, country_iso3, *type_args))
+
+def get_outputs(catalog_file: Union[str, Path], forecast_time: str, storm_name: str = None,
+                country_iso3: str = None) -> List[str]:
+    """
+    Output files of a run, optionally of a storm and a country only.
+    """
+    query, args = "SELECT file_path FROM outputs WHERE forecast_time = ?", [forecast_time]
+    for col, value in [('storm_name', storm_name), ('country_iso3', country_iso3)]:
+        if value is not None:
+            query += f" AND {col} = ?"
+            args.append(value)
+    with _connect(catalog_file) as conn:
+        return [file_path for (file_path,) in conn.execute(query + " ORDER BY file_path", args)]
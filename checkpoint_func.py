@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for crash-safe outputs and resuming an interrupted run.
+
+Every output is written to a temporary file next to its destination and
+renamed once complete, so that a crash never leaves half-written files.
+A per-run progress ledger records the completed (storm, country, impact
+type) units, so that a restart only redoes the unfinished ones.
+
+@author: Pui Man (Mannie) Kam
+"""
+import os
+import json
+import uuid
+from contextlib import contextmanager
+from typing import Union, List
+from pathlib import Path
+
+PROGRESS_LEDGER_FILE_NAME = "progress_TC_ECMWF_{forecast_time}.jsonl"
+
+@contextmanager
+def atomic_file(file_name: Union[str, Path]):
+    """
+    Context manager that yields a temporary file name to write to, and
+    renames the temporary file to file_name once the block completes. The
+    temporary file keeps the extension of file_name, so that writers that
+    infer the format from it (savefig, to_file) still work, and is unique
+    per process and call, so that concurrent writers of the same file never
+    share it.
+
+    Example
+    -------
+    with atomic_file(save_dir + file_name) as tmp_file:
+        df.to_csv(tmp_file)
+    """
+    file_name = str(file_name)
+    tmp_file = os.path.join(os.path.dirname(file_name),
+                            f'.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}-'
+                            + os.path.basename(file_name))
+    try:
+        yield tmp_file
+        os.replace(tmp_file, file_name)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def make_progress_ledger_file_name(save_dir: Union[str, Path], forecast_time: str):
+    """File of the progress ledger of a run."""
+    return os.path.join(save_dir, PROGRESS_LEDGER_FILE_NAME.format(forecast_time=forecast_time))
+
+def load_progress_ledger(ledger_file: Union[str, Path]) -> dict:
+    """
+    Load the completed units of a run.
+
+    Returns
+    -------
+    ledger : dict
+        Record (status and forecast summary) per (storm, country, impact type).
+    """
+    ledger = {}
+    if os.path.exists(ledger_file):
+        with open(ledger_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError: # last line of a crashed run
+                    continue
+                ledger[(record['eventName'], record['countryISO3'], record['impactType'])] = record
+    return ledger
+
+def record_progress(ledger_file: Union[str, Path],
+                    ledger: dict,
+                    tc_name: str,
+                    country_iso3: str,
+                    impact_type: str,
+                    status: str,
+                    imp_summary_dict: dict = None):
+    """
+    Record a completed unit in the progress ledger (file and loaded ledger).
+
+    Parameters
+    ----------
+    ledger_file : Union[str, Path]
+        File of the progress ledger.
+    ledger : dict
+        Loaded progress ledger, updated in place.
+    tc_name, country_iso3, impact_type : str
+        The unit.
+    status : str
+        'saved' (all outputs written), 'zero' (no impact, nothing saved),
+        'skipped' (not computed, e.g. no exposed population) or 'no_exposure'.
+    imp_summary_dict : dict
+        Forecast summary of the unit, if saved.
+    """
+    record = {'eventName': tc_name, 'countryISO3': country_iso3, 'impactType': impact_type,
+              'status': status, 'summary': imp_summary_dict}
+    with open(ledger_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    ledger[(tc_name, country_iso3, impact_type)] = record
+
+def is_country_done(ledger: dict, tc_name: str, country_iso3: str,
+                    impact_types: List[str]) -> bool:
+    """Whether all impact types of a (storm, country) pair are completed."""
+    return all((tc_name, country_iso3, impact_type) in ledger for impact_type in impact_types)
+
+def completed_summaries(ledger: dict, tc_name: str, country_iso3: str) -> dict:
+    """Forecast summaries of the saved impact types of a (storm, country) pair."""
+    return {impact_type: record['summary']
+            # copy, since the background writer may record units meanwhile
+            for (name, iso3, impact_type), record in list(ledger.items())
+            if name == tc_name and iso3 == country_iso3 and record['status'] == 'saved'}
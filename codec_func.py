@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Quantized storage of the wind intensity in the tc_wind HDF5 files.
+
+The wind speeds only matter to about 0.1 m/s, so the nonzero intensities are
+quantized and written as compressed datasets, in a single pass into a fresh
+file (datasets deleted from an HDF5 file do not free their space):
+
+- 'scaleoffset': float32 with the HDF5 scale-offset filter at 0.01 m/s,
+  decoded by the HDF5 library itself, so that Hazard.from_hdf5 (and any
+  other reader of the files) reads them as usual.
+- 'uint16', 'uint8': unsigned integer codes with a scale and an offset
+  (intensity = offset + scale * code) kept as attributes of the intensity
+  group, for computing the impacts on the codes (see read_hazard_codes and
+  impact_calc_func.calc_impact_quantized). Code 0 is reserved for no wind,
+  so intensities that round to it are not stored. Only read_hazard decodes
+  them, Hazard.from_hdf5 returns the codes.
+
+read_hazard reads the files of every codec, and files without codec as they are.
+
+@author: Pui Man (Mannie) Kam
+"""
+import os
+import tempfile
+import h5py
+import numpy as np
+from typing import Union, Tuple, Optional
+from pathlib import Path
+from scipy import sparse
+
+from climada.hazard import Hazard
+
+# codecs: integer type, scale (m/s per code) and offset (m/s), code 0 is no wind
+INTENSITY_CODECS = {
+    'uint16': (np.uint16, .01, 0.),        # 0.01 m/s up to 655 m/s
+    'uint8': (np.uint8, .5, 17.5 - .5),    # 0.5 m/s from the 17.5 m/s threshold (code 1) up to 144.5 m/s
+}
+
+# codec decoded by the HDF5 library: decimal digits kept by the scale-offset filter
+SCALEOFFSET_CODEC = 'scaleoffset'
+SCALEOFFSET_DIGITS = 2
+
+SCALE_ATTR = 'scale_factor'
+OFFSET_ATTR = 'add_offset'
+
+def encode_intensity(intensity_data: np.ndarray, codec: str = 'uint16') -> np.ndarray:
+    """
+    Encode the nonzero intensities into integer codes, clipped to the range
+    of the codec. Intensities that round to code 0 (below offset + scale / 2)
+    become 0, i.e. no wind.
+    """
+    int_type, scale, offset = INTENSITY_CODECS[codec]
+    codes = np.rint((intensity_data - offset) / scale)
+    return np.clip(codes, 0, np.iinfo(int_type).max).astype(int_type)
+
+def decode_intensity(codes: np.ndarray, scale: float, offset: float,
+                     dtype: type = np.float32) -> np.ndarray:
+    """
+    Decode integer codes into intensities, code 0 into 0 (no wind).
+    """
+    intensity = (offset + scale * codes.astype(dtype)).astype(dtype)
+    intensity[codes == 0] = 0
+    return intensity
+
+def _compressed_dataset(group: h5py.Group, name: str, values: np.ndarray, **kwargs) -> None:
+    """Dataset with gzip and shuffle (an empty dataset cannot be chunked)."""
+    if values.size == 0:
+        group.create_dataset(name, data=values)
+    else:
+        group.create_dataset(name, data=values, compression='gzip', compression_opts=4,
+                             shuffle=True, **kwargs)
+
+def write_hazard(tc_haz: Hazard, file_name: Union[str, Path], codec: str = None) -> None:
+    """
+    Write a hazard to HDF5, with the intensity quantized with the given codec
+    ('scaleoffset', 'uint16' or 'uint8'). Without codec, the hazard is
+    written as by Hazard.write_hdf5.
+
+    With a codec, the hazard is first written by Hazard.write_hdf5 into a
+    local temporary file, which is copied into file_name with the intensity
+    datasets encoded and compressed.
+    """
+    if codec is None:
+        tc_haz.write_hdf5(file_name)
+        return
+
+    intensity = tc_haz.intensity.tocsr()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plain_file = os.path.join(tmp_dir, os.path.basename(str(file_name)))
+        tc_haz.write_hdf5(plain_file)
+
+        with h5py.File(plain_file, 'r') as hf_in, h5py.File(file_name, 'w') as hf_out:
+            hf_out.attrs.update(hf_in.attrs)
+            for name in hf_in:
+                if name != 'intensity':
+                    hf_in.copy(hf_in[name], hf_out, name=name)
+
+            hf_csr = hf_out.create_group('intensity')
+            hf_csr.attrs.update(hf_in['intensity'].attrs)
+            for name in hf_in['intensity']:
+                if name not in ('data', 'indices', 'indptr'):
+                    hf_in.copy(hf_in['intensity'][name], hf_csr, name=name)
+
+            if codec == SCALEOFFSET_CODEC:
+                _compressed_dataset(hf_csr, 'data', intensity.data.astype(np.float32),
+                                    scaleoffset=SCALEOFFSET_DIGITS)
+            else:
+                # the intensities that round to code 0 (no wind) are not stored
+                # (on a copy, the hazard itself is left unchanged)
+                intensity = sparse.csr_matrix(
+                    (encode_intensity(intensity.data, codec), intensity.indices.copy(),
+                     intensity.indptr.copy()), shape=intensity.shape)
+                intensity.eliminate_zeros()
+                _compressed_dataset(hf_csr, 'data', intensity.data)
+                _, scale, offset = INTENSITY_CODECS[codec]
+                hf_csr.attrs[SCALE_ATTR] = scale
+                hf_csr.attrs[OFFSET_ATTR] = offset
+            _compressed_dataset(hf_csr, 'indices', intensity.indices)
+            _compressed_dataset(hf_csr, 'indptr', intensity.indptr)
+
+def read_hazard_quantized(file_name: Union[str, Path]) -> Tuple[Hazard, float, float]:
+    """
+    Read a hazard, keeping the intensity as integer codes.
+
+    Returns
+    -------
+    tc_haz : climada.hazard.Hazard
+        Hazard with the integer codes as intensity.
+    scale, offset : float
+        Codec of the intensity (intensity = offset + scale * code). A file
+        without integer codec (none or 'scaleoffset') gives a scale of None.
+    """
+    tc_haz = Hazard.from_hdf5(file_name)
+    with h5py.File(file_name, 'r') as hf:
+        attrs = hf['intensity'].attrs if 'intensity' in hf else {}
+        scale = float(attrs[SCALE_ATTR]) if SCALE_ATTR in attrs else None
+        offset = float(attrs[OFFSET_ATTR]) if OFFSET_ATTR in attrs else 0.
+
+    return tc_haz, scale, offset
+
+def read_hazard(file_name: Union[str, Path], dtype: type = np.float32) -> Hazard:
+    """
+    Read a hazard written with or without codec, the quantized intensity is
+    decoded to the given floating point type. Use it in place of
+    Hazard.from_hdf5 for the tc_wind files.
+    """
+    tc_haz, scale, offset = read_hazard_quantized(file_name)
+    if scale is not None:
+        tc_haz.intensity.data = decode_intensity(tc_haz.intensity.data, scale, offset, dtype)
+
+    return tc_haz
+
+def read_hazard_codes(file_name: Union[str, Path], dtype: type = np.float32
+                      ) -> Tuple[Hazard, Optional[Tuple[sparse.csr_matrix, float, float]]]:
+    """
+    Read a hazard as read_hazard, and keep the integer codes of the intensity
+    for computing the impacts on them (see impact_calc_func.calc_impact_quantized).
+
+    Returns
+    -------
+    tc_haz : climada.hazard.Hazard
+        Hazard with the decoded intensity.
+    intensity_codes : Tuple[scipy.sparse.csr_matrix, float, float]
+        Integer codes of the intensity, scale and offset. None if the file has
+        no integer codec (none or 'scaleoffset').
+    """
+    tc_haz, scale, offset = read_hazard_quantized(file_name)
+    if scale is None:
+        return tc_haz, None
+
+    codes = tc_haz.intensity
+    tc_haz.intensity = sparse.csr_matrix(
+        (decode_intensity(codes.data, scale, offset, dtype), codes.indices.copy(),
+         codes.indptr.copy()), shape=codes.shape)
+    return tc_haz, (codes, scale, offset)
+
+def intensity_levels(scale: float, offset: float, int_type: type = np.uint16) -> np.ndarray:
+    """
+    Intensity of every code of a codec, for building lookup tables
+    """
+    return decode_intensity(np.arange(np.iinfo(int_type).max + 1), scale, offset, np.float64)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for the run-over-run (delta) processing of consecutive
+12-hourly forecasts.
+
+Each run stores a run state with a summary of the hazard footprint and the
+forecast summaries of every (storm, country) pair. The next run only
+recomputes the pairs whose footprint changed meaningfully (beyond a
+tolerance, see footprint_changed), carries over the outputs of the others,
+and writes a "change since last forecast" table. Carried-over pairs are
+always compared with the footprint of the run that computed them, so that
+small changes do not add up over several runs.
+
+@author: Pui Man (Mannie) Kam
+"""
+import io
+import os
+import glob
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from typing import Union, List, Tuple
+from pathlib import Path
+from scipy import sparse
+
+from climada.hazard import Hazard
+from climada.engine import Impact
+
+from checkpoint_func import atomic_file
+from writer_func import AsyncWriter, write_bytes
+
+RUN_STATE_FILE_NAME = "run-state_TC_ECMWF_{forecast_time}.json"
+
+# summary statistics compared between two runs
+CHANGE_STATS = ["mean", "median", "05perc", "95perc"]
+
+# tolerance of the footprint comparison: wind speed (m/s) of the per-member
+# maximum and mean wind, and relative change of the area above the threshold
+FOOTPRINT_TOL_MS = 1.
+FOOTPRINT_REL_TOL = .05
+
+# outputs that show the forecast time, re-rendered instead of carried over
+RENDERED_OUTPUT_PREFIXES = ("impact-map", "impact-histogram")
+
+def hazard_footprint(tc_haz: Hazard,
+                     centroid_idx: np.ndarray,
+                     wind_thres: float) -> dict:
+    """
+    Summary of the wind field of all ensemble members at the given centroids
+    (e.g. the centroids of a country): maximum wind, mean wind and number of
+    centroids with at least wind_thres of each member. The members are
+    sorted, since the members of two runs are independent draws and only
+    their distribution (as in the forecast summaries) is compared.
+
+    Parameters
+    ----------
+    tc_haz : climada.hazard.Hazard
+        Wind field of all ensemble members of a storm.
+    centroid_idx : np.ndarray
+        Indices of the centroids to consider.
+    wind_thres : float
+        Wind speed threshold in m/s, e.g. the threshold of the exposed population.
+
+    Returns
+    -------
+    footprint : dict
+        Number of centroids and the sorted per-member statistics (JSON serializable).
+    """
+    intensity = sparse.csr_matrix(tc_haz.intensity[:, np.sort(centroid_idx)])
+    n_centroids = max(intensity.shape[1], 1)
+    return {
+        "n_centroids": int(intensity.shape[1]),
+        "max_wind": np.sort(intensity.max(axis=1).toarray().ravel()).tolist(),
+        "mean_wind": np.sort(np.asarray(intensity.sum(axis=1)).ravel() / n_centroids).tolist(),
+        "n_above": np.sort(np.asarray((intensity >= wind_thres).sum(axis=1)).ravel()).tolist(),
+    }
+
+def footprint_changed(footprint: dict,
+                      prev_footprint: dict,
+                      tol_ms: float = FOOTPRINT_TOL_MS,
+                      rel_tol: float = FOOTPRINT_REL_TOL) -> bool:
+    """
+    Whether the footprint of a (storm, country) pair changed meaningfully
+    since a previous run (see hazard_footprint): different centroids or
+    number of members, a sorted per-member maximum or mean wind that moved by
+    more than tol_ms, or an area above the threshold that changed by more
+    than rel_tol (relative). A missing previous footprint counts as changed.
+    """
+    if not prev_footprint or footprint["n_centroids"] != prev_footprint["n_centroids"] \
+            or len(footprint["max_wind"]) != len(prev_footprint["max_wind"]):
+        return True
+    for stat in ("max_wind", "mean_wind"):
+        if np.max(np.abs(np.subtract(footprint[stat], prev_footprint[stat])), initial=0.) > tol_ms:
+            return True
+    n_above, prev_n_above = np.asarray(footprint["n_above"]), np.asarray(prev_footprint["n_above"])
+    return bool(np.any(np.abs(n_above - prev_n_above) > rel_tol * np.fmax(prev_n_above, 1)))
+
+def load_run_state(save_dir: Union[str, Path], forecast_time: str) -> dict:
+    """Load the run state of a forecast, empty if the run has none."""
+    state_file = os.path.join(save_dir, RUN_STATE_FILE_NAME.format(forecast_time=forecast_time))
+    if not os.path.exists(state_file):
+        return {"storms": {}}
+    with open(state_file) as f:
+        return json.load(f)
+
+def save_run_state(save_dir: Union[str, Path], forecast_time: str, run_state: dict,
+                   writer: AsyncWriter = None):
+    """
+    Save the run state of a forecast.
+    Written in the background if an AsyncWriter is given.
+    """
+    state_file = os.path.join(save_dir, RUN_STATE_FILE_NAME.format(forecast_time=forecast_time))
+    return write_bytes(state_file, json.dumps(run_state, indent=4).encode(), writer)
+
+def carry_over_outputs(prev_save_dir: Union[str, Path],
+                       save_dir: Union[str, Path],
+                       tc_name: str,
+                       country_iso3: str,
+                       prev_forecast_time: str,
+                       forecast_time: str) -> List[str]:
+    """
+    Copy the outputs of an unchanged (storm, country) pair from the previous
+    run to the current one, with the forecast time in the file names (and in
+    the forecast summaries) replaced by the current one. The maps and
+    histograms show the forecast time and are not copied, they are
+    re-rendered from the carried-over impacts (see load_carried_impact).
+
+    Returns
+    -------
+    files : List[str]
+        Copied files.
+    """
+    pattern = os.path.join(prev_save_dir,
+                           f"*_TC_ECMWF_ens_{tc_name}_{prev_forecast_time}_{country_iso3}_*")
+    files = []
+    for prev_file in glob.glob(pattern):
+        if os.path.basename(prev_file).startswith(RENDERED_OUTPUT_PREFIXES):
+            continue
+        new_file = os.path.join(save_dir, os.path.basename(prev_file).replace(
+            f"_{tc_name}_{prev_forecast_time}_", f"_{tc_name}_{forecast_time}_"))
+        if os.path.basename(prev_file).startswith("impact-summary"):
+            with open(prev_file) as f:
+                geojson_data = json.load(f)
+            for feature in geojson_data["features"]:
+                feature["properties"]["initializationTime"] = forecast_time
+            with atomic_file(new_file) as tmp_file:
+                with open(tmp_file, 'w') as f:
+                    json.dump(geojson_data, f, indent=4)
+        else:
+            with atomic_file(new_file) as tmp_file:
+                shutil.copyfile(prev_file, tmp_file)
+        files.append(new_file)
+    return files
+
+def make_save_impact_points_file_name(tc_name: str, forecast_time: str,
+                                      country_iso3: str, impact_type: str):
+    """
+    Make a file name for saving the ensemble mean impact per exposure point
+    """
+    return (f'impact-points_TC_ECMWF_ens_{tc_name}_{forecast_time}'
+            f'_{country_iso3}_{impact_type}.npz')
+
+def save_impact_points(save_dir: Union[str, Path],
+                       imp_summary_dict: dict,
+                       impact: Impact,
+                       writer: AsyncWriter = None):
+    """
+    Save the ensemble mean impact of the exposure points with impact, so that
+    the storm raster and the map can be rebuilt when the pair is carried over,
+    with the bounds (lat_min, lat_max, lon_min, lon_max) of all exposure points.
+    Written in the background if an AsyncWriter is given.
+    """
+    idx_imp = np.flatnonzero(impact.eai_exp)
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, coord_exp=impact.coord_exp[idx_imp],
+                        eai_exp=impact.eai_exp[idx_imp],
+                        exp_bounds=np.array([impact.coord_exp[:, 0].min(), impact.coord_exp[:, 0].max(),
+                                             impact.coord_exp[:, 1].min(), impact.coord_exp[:, 1].max()]))
+    return write_bytes(os.path.join(save_dir, make_save_impact_points_file_name(
+                           imp_summary_dict["eventName"], imp_summary_dict["initializationTime"],
+                           imp_summary_dict["countryISO3"], imp_summary_dict["impactType"])),
+                       buffer.getvalue(), writer)
+
+def load_impact_points(save_dir: Union[str, Path], tc_name: str, forecast_time: str,
+                       country_iso3: str, impact_type: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load the ensemble mean impact per exposure point saved by save_impact_points.
+
+    Returns
+    -------
+    coord_exp, eai_exp : np.ndarray
+        Coordinates (lat, lon) and ensemble mean impact of the exposure points.
+    """
+    with np.load(os.path.join(save_dir, make_save_impact_points_file_name(
+            tc_name, forecast_time, country_iso3, impact_type))) as points:
+        return points["coord_exp"], points["eai_exp"]
+
+def load_carried_impact(save_dir: Union[str, Path], imp_summary_dict: dict) -> Impact:
+    """
+    Impact of a carried-over (storm, country, impact type) with what the maps
+    and histograms need: the impact per member (impact-at-event file) and the
+    ensemble mean impact of the exposure points (see save_impact_points). Two
+    points without impact at the corners of the exposure bounds keep the
+    extent of the map. The coordinates are not those of the exposure of the
+    country, so the hexbin of such an impact must not replace the cached one
+    of the country (see hexbin_func.get_country_hexbin without cache_dir).
+    """
+    file_key = (f'_TC_ECMWF_ens_{imp_summary_dict["eventName"]}_{imp_summary_dict["initializationTime"]}'
+                f'_{imp_summary_dict["countryISO3"]}_{imp_summary_dict["impactType"]}')
+    at_event = pd.read_csv(os.path.join(save_dir, f'impact-at-event{file_key}.csv'), index_col=0)
+    with np.load(os.path.join(save_dir, make_save_impact_points_file_name(
+            imp_summary_dict["eventName"], imp_summary_dict["initializationTime"],
+            imp_summary_dict["countryISO3"], imp_summary_dict["impactType"]))) as points:
+        coord_exp, eai_exp = points["coord_exp"], points["eai_exp"]
+        if "exp_bounds" in points.files:
+            lat_min, lat_max, lon_min, lon_max = points["exp_bounds"]
+            coord_exp = np.vstack([coord_exp, [[lat_min, lon_min], [lat_max, lon_max]]])
+            eai_exp = np.append(eai_exp, [0., 0.])
+
+    return Impact(event_id=at_event["ensemble_id"].values,
+                  at_event=at_event["at_event"].values,
+                  coord_exp=coord_exp,
+                  eai_exp=eai_exp,
+                  haz_type='TC')
+
+def make_change_table(run_state: dict, prev_run_state: dict) -> pd.DataFrame:
+    """
+    Table of the change of the forecast summaries since the previous run,
+    with one row per (storm, country, impact type) of either run.
+
+    The status is 'new' (not in the previous run), 'ended' (not in the
+    current run), 'unchanged' (footprint within the tolerance, outputs carried over)
+    or 'updated'.
+    """
+    def _summaries(state):
+        return {(tc_name, country_iso3, impact_type): (storm_state, country_state, summary)
+                for tc_name, storm_state in state["storms"].items()
+                for country_iso3, country_state in storm_state["countries"].items()
+                for impact_type, summary in country_state["summaries"].items()}
+
+    summaries = _summaries(run_state)
+    prev_summaries = _summaries(prev_run_state)
+
+    rows = []
+    for key in sorted(set(summaries) | set(prev_summaries)):
+        storm_state, country_state, summary = summaries.get(key, ({}, {}, {}))
+        prev_storm_state, prev_country_state, prev_summary = prev_summaries.get(key, ({}, {}, {}))
+        if not prev_summary:
+            status = "new"
+        elif not summary:
+            status = "ended"
+        elif country_state.get("carried_over"):
+            status = "unchanged"
+        else:
+            status = "updated"
+
+        row = {"eventName": key[0], "countryISO3": key[1], "impactType": key[2],
+               "status": status,
+               "nMembers": storm_state.get("n_members"),
+               "nMembersPrevious": prev_storm_state.get("n_members")}
+        for stat in CHANGE_STATS:
+            value = summary.get(stat, 0.)
+            prev_value = prev_summary.get(stat, 0.)
+            row[stat] = value
+            row[f"{stat}Previous"] = prev_value
+            row[f"{stat}Change"] = value - prev_value
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+def save_change_table(save_dir: Union[str, Path],
+                      forecast_time: str,
+                      change_df: pd.DataFrame,
+                      writer: AsyncWriter = None):
+    """
+    Save the change since the last forecast into a CSV file.
+    Written in the background if an AsyncWriter is given.
+    """
+    return write_bytes(os.path.join(save_dir, f'impact-change_TC_ECMWF_ens_{forecast_time}.csv'),
+                       change_df.to_csv(index=False).encode(), writer)
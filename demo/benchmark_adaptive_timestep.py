@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the adaptive track time-stepping against the fixed time step
+of 0.5 h on the demo data.
+Output: number of track points, wind field computation time and the
+        difference in the maximum wind swath for each storm.
+
+@author: Pui Man (Mannie) Kam
+"""
+import sys
+import time
+import numpy as np
+from pathlib import Path
+import warnings
+warnings.filterwarnings("ignore")
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from climada.hazard import TropCyclone
+from climada_petals.hazard import TCForecast
+from climada.util.api_client import Client
+
+from tc_tracks_func import (
+    filter_storm, _correct_max_sustained_wind_speed, adaptive_timestep
+)
+
+client = Client()
+
+BUFR_TRACKS_FOLDER = "./demo/data/20240825000000"
+
+FIXED_TIME_STEP_H = .5
+
+glob_centroids = client.get_centroids()
+
+tr_fcast = TCForecast()
+tr_fcast.fetch_ecmwf(path=BUFR_TRACKS_FOLDER)
+tr_filter = filter_storm(tr_fcast)
+_correct_max_sustained_wind_speed(tr_filter)
+
+print(f"{'storm':<12}{'mode':<10}{'points':>10}{'time (s)':>12}"
+      f"{'max abs diff (m/s)':>22}{'rel diff max wind':>20}")
+
+for tr_name in sorted(set([tr.name for tr in tr_filter.data])):
+    tr_fixed = tr_filter.subset({'name': tr_name})
+    tr_adaptive = tr_filter.subset({'name': tr_name})
+    tr_fixed.equal_timestep(FIXED_TIME_STEP_H)
+    adaptive_timestep(tr_adaptive)
+
+    centroids_refine = glob_centroids.select(extent=tr_fixed.get_extent(deg_buffer=5.))
+
+    results = {}
+    for mode, tracks in [('fixed', tr_fixed), ('adaptive', tr_adaptive)]:
+        time_start = time.time()
+        tc_wind = TropCyclone.from_tracks(tracks, centroids_refine, model="H1980")
+        results[mode] = (sum(tr.time.size for tr in tracks.data),
+                         time.time() - time_start,
+                         tc_wind.intensity.toarray())
+
+    n_fixed, t_fixed, int_fixed = results['fixed']
+    n_adapt, t_adapt, int_adapt = results['adaptive']
+    max_abs_diff = np.abs(int_fixed - int_adapt).max()
+    rel_diff_max = np.abs(int_adapt.max(axis=1) - int_fixed.max(axis=1)).max() \
+        / max(int_fixed.max(), 1e-6)
+
+    print(f"{tr_name:<12}{'fixed':<10}{n_fixed:>10}{t_fixed:>12.2f}")
+    print(f"{tr_name:<12}{'adaptive':<10}{n_adapt:>10}{t_adapt:>12.2f}"
+          f"{max_abs_diff:>22.2f}{rel_diff_max:>20.4f}")
+    print(f"{tr_name:<12}{'ratio':<10}{n_adapt / n_fixed:>10.2f}"
+          f"{t_adapt / t_fixed:>12.2f}")
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the batched H1980 wind field kernel against
+TropCyclone.from_tracks on the demo data.
+Output: wall time of both and the difference in the wind field for each storm.
+
+@author: Pui Man (Mannie) Kam
+"""
+import sys
+import time
+import numpy as np
+from pathlib import Path
+import warnings
+warnings.filterwarnings("ignore")
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from climada.hazard import TropCyclone
+from climada_petals.hazard import TCForecast
+from climada.util.api_client import Client
+
+from tc_tracks_func import (
+    filter_storm, _correct_max_sustained_wind_speed, adaptive_timestep
+)
+from windfield_func import ensemble_windfield_h1980, DEG_BUFFER
+
+client = Client()
+
+BUFR_TRACKS_FOLDER = "./demo/data/20240825000000"
+
+# tolerance of the wind speed difference, in m/s
+TOLERANCE_MS = .1
+
+glob_centroids = client.get_centroids()
+
+tr_fcast = TCForecast()
+tr_fcast.fetch_ecmwf(path=BUFR_TRACKS_FOLDER)
+tr_filter = filter_storm(tr_fcast)
+_correct_max_sustained_wind_speed(tr_filter)
+adaptive_timestep(tr_filter)
+
+print(f"{'storm':<12}{'members':>8}{'from_tracks (s)':>17}{'batched (s)':>13}"
+      f"{'speed-up':>10}{'max abs diff (m/s)':>22}{'within tol.':>13}")
+
+for tr_name in sorted(set([tr.name for tr in tr_filter.data])):
+    tr_one_storm = tr_filter.subset({'name': tr_name})
+    centroids_refine = glob_centroids.select(extent=tr_one_storm.get_extent(deg_buffer=DEG_BUFFER))
+
+    time_start = time.time()
+    tc_wind_ref = TropCyclone.from_tracks(tr_one_storm, centroids_refine, model="H1980")
+    t_ref = time.time() - time_start
+
+    time_start = time.time()
+    tc_wind_batched = ensemble_windfield_h1980(tr_one_storm, centroids_refine)
+    t_batched = time.time() - time_start
+
+    max_abs_diff = abs(tc_wind_ref.intensity - tc_wind_batched.intensity).max()
+
+    print(f"{tr_name:<12}{len(tr_one_storm.data):>8}{t_ref:>17.2f}{t_batched:>13.2f}"
+          f"{t_ref / t_batched:>10.1f}{max_abs_diff:>22.3f}"
+          f"{str(max_abs_diff <= TOLERANCE_MS):>13}")
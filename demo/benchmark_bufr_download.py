@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the concurrent BUFR download on the demo data.
+Serves demo/data with the local stand-in server, with and without injected
+failures (503 responses and transfers cut in the middle), and downloads the
+run 20240825000000 sequentially and concurrently.
+Output: time, retries and throughput of each configuration, and whether the
+        downloaded files are identical to the served ones.
+
+@author: Pui Man (Mannie) Kam
+"""
+import os
+import sys
+import filecmp
+import tempfile
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from download_func import start_stand_in_server, fetch_latest_run
+
+DEMO_DATA_DIR = "./demo/data"
+RUN_FOLDER = "20240825000000"
+
+FAILURE_RATES = [0., .2]
+N_WORKERS = [1, 8]
+
+# delay of each transfer, as a stand-in for the latency of the dissemination server
+STALL_S = .05
+
+results = []
+for failure_rate in FAILURE_RATES:
+    server, base_url = start_stand_in_server(DEMO_DATA_DIR, failure_rate=failure_rate,
+                                             stall_s=STALL_S, seed=0)
+    for n_workers in N_WORKERS:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            run_dir, _ = fetch_latest_run(cache_dir, pd.Timestamp(RUN_FOLDER).to_datetime64(),
+                                          base_url, n_workers, backoff_s=.05)
+            time_start = pd.Timestamp.now()
+            # second call: everything from the cache
+            fetch_latest_run(cache_dir, pd.Timestamp(RUN_FOLDER).to_datetime64(),
+                             base_url, n_workers)
+            cached_s = (pd.Timestamp.now() - time_start).total_seconds()
+
+            served_dir = os.path.join(DEMO_DATA_DIR, RUN_FOLDER)
+            identical = all(filecmp.cmp(os.path.join(run_dir, file_name),
+                                        os.path.join(served_dir, file_name), shallow=False)
+                            for file_name in os.listdir(served_dir))
+            results.append({'failure_rate': failure_rate, 'n_workers': n_workers,
+                            'n_files': len(os.listdir(run_dir)), 'identical': identical,
+                            'cached_run_s': cached_s})
+    server.shutdown()
+
+print(pd.DataFrame(results).to_string(index=False))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the cached impact function sets and of the tabulated
+evaluation of the impact functions against the direct evaluation.
+Output: time to build the displacement impact function sets of all countries
+        with and without cache, and time and maximum difference of the mean
+        damage ratio on the intensities of a large synthetic hazard.
+
+@author: Pui Man (Mannie) Kam
+"""
+import sys
+import time
+import numpy as np
+from pathlib import Path
+import warnings
+warnings.filterwarnings("ignore")
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from climada.entity import ImpfTropCyclone
+
+from impact_calc_func import (
+    iso3_to_basin, iso3_to_basin_reverse, v_half_per_region,
+    impf_set_displacement, impf_set_displacement_basin, _impf_emanuel,
+    tabulate_impf_set
+)
+
+# number of non-zero intensities of the synthetic hazard (51 members x ~1e6 centroids)
+N_INTENSITIES = 50_000_000
+
+countries = list(iso3_to_basin_reverse)
+
+# impact function sets of all countries: rebuilt per country vs cached per region
+time_start = time.time()
+for country in countries:
+    basin = [key for key, list_of_values in iso3_to_basin.items() if country in list_of_values]
+    ImpfTropCyclone.from_emanuel_usa(v_half=v_half_per_region[basin[0]])
+t_direct = time.time() - time_start
+
+impf_set_displacement_basin.cache_clear()
+_impf_emanuel.cache_clear()
+time_start = time.time()
+for country in countries:
+    impf_set_displacement(country)
+t_cached = time.time() - time_start
+
+print(f"impact function sets of {len(countries)} countries: "
+      f"rebuilt {t_direct:.3f} s, cached {t_cached:.3f} s")
+
+# mean damage ratio of the intensities of a large hazard
+intensity = np.random.default_rng(0).uniform(17.5, 90., N_INTENSITIES)
+print(f"{'region':<8}{'direct (s)':>12}{'tabulated (s)':>15}{'speed-up':>10}{'max abs diff':>15}")
+for basin in v_half_per_region:
+    impf = impf_set_displacement_basin(basin).get_func(haz_type="TC")[0]
+    impf_tab = tabulate_impf_set(impf_set_displacement_basin(basin)).get_func(haz_type="TC")[0]
+
+    time_start = time.time()
+    mdr = impf.calc_mdr(intensity)
+    t_direct = time.time() - time_start
+
+    time_start = time.time()
+    mdr_tab = impf_tab.calc_mdr(intensity)
+    t_tab = time.time() - time_start
+
+    print(f"{basin:<8}{t_direct:>12.2f}{t_tab:>15.2f}{t_direct / t_tab:>10.1f}"
+          f"{np.abs(mdr - mdr_tab).max():>15.2e}")
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the quantized intensity codecs on the demo data.
+Output: size and read time of the tc_wind HDF5 file of each storm per codec,
+        and the difference of the impact per ensemble member (at_event)
+        computed on the quantized intensity with the lookup tables
+        (calc_impact_quantized) against ImpactCalc on the float intensity.
+
+@author: Pui Man (Mannie) Kam
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import warnings
+warnings.filterwarnings("ignore")
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from climada.engine import ImpactCalc
+from climada_petals.hazard import TCForecast
+from climada.util.api_client import Client
+from climada.util.coordinates import get_country_code, country_to_iso
+
+from tc_tracks_func import (
+    filter_storm, _correct_max_sustained_wind_speed, adaptive_timestep
+)
+from windfield_func import compute_storm_windfield, N_ENSEMBLE
+from codec_func import write_hazard, read_hazard, read_hazard_quantized, INTENSITY_CODECS
+from impact_calc_func import (
+    impf_set_exposed_pop, impf_set_displacement, calc_impact_quantized
+)
+
+client = Client()
+
+BUFR_TRACKS_FOLDER = "./demo/data/20240825000000"
+
+EXPOSED_TO_WIND_THRESHOLD = 32.92 # threshold for people exposed to wind in m/s
+
+CODECS = [None, 'scaleoffset', 'uint16', 'uint8']
+
+glob_centroids = client.get_centroids()
+
+tr_fcast = TCForecast()
+tr_fcast.fetch_ecmwf(path=BUFR_TRACKS_FOLDER)
+tr_filter = filter_storm(tr_fcast)
+_correct_max_sustained_wind_speed(tr_filter)
+adaptive_timestep(tr_filter)
+
+file_report = []
+impact_report = []
+with tempfile.TemporaryDirectory() as tmp_dir:
+    for tr_name in sorted(set([tr.name for tr in tr_filter.data])):
+        tr_one_storm = tr_filter.subset({'name': tr_name})
+        tc_wind = compute_storm_windfield(tr_one_storm, glob_centroids, N_ENSEMBLE, batched=True)
+
+        tc_files = {}
+        for codec in CODECS:
+            tc_files[codec] = os.path.join(tmp_dir, f"tc_wind_{tr_name}_{codec}.hdf5")
+            write_hazard(tc_wind, tc_files[codec], codec)
+            time_start = time.time()
+            read_hazard(tc_files[codec])
+            file_report.append({
+                "storm": tr_name, "codec": str(codec),
+                "file_MB": os.path.getsize(tc_files[codec]) / 1e6,
+                "read_s": time.time() - time_start,
+            })
+        for report in file_report[-len(CODECS):]:
+            report["shrink"] = file_report[-len(CODECS)]["file_MB"] / report["file_MB"]
+
+        idx_non_zero_wind = tc_wind.intensity.max(axis=0).nonzero()[1]
+        country_codes = np.trim_zeros(np.unique(get_country_code(
+            tc_wind.centroids.lat[idx_non_zero_wind],
+            tc_wind.centroids.lon[idx_non_zero_wind])))
+
+        for country_code in country_codes:
+            country_iso3 = country_to_iso(country_code, "alpha3")
+            try:
+                exp = client.get_exposures(
+                    exposures_type='litpop',
+                    properties={'country_iso3num': [str(country_code).zfill(3)],
+                                'exponents': '(0,1)',
+                                'fin_mode': 'pop',
+                                'version': 'v2'})
+            except client.NoResult:
+                continue
+            exp.assign_centroids(tc_wind)
+
+            for impact_type, impf_set in [("exposed_population", impf_set_exposed_pop(EXPOSED_TO_WIND_THRESHOLD)),
+                                          ("displacement", impf_set_displacement(country_iso3))]:
+                exp.gdf['impf_TC'] = impf_set.get_ids("TC")[0]
+                time_start = time.time()
+                at_event_ref = ImpactCalc(exp, impf_set, tc_wind).impact(
+                    save_mat=True, assign_centroids=False).at_event
+                t_ref = time.time() - time_start
+
+                for codec in [codec for codec in CODECS if codec in INTENSITY_CODECS]:
+                    tc_codes, scale, offset = read_hazard_quantized(tc_files[codec])
+                    time_start = time.time()
+                    at_event = calc_impact_quantized(exp, impf_set, tc_codes, scale, offset).at_event
+                    t_lut = time.time() - time_start
+                    impact_report.append({
+                        "storm": tr_name, "country": country_iso3,
+                        "impact_type": impact_type, "codec": codec,
+                        "mean_at_event": at_event_ref.mean(),
+                        "max_rel_diff": (np.abs(at_event - at_event_ref)
+                                         / np.fmax(at_event_ref, 1)).max(),
+                        "ImpactCalc_s": t_ref, "lookup_s": t_lut,
+                    })
+
+print("tc_wind files")
+print(pd.DataFrame(file_report).to_string(index=False))
+print()
+print("Impact on the quantized intensity (lookup tables) vs ImpactCalc on floats")
+print(pd.DataFrame(impact_report).to_string(index=False))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sweep of the displacement impact function parameter v_half on the demo data.
+Output: time of a sweep over 1000 v_half values per storm and country, and
+        the difference to ImpactCalc for a few of the values.
+
+@author: Pui Man (Mannie) Kam
+"""
+import sys
+import time
+import numpy as np
+from pathlib import Path
+import warnings
+warnings.filterwarnings("ignore")
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from climada.engine import ImpactCalc
+from climada.entity import ImpfTropCyclone, ImpactFuncSet
+from climada_petals.hazard import TCForecast
+from climada.util.api_client import Client
+from climada.util.coordinates import get_country_code, country_to_iso
+
+from tc_tracks_func import (
+    filter_storm, _correct_max_sustained_wind_speed, adaptive_timestep
+)
+from windfield_func import compute_storm_windfield, N_ENSEMBLE
+from calibration_func import displacement_v_half_sweep
+
+client = Client()
+
+BUFR_TRACKS_FOLDER = "./demo/data/20240825000000"
+
+V_HALF_VALUES = np.linspace(30., 100., 1000)
+V_HALF_CHECK = V_HALF_VALUES[::250]
+
+glob_centroids = client.get_centroids()
+
+tr_fcast = TCForecast()
+tr_fcast.fetch_ecmwf(path=BUFR_TRACKS_FOLDER)
+tr_filter = filter_storm(tr_fcast)
+_correct_max_sustained_wind_speed(tr_filter)
+adaptive_timestep(tr_filter)
+
+print(f"{'storm':<12}{'country':<9}{'sweep (s)':>11}{'ImpactCalc per value (s)':>26}"
+      f"{'max rel diff':>14}")
+
+for tr_name in sorted(set([tr.name for tr in tr_filter.data])):
+    tc_haz = compute_storm_windfield(tr_filter.subset({'name': tr_name}), glob_centroids,
+                                     N_ENSEMBLE, batched=True)
+
+    idx_non_zero_wind = tc_haz.intensity.max(axis=0).nonzero()[1]
+    country_codes = np.trim_zeros(np.unique(get_country_code(
+        tc_haz.centroids.lat[idx_non_zero_wind], tc_haz.centroids.lon[idx_non_zero_wind])))
+
+    for country_code in country_codes:
+        try:
+            exp = client.get_exposures(
+                exposures_type='litpop',
+                properties={'country_iso3num': [str(country_code).zfill(3)],
+                            'exponents': '(0,1)',
+                            'fin_mode': 'pop',
+                            'version': 'v2'})
+        except client.NoResult:
+            continue
+        exp.assign_centroids(tc_haz)
+        exp.gdf['impf_TC'] = 1
+
+        time_start = time.time()
+        displacement = displacement_v_half_sweep(exp, tc_haz, V_HALF_VALUES)
+        t_sweep = time.time() - time_start
+
+        max_rel_diff = 0.
+        time_start = time.time()
+        for v_half in V_HALF_CHECK:
+            impf_set = ImpactFuncSet([ImpfTropCyclone.from_emanuel_usa(v_half=v_half)])
+            at_event = ImpactCalc(exp, impf_set, tc_haz).impact(assign_centroids=False).at_event
+            max_rel_diff = max(max_rel_diff, (np.abs(
+                displacement[V_HALF_VALUES == v_half][0] - at_event) / np.fmax(at_event, 1)).max())
+        t_impact_calc = (time.time() - time_start) / V_HALF_CHECK.size
+
+        print(f"{tr_name:<12}{country_to_iso(country_code, 'alpha3'):<9}{t_sweep:>11.2f}"
+              f"{t_impact_calc:>26.2f}{max_rel_diff:>14.2e}")
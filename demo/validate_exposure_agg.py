@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Validation of the impacts on the pre-aggregated exposures against the
+point-level LitPop exposures on the demo data.
+Output: number of exposure points, impact computation time and the maximum
+        relative difference of the impact per ensemble member for each
+        storm, country and impact type.
+
+@author: Pui Man (Mannie) Kam
+"""
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import warnings
+warnings.filterwarnings("ignore")
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from climada_petals.hazard import TCForecast
+from climada.util.api_client import Client
+from climada.util.coordinates import get_country_code, country_to_iso
+
+from tc_tracks_func import (
+    filter_storm, _correct_max_sustained_wind_speed, adaptive_timestep
+)
+from windfield_func import compute_storm_windfield, N_ENSEMBLE
+from impact_calc_func import calc_country_impacts_batched
+from exposure_agg_func import get_exposure_agg, exposure_agg_on_hazard
+
+client = Client()
+
+BUFR_TRACKS_FOLDER = "./demo/data/20240825000000"
+
+EXPOSED_TO_WIND_THRESHOLD = 32.92 # threshold for people exposed to wind in m/s
+
+glob_centroids = client.get_centroids()
+
+tr_fcast = TCForecast()
+tr_fcast.fetch_ecmwf(path=BUFR_TRACKS_FOLDER)
+tr_filter = filter_storm(tr_fcast)
+_correct_max_sustained_wind_speed(tr_filter)
+adaptive_timestep(tr_filter)
+
+report = []
+with tempfile.TemporaryDirectory() as agg_dir:
+    for tr_name in sorted(set([tr.name for tr in tr_filter.data])):
+        tc_haz = compute_storm_windfield(tr_filter.subset({'name': tr_name}), glob_centroids,
+                                         N_ENSEMBLE, batched=True)
+        idx_non_zero_wind = tc_haz.intensity.max(axis=0).nonzero()[1]
+        country_codes = np.trim_zeros(np.unique(get_country_code(
+            tc_haz.centroids.lat[idx_non_zero_wind], tc_haz.centroids.lon[idx_non_zero_wind])))
+
+        for country_code in country_codes:
+            country_iso3 = country_to_iso(country_code, "alpha3")
+            try:
+                exp_points = client.get_exposures(
+                    exposures_type='litpop',
+                    properties={'country_iso3num': [str(country_code).zfill(3)],
+                                'exponents': '(0,1)',
+                                'fin_mode': 'pop',
+                                'version': 'v2'})
+            except client.NoResult:
+                continue
+            exp_agg, value_unit = get_exposure_agg(client, country_code, country_iso3, agg_dir)
+            exp_centroids = exposure_agg_on_hazard(exp_agg, value_unit, tc_haz)
+
+            impacts, times = {}, {}
+            for mode, exp in [('points', exp_points), ('centroids', exp_centroids)]:
+                time_start = time.time()
+                impacts[mode] = calc_country_impacts_batched(
+                    {country_code: exp}, tc_haz, EXPOSED_TO_WIND_THRESHOLD)[country_code]
+                times[mode] = time.time() - time_start
+
+            for impact_type, impact in impacts['points'].items():
+                at_event_agg = impacts['centroids'][impact_type].at_event
+                report.append({
+                    "storm": tr_name, "country": country_iso3, "impact_type": impact_type,
+                    "n_points": exp_points.gdf.shape[0], "n_centroids": exp_centroids.gdf.shape[0],
+                    "points_s": times['points'], "centroids_s": times['centroids'],
+                    "max_rel_diff": (np.abs(at_event_agg - impact.at_event)
+                                     / np.fmax(impact.at_event, 1)).max(),
+                })
+
+print(pd.DataFrame(report).to_string(index=False))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Validation of the float32 mode against float64 on the demo data.
+Output: size of the intensity matrix and of the HDF5 file of each storm, and
+        the maximum absolute and relative differences in the forecast summaries
+        of each storm, country and impact type.
+
+@author: Pui Man (Mannie) Kam
+"""
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import warnings
+warnings.filterwarnings("ignore")
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from climada.hazard import Hazard
+from climada_petals.hazard import TCForecast
+from climada.util.api_client import Client
+from climada.util.coordinates import get_country_code, country_to_iso
+
+from tc_tracks_func import (
+    filter_storm, _correct_max_sustained_wind_speed, adaptive_timestep
+)
+from windfield_func import compute_storm_windfield, N_ENSEMBLE
+from impact_calc_func import calc_country_impacts, summarize_forecast
+
+client = Client()
+
+BUFR_TRACKS_FOLDER = "./demo/data/20240825000000"
+
+EXPOSED_TO_WIND_THRESHOLD = 32.92 # threshold for people exposed to wind in m/s
+
+SUMMARY_STATS = ["mean", "median", "05perc", "25perc", "75perc", "95perc"]
+
+DTYPES = {'float64': np.float64, 'float32': np.float32}
+
+glob_centroids = client.get_centroids()
+
+tr_fcast = TCForecast()
+tr_fcast.fetch_ecmwf(path=BUFR_TRACKS_FOLDER)
+tr_filter = filter_storm(tr_fcast)
+_correct_max_sustained_wind_speed(tr_filter)
+adaptive_timestep(tr_filter)
+
+hazard_report = []
+summary_report = []
+with tempfile.TemporaryDirectory() as tmp_dir:
+    for tr_name in sorted(set([tr.name for tr in tr_filter.data])):
+        tr_one_storm = tr_filter.subset({'name': tr_name})
+
+        # wind field, written and read back in both precisions
+        tc_haz = {}
+        for dtype_name, dtype in DTYPES.items():
+            tc_wind = compute_storm_windfield(tr_one_storm, glob_centroids, N_ENSEMBLE,
+                                              batched=True, dtype=dtype)
+            tc_file = os.path.join(tmp_dir, f"tc_wind_{tr_name}_{dtype_name}.hdf5")
+            tc_wind.write_hdf5(tc_file)
+            tc_haz[dtype_name] = Hazard.from_hdf5(tc_file)
+            intensity = tc_haz[dtype_name].intensity
+            hazard_report.append({
+                "storm": tr_name, "dtype": dtype_name,
+                "intensity_MB": (intensity.data.nbytes + intensity.indices.nbytes
+                                 + intensity.indptr.nbytes) / 1e6,
+                "file_MB": os.path.getsize(tc_file) / 1e6,
+            })
+        hazard_report[-1]["max_abs_diff_wind"] = abs(
+            tc_haz['float64'].intensity - tc_haz['float32'].intensity.astype(np.float64)).max()
+
+        # impacts in all countries with wind
+        idx_non_zero_wind = tc_haz['float64'].intensity.max(axis=0).nonzero()[1]
+        country_codes = np.trim_zeros(np.unique(get_country_code(
+            tc_haz['float64'].centroids.lat[idx_non_zero_wind],
+            tc_haz['float64'].centroids.lon[idx_non_zero_wind])))
+
+        for country_code in country_codes:
+            country_iso3 = country_to_iso(country_code, "alpha3")
+            summaries = {}
+            for dtype_name, dtype in DTYPES.items():
+                try:
+                    exp = client.get_exposures(
+                        exposures_type='litpop',
+                        properties={'country_iso3num': [str(country_code).zfill(3)],
+                                    'exponents': '(0,1)',
+                                    'fin_mode': 'pop',
+                                    'version': 'v2'})
+                except client.NoResult:
+                    break
+                impacts = calc_country_impacts(exp, country_iso3, tc_haz[dtype_name],
+                                               EXPOSED_TO_WIND_THRESHOLD, dtype)
+                summaries[dtype_name] = {
+                    impact_type: summarize_forecast(country_iso3, "", impact_type,
+                                                    tc_haz[dtype_name], tr_name, impact)
+                    for impact_type, impact in impacts.items()
+                }
+            if len(summaries) < len(DTYPES):
+                continue
+
+            for impact_type, summary_64 in summaries['float64'].items():
+                summary_32 = summaries['float32'][impact_type]
+                abs_diff = np.array([abs(summary_32[stat] - summary_64[stat])
+                                     for stat in SUMMARY_STATS])
+                ref = np.array([abs(summary_64[stat]) for stat in SUMMARY_STATS])
+                summary_report.append({
+                    "storm": tr_name, "country": country_iso3, "impact_type": impact_type,
+                    "mean_float64": summary_64["mean"],
+                    "max_abs_diff": abs_diff.max(),
+                    "max_rel_diff": (abs_diff / np.fmax(ref, 1)).max(),
+                })
+
+print("Hazard intensity")
+print(pd.DataFrame(hazard_report).to_string(index=False))
+print()
+print("Forecast summaries (float32 vs float64)")
+print(pd.DataFrame(summary_report).to_string(index=False))
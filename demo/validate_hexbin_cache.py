@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Validation of the cached hexbin of the impact maps against binning all the
+reprojected exposure points, as before, on the demo data.
+Output: number of exposure points and hexagons, binning time of both ways
+        and the maximum difference of the hexagon values for each storm,
+        country and impact type.
+
+@author: Pui Man (Mannie) Kam
+"""
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from pathlib import Path
+import warnings
+warnings.filterwarnings("ignore")
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from climada_petals.hazard import TCForecast
+from climada.util.api_client import Client
+from climada.util.coordinates import get_country_code, country_to_iso
+
+from tc_tracks_func import (
+    filter_storm, _correct_max_sustained_wind_speed, adaptive_timestep
+)
+from windfield_func import compute_storm_windfield, N_ENSEMBLE
+from impact_calc_func import calc_country_impacts_batched
+from exposure_agg_func import get_exposure_agg, exposure_agg_on_hazard
+from hexbin_func import get_country_hexbin, hexbin_values, HEXBIN_GRIDSIZE
+
+client = Client()
+
+BUFR_TRACKS_FOLDER = "./demo/data/20240825000000"
+
+EXPOSED_TO_WIND_THRESHOLD = 32.92 # threshold for people exposed to wind in m/s
+
+def hexbin_all_points(impact):
+    """Hexagon values of the maps before the cache: reproject and bin all points."""
+    impact_exp = impact._build_exp()
+    extent = impact_exp.gdf.geometry.to_crs(epsg=3857).total_bounds
+    impact_exp.to_crs("EPSG:3857", inplace=True)
+    gdf = impact_exp.gdf
+    fig, ax = plt.subplots()
+    hb = ax.hexbin(x=gdf.geometry.x, y=gdf.geometry.y, C=gdf["value"],
+                   reduce_C_function=np.sum, gridsize=HEXBIN_GRIDSIZE,
+                   extent=(extent[0], extent[2], extent[1], extent[3]))
+    plt.close(fig)
+    return hb.get_offsets(), hb.get_array()
+
+def hexbin_cached(impact, country_iso3, hexbin_dir):
+    """Hexagon values of the maps with the cached hexbin."""
+    hexbin = get_country_hexbin(impact.coord_exp, country_iso3, hexbin_dir)
+    fig, ax = plt.subplots()
+    hb = ax.hexbin(x=hexbin["cell_x"], y=hexbin["cell_y"], C=hexbin_values(hexbin, impact.eai_exp),
+                   reduce_C_function=np.sum, gridsize=hexbin["gridsize"],
+                   extent=tuple(hexbin["extent"]))
+    plt.close(fig)
+    return hb.get_offsets(), hb.get_array()
+
+glob_centroids = client.get_centroids()
+
+tr_fcast = TCForecast()
+tr_fcast.fetch_ecmwf(path=BUFR_TRACKS_FOLDER)
+tr_filter = filter_storm(tr_fcast)
+_correct_max_sustained_wind_speed(tr_filter)
+adaptive_timestep(tr_filter)
+
+report = []
+with tempfile.TemporaryDirectory() as agg_dir:
+    for tr_name in sorted(set([tr.name for tr in tr_filter.data])):
+        tc_haz = compute_storm_windfield(tr_filter.subset({'name': tr_name}), glob_centroids,
+                                         N_ENSEMBLE, batched=True)
+        idx_non_zero_wind = tc_haz.intensity.max(axis=0).nonzero()[1]
+        country_codes = np.trim_zeros(np.unique(get_country_code(
+            tc_haz.centroids.lat[idx_non_zero_wind], tc_haz.centroids.lon[idx_non_zero_wind])))
+
+        for country_code in country_codes:
+            country_iso3 = country_to_iso(country_code, "alpha3")
+            try:
+                exp_agg, value_unit = get_exposure_agg(client, country_code, country_iso3, agg_dir)
+            except client.NoResult:
+                continue
+            impacts = calc_country_impacts_batched(
+                {country_code: exposure_agg_on_hazard(exp_agg, value_unit, tc_haz)},
+                tc_haz, EXPOSED_TO_WIND_THRESHOLD)[country_code]
+
+            for impact_type, impact in impacts.items():
+                time_start = time.time()
+                offsets_all, values_all = hexbin_all_points(impact)
+                time_all = time.time() - time_start
+
+                time_start = time.time()
+                offsets_cached, values_cached = hexbin_cached(impact, country_iso3, agg_dir)
+                time_cached = time.time() - time_start
+
+                # hexagons without points are masked in both
+                same_cells = np.array_equal(np.ma.getmaskarray(values_all),
+                                            np.ma.getmaskarray(values_cached))
+                report.append({
+                    'storm': tr_name, 'country': country_iso3, 'impact_type': impact_type,
+                    'n_points': impact.coord_exp.shape[0],
+                    'n_hexagons': int(np.ma.count(values_all)),
+                    'same_hexagons': same_cells,
+                    'max_abs_diff': float(np.ma.max(np.ma.abs(values_all - values_cached))),
+                    'time_all_points_s': time_all, 'time_cached_s': time_cached,
+                })
+
+print(pd.DataFrame(report).to_string(index=False))
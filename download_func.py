@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Concurrent download of the ECMWF BUFR track files of a forecast run.
+
+The files of a run are fetched from a thread pool with bounded parallelism,
+so a slow or stalled transfer no longer holds up the other storms. Failed
+transfers are retried with exponential backoff and resumed from the partial
+file with an HTTP Range request. The files are kept in a local cache with
+one folder per run (named like the ECMWF run folders, e.g. 20240825000000),
+which is passed to TCForecast.fetch_ecmwf(path=...), so that a rerun of the
+same run does not download anything.
+
+start_stand_in_server serves a local folder of runs (e.g. demo/data) over
+HTTP, with Range support and optional injected failures, to test the
+throughput and the failure handling offline.
+
+@author: Pui Man (Mannie) Kam
+"""
+import os
+import re
+import time
+import random
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+from typing import Union, List, Tuple
+from pathlib import Path
+
+# run folders of the ECMWF dissemination, e.g. https://essential.ecmwf.int/file/20240825000000/
+ECMWF_BUFR_URL = "https://essential.ecmwf.int/file/{run_time}/"
+
+# BUFR files of the ensemble and deterministic tracks
+TRACK_FILE_PATTERN = r'[^"/<>]*tropical_cyclone_track[^"/<>]*bufr4\.bin'
+
+DOWNLOAD_WORKERS = 8
+MAX_RETRIES = 5
+BACKOFF_S = 1.
+TIMEOUT_S = 30.
+CHUNK_BYTES = 1 << 16
+
+PART_SUFFIX = '.part'
+
+# HTTP status codes worth a retry
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+def format_run_folder(run_datetime: np.datetime64) -> str:
+    """Run folder name of a forecast run, e.g. 20240825000000"""
+    return np.datetime64(run_datetime, 's').astype(str).replace('-', '').replace(
+        'T', '').replace(':', '')
+
+def list_run_files(run_url: str, pattern: str = TRACK_FILE_PATTERN,
+                   timeout_s: float = TIMEOUT_S) -> List[str]:
+    """
+    File names of the track files listed in the index page of a run folder.
+    An empty list if the run is not (yet) published.
+    """
+    try:
+        with urllib.request.urlopen(run_url, timeout=timeout_s) as response:
+            index = response.read().decode(errors='replace')
+    except urllib.error.HTTPError as err:
+        if err.code == 404:
+            return []
+        raise
+
+    file_names = {urllib.parse.unquote(os.path.basename(name))
+                  for name in re.findall(pattern, index)}
+    return sorted(file_names)
+
+def download_file(url: str, target_file: Union[str, Path],
+                  max_retries: int = MAX_RETRIES,
+                  backoff_s: float = BACKOFF_S,
+                  timeout_s: float = TIMEOUT_S) -> dict:
+    """
+    Download a file, retrying with exponential backoff and resuming from the
+    partial file (target_file + '.part') after a failure. The file appears
+    under target_file only once complete. Raises the last error if the
+    transfer still fails after max_retries retries.
+
+    Returns
+    -------
+    stats : dict
+        Bytes transferred and number of retries.
+    """
+    target_file = str(target_file)
+    part_file = target_file + PART_SUFFIX
+    stats = {'bytes': 0, 'retries': 0}
+
+    for attempt in range(max_retries + 1):
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header('Range', f'bytes={offset}-')
+        try:
+            with urllib.request.urlopen(request, timeout=timeout_s) as response:
+                if response.status != 206:  # the server ignored the range
+                    offset = 0
+                length = response.headers.get('Content-Length')
+                expected = None if length is None else offset + int(length)
+                with open(part_file, 'ab' if offset else 'wb') as f:
+                    while chunk := response.read(CHUNK_BYTES):
+                        f.write(chunk)
+                        stats['bytes'] += len(chunk)
+            if expected is not None and os.path.getsize(part_file) != expected:
+                raise ConnectionError(f"incomplete transfer of {url}")
+            os.replace(part_file, target_file)
+            return stats
+
+        except urllib.error.HTTPError as err:
+            if err.code == 416:  # stale partial file
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+            elif err.code not in RETRY_STATUS:
+                raise
+            if attempt == max_retries:
+                raise
+        except (urllib.error.URLError, ConnectionError, TimeoutError, OSError):
+            if attempt == max_retries:
+                raise
+
+        stats['retries'] += 1
+        time.sleep(backoff_s * 2 ** attempt * random.uniform(.5, 1.5))
+
+def fetch_run(run_url: str, run_dir: Union[str, Path],
+              n_workers: int = DOWNLOAD_WORKERS,
+              pattern: str = TRACK_FILE_PATTERN,
+              **kwargs) -> Tuple[List[str], dict]:
+    """
+    Download the track files of a run concurrently into run_dir, skipping the
+    files already in the cache.
+
+    Parameters
+    ----------
+    run_url : str
+        URL of the run folder, ending with '/'.
+    run_dir : Union[str, Path]
+        Local cache folder of the run.
+    n_workers : int
+        Maximum number of concurrent transfers. Default: 8
+    kwargs :
+        Passed to download_file (max_retries, backoff_s, timeout_s).
+
+    Returns
+    -------
+    files : List[str]
+        Local files of the run, empty if the run is not published.
+    stats : dict
+        Number of files downloaded and cached, bytes, retries and seconds.
+    """
+    time_start = time.time()
+    file_names = list_run_files(run_url, pattern, kwargs.get('timeout_s', TIMEOUT_S))
+    if file_names:
+        os.makedirs(run_dir, exist_ok=True)
+    files = [os.path.join(run_dir, file_name) for file_name in file_names]
+
+    to_fetch = [(run_url + urllib.parse.quote(file_name), file)
+                for file_name, file in zip(file_names, files) if not os.path.exists(file)]
+    with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="bufr-download") as executor:
+        file_stats = list(executor.map(lambda args: download_file(*args, **kwargs), to_fetch))
+
+    stats = {'downloaded': len(to_fetch), 'cached': len(files) - len(to_fetch),
+             'bytes': sum(s['bytes'] for s in file_stats),
+             'retries': sum(s['retries'] for s in file_stats),
+             'seconds': time.time() - time_start}
+    return files, stats
+
+def fetch_latest_run(cache_dir: Union[str, Path],
+                     run_datetime: np.datetime64,
+                     base_url: str = ECMWF_BUFR_URL,
+                     n_workers: int = DOWNLOAD_WORKERS,
+                     **kwargs) -> Tuple[str, np.datetime64]:
+    """
+    Download the track files of a run into the cache (cache_dir/<run folder>),
+    or of the previous run if it is not published yet.
+
+    Returns
+    -------
+    run_dir : str
+        Local folder of the run, to pass to TCForecast.fetch_ecmwf(path=...).
+        None if neither run is published.
+    run_datetime : np.datetime64
+        Run datetime of the downloaded files.
+    """
+    for run in [np.datetime64(run_datetime, 's'),
+                np.datetime64(run_datetime, 's') - np.timedelta64(12, 'h')]:
+        run_folder = format_run_folder(run)
+        run_dir = os.path.join(cache_dir, run_folder)
+        files, stats = fetch_run(base_url.format(run_time=run_folder), run_dir, n_workers, **kwargs)
+        if files:
+            print(f"BUFR files of {run_folder}: {stats['downloaded']} downloaded, "
+                  f"{stats['cached']} cached, {stats['bytes'] / 1e6:.1f} MB, "
+                  f"{stats['retries']} retries in {stats['seconds']:.1f} s")
+            return run_dir, run
+
+    return None, None
+
+class _StandInHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler with single byte-range requests and injected
+    failures (503 responses and transfers cut in the middle).
+    """
+    failure_rate = 0.
+    stall_s = 0.
+    _rng = random.Random()
+    _lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _fails(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.failure_rate
+
+    def send_head(self):
+        self._remaining = None
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or not os.path.exists(path):
+            return super().send_head()
+
+        if self._fails():
+            self.send_error(503, "Injected failure")
+            return None
+
+        size = os.path.getsize(path)
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        start, end = 0, size - 1
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_error(416, "Range not satisfiable")
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self._remaining is None:  # directory listing
+            return super().copyfile(source, outputfile)
+
+        # cut the transfer in the middle
+        n_bytes = self._remaining // 2 if self._fails() else self._remaining
+        time.sleep(self.stall_s)
+        outputfile.write(source.read(n_bytes))
+        if n_bytes < self._remaining:
+            self.close_connection = True
+
+def start_stand_in_server(root_dir: Union[str, Path], port: int = 0,
+                          failure_rate: float = 0., stall_s: float = 0.,
+                          seed: int = None) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Serve a folder of runs (e.g. demo/data) over HTTP from a background
+    thread, as a stand-in for the ECMWF dissemination.
+
+    Parameters
+    ----------
+    root_dir : Union[str, Path]
+        Folder with one sub-folder per run.
+    port : int
+        Port to listen on. Default: 0 (any free port)
+    failure_rate : float
+        Probability of a 503 response, and of a transfer cut in the middle.
+        Default: 0
+    stall_s : float
+        Delay before each file transfer, in seconds. Default: 0
+    seed : int
+        Seed of the injected failures.
+
+    Returns
+    -------
+    server : http.server.ThreadingHTTPServer
+        Call server.shutdown() to stop it.
+    base_url : str
+        URL template of the run folders, see fetch_latest_run.
+    """
+    handler = type('StandInHandler', (_StandInHandler,),
+                   {'failure_rate': failure_rate, 'stall_s': stall_s,
+                    '_rng': random.Random(seed), '_lock': threading.Lock()})
+    server = ThreadingHTTPServer(('127.0.0.1', port),
+                                 partial(handler, directory=str(root_dir)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/{{run_time}}/"
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for probabilistic products of the ensemble forecast:
+probability of exceeding wind or impact thresholds and ensemble quantiles
+for each centroid or exposure point.
+
+All products are computed directly on the sparse (member x point) intensity
+or impact matrix, in one pass over its non-zero entries.
+
+@author: Pui Man (Mannie) Kam
+"""
+import numpy as np
+import pandas as pd
+from typing import Union, List
+from pathlib import Path
+from scipy import sparse
+
+from climada.hazard import Hazard
+from climada.engine import Impact
+
+from writer_func import AsyncWriter, write_bytes
+
+KN_TO_MS = 0.514444
+
+N_ENSEMBLE = 51
+
+# gale, storm and hurricane force winds
+WIND_THRESHOLDS_KT = [34, 50, 64]
+
+# number of people per exposure point
+IMPACT_THRESHOLDS = [1, 10, 100, 1000]
+
+QUANTILES = [.05, .25, .5, .75, .95]
+
+def exceedance_probability(mat: sparse.csr_matrix,
+                           thresholds: List[float],
+                           n_members: int = N_ENSEMBLE) -> np.ndarray:
+    """
+    Probability that the value at each point (column) reaches or exceeds each
+    threshold, across the ensemble members (rows). Members missing from the
+    matrix (less than n_members) count as not exceeding.
+
+    Parameters
+    ----------
+    mat : scipy.sparse.csr_matrix
+        Sparse matrix (member x point), e.g. hazard intensity or impact matrix.
+    thresholds : List[float]
+        Thresholds in the unit of the matrix.
+    n_members : int
+        Number of ensemble members. Default: 51
+
+    Returns
+    -------
+    prob : np.ndarray
+        Exceedance probability (threshold x point).
+    """
+    mat = sparse.csr_matrix(mat)
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+    n_thres, n_points = thresholds.size, mat.shape[1]
+
+    # number of thresholds reached by each non-zero entry
+    n_reached = np.searchsorted(thresholds, mat.data, side='right')
+    counts = np.bincount(n_reached * n_points + mat.indices,
+                         minlength=(n_thres + 1) * n_points).reshape(n_thres + 1, n_points)
+    # entries that reach threshold j also reach all thresholds below j
+    n_exceed = np.cumsum(counts[::-1], axis=0)[::-1][1:]
+
+    return n_exceed / n_members
+
+def ensemble_quantiles(mat: sparse.csr_matrix,
+                       quantiles: List[float],
+                       n_members: int = N_ENSEMBLE) -> np.ndarray:
+    """
+    Ensemble quantiles at each point (column) of a sparse non-negative matrix,
+    with the implicit zeros (and missing members) taken into account. Same
+    result as np.quantile (linear interpolation) on the dense matrix, without
+    ever building it.
+
+    Parameters
+    ----------
+    mat : scipy.sparse.csr_matrix
+        Sparse non-negative matrix (member x point).
+    quantiles : List[float]
+        Quantiles between 0 and 1.
+    n_members : int
+        Number of ensemble members. Default: 51
+
+    Returns
+    -------
+    quant : np.ndarray
+        Quantiles (quantile x point).
+    """
+    mat = sparse.csc_matrix(mat)
+    mat.eliminate_zeros()
+    if mat.data.size and mat.data.min() < 0:
+        raise ValueError("ensemble_quantiles requires a non-negative matrix.")
+
+    n_points = mat.shape[1]
+    col = np.repeat(np.arange(n_points), np.diff(mat.indptr))
+    # sort the non-zero values within each column
+    data_sorted = mat.data[np.lexsort((mat.data, col))]
+
+    # position of each quantile in the sorted column of length n_members,
+    # where the first n_members - n_nonzero values are zero
+    pos = np.asarray(quantiles, dtype=float)[:, None] * (n_members - 1)
+    idx_lo = np.floor(pos).astype(int)
+    idx_hi = np.minimum(idx_lo + 1, n_members - 1)
+    frac = pos - idx_lo
+
+    n_zeros = n_members - np.diff(mat.indptr)[None, :]
+
+    def _value_at(idx):
+        idx_nz = idx - n_zeros
+        is_nz = idx_nz >= 0
+        flat_idx = np.where(is_nz, mat.indptr[:-1][None, :] + idx_nz, 0)
+        return np.where(is_nz, data_sorted[flat_idx] if data_sorted.size else 0., 0.)
+
+    val_lo = _value_at(np.broadcast_to(idx_lo, (pos.shape[0], n_points)))
+    val_hi = _value_at(np.broadcast_to(idx_hi, (pos.shape[0], n_points)))
+
+    return val_lo + frac * (val_hi - val_lo)
+
+def wind_exceedance_products(tc_haz: Hazard,
+                             thresholds_kt: List[float] = WIND_THRESHOLDS_KT,
+                             quantiles: List[float] = QUANTILES) -> pd.DataFrame:
+    """
+    Probability of exceeding the wind thresholds and ensemble quantiles of the
+    wind speed for each centroid with wind in at least one member.
+
+    Parameters
+    ----------
+    tc_haz : climada.hazard.Hazard
+        Wind field of all ensemble members of a storm (in m/s).
+    thresholds_kt : List[float]
+        Wind speed thresholds in knots. Default: 34, 50 and 64 kt
+    quantiles : List[float]
+        Ensemble quantiles. Default: 5, 25, 50, 75 and 95%
+
+    Returns
+    -------
+    wind_prob_df : pd.DataFrame
+        One row per centroid with the columns lat, lon, prob_{threshold}kt
+        and wind_q{quantile}.
+    """
+    intensity = sparse.csr_matrix(tc_haz.intensity)
+    idx_wind = np.unique(intensity.indices)
+    intensity = intensity[:, idx_wind]
+
+    prob = exceedance_probability(intensity, np.asarray(thresholds_kt) * KN_TO_MS)
+    quant = ensemble_quantiles(intensity, quantiles)
+
+    wind_prob_df = pd.DataFrame({'lat': tc_haz.centroids.lat[idx_wind],
+                                 'lon': tc_haz.centroids.lon[idx_wind]})
+    for thres, prob_thres in zip(sorted(thresholds_kt), prob):
+        wind_prob_df[f'prob_{thres}kt'] = prob_thres
+    for q, quant_q in zip(quantiles, quant):
+        wind_prob_df[f'wind_q{int(round(q * 100)):02d}'] = quant_q
+
+    return wind_prob_df
+
+def impact_exceedance_products(impact: Impact,
+                               thresholds: List[float] = IMPACT_THRESHOLDS,
+                               quantiles: List[float] = QUANTILES) -> pd.DataFrame:
+    """
+    Probability of exceeding the impact thresholds and ensemble quantiles of the
+    impact for each exposure point with impact in at least one member.
+
+    Parameters
+    ----------
+    impact : climada.engine.Impact
+        Impact with the impact matrix (imp_mat) saved.
+    thresholds : List[float]
+        Impact thresholds (people per exposure point). Default: 1, 10, 100, 1000
+    quantiles : List[float]
+        Ensemble quantiles. Default: 5, 25, 50, 75 and 95%
+
+    Returns
+    -------
+    imp_prob_df : pd.DataFrame
+        One row per exposure point with the columns lat, lon, prob_{threshold}
+        and impact_q{quantile}.
+    """
+    imp_mat = sparse.csr_matrix(impact.imp_mat)
+    imp_mat.eliminate_zeros()
+    idx_imp = np.unique(imp_mat.indices)
+    imp_mat = imp_mat[:, idx_imp]
+
+    prob = exceedance_probability(imp_mat, thresholds)
+    quant = ensemble_quantiles(imp_mat, quantiles)
+
+    imp_prob_df = pd.DataFrame({'lat': impact.coord_exp[idx_imp, 0],
+                                'lon': impact.coord_exp[idx_imp, 1]})
+    for thres, prob_thres in zip(sorted(thresholds), prob):
+        imp_prob_df[f'prob_{thres}'] = prob_thres
+    for q, quant_q in zip(quantiles, quant):
+        imp_prob_df[f'impact_q{int(round(q * 100)):02d}'] = quant_q
+
+    return imp_prob_df
+
+def save_wind_exceedance(save_dir: Union[str, Path],
+                         tc_name: str,
+                         forecast_time: str,
+                         wind_prob_df: pd.DataFrame,
+                         writer: AsyncWriter = None):
+    """
+    Save the wind exceedance probabilities and quantiles into a CSV file.
+    Written in the background if an AsyncWriter is given.
+    """
+    save_file_name = f'wind-exceedance_TC_ECMWF_ens_{tc_name}_{forecast_time}.csv'
+    return write_bytes(save_dir +save_file_name, wind_prob_df.to_csv(index=False).encode(), writer)
+
+def save_impact_exceedance(save_dir: Union[str, Path],
+                           imp_summary_dict: dict,
+                           imp_prob_df: pd.DataFrame,
+                           writer: AsyncWriter = None):
+    """
+    Save the impact exceedance probabilities and quantiles into a CSV file.
+    Written in the background if an AsyncWriter is given.
+    """
+    save_file_name = (
+        f'impact-exceedance_TC_ECMWF_ens_{imp_summary_dict["eventName"]}_{imp_summary_dict["initializationTime"]}'
+        f'_{imp_summary_dict["countryISO3"]}_{imp_summary_dict["impactType"]}.csv'
+        )
+    return write_bytes(save_dir +save_file_name, imp_prob_df.to_csv(index=False).encode(), writer)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for the LitPop exposures pre-aggregated onto the global
+centroids of the wind field (client.get_centroids()).
+
+The population of each country is summed onto the centroid grid once and
+persisted, keyed by the global centroid index. The file name carries a
+checksum of the LitPop properties (version, exponents, financial mode), so
+a new LitPop release is aggregated afresh instead of reusing stale files.
+The storm hazards are
+computed on a subset of the same centroids, so the pre-aggregated
+exposures are joined to the hazard centroids by their exact coordinates,
+without any nearest-neighbour matching, and the impact is a sparse matrix
+(member x centroid) times the population per centroid.
+
+@author: Pui Man (Mannie) Kam
+"""
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from typing import Union
+from pathlib import Path
+
+from climada.hazard import Hazard, Centroids
+from climada.entity import Exposures
+from climada.util.coordinates import match_centroids
+
+from checkpoint_func import atomic_file
+
+EXPOSURE_AGG_FILE_NAME = "litpop-pop-agg_{version}-{checksum}_{country_iso3}.npz"
+
+# properties of the LitPop population exposures in the Data API
+LITPOP_PROPERTIES = {'exponents':'(0,1)',
+                     'fin_mode':'pop',
+                     'version':'v2'
+                     }
+
+_glob_centroids = {}
+
+def properties_checksum(properties: dict) -> str:
+    """Short checksum of the LitPop properties, independent of their order."""
+    return hashlib.sha1(json.dumps(properties, sort_keys=True).encode()).hexdigest()[:8]
+
+def make_exposure_agg_file_name(agg_dir: Union[str, Path], country_iso3: str,
+                                properties: dict = LITPOP_PROPERTIES):
+    """File of the pre-aggregated exposures of a country, for the given LitPop properties."""
+    return os.path.join(agg_dir, EXPOSURE_AGG_FILE_NAME.format(
+        version=properties.get('version', ''), checksum=properties_checksum(properties),
+        country_iso3=country_iso3))
+
+def aggregate_exposure_to_centroids(exp: Exposures, glob_centroids: Centroids) -> pd.DataFrame:
+    """
+    Sum the exposure values onto the nearest global centroids.
+
+    Returns
+    -------
+    exp_agg : pd.DataFrame
+        Columns centr_idx (index in the global centroids), lat, lon and
+        value, one row per centroid with exposure.
+    """
+    centr = match_centroids(exp.gdf, glob_centroids)
+    assigned = centr >= 0
+    totals = np.bincount(centr[assigned], weights=exp.gdf['value'].values[assigned],
+                         minlength=glob_centroids.size)
+    [centr_idx] = totals.nonzero()
+
+    return pd.DataFrame({'centr_idx': centr_idx,
+                         'lat': glob_centroids.lat[centr_idx],
+                         'lon': glob_centroids.lon[centr_idx],
+                         'value': totals[centr_idx]})
+
+def save_exposure_agg(agg_dir: Union[str, Path], country_iso3: str,
+                      exp_agg: pd.DataFrame, value_unit: str,
+                      properties: dict = LITPOP_PROPERTIES) -> None:
+    """
+    Save the pre-aggregated exposures of a country.
+    """
+    os.makedirs(agg_dir, exist_ok=True)
+    with atomic_file(make_exposure_agg_file_name(agg_dir, country_iso3, properties)) as tmp_file:
+        np.savez(tmp_file, value_unit=value_unit,
+                 **{col: exp_agg[col].values for col in exp_agg.columns})
+
+def load_exposure_agg(agg_dir: Union[str, Path], country_iso3: str,
+                      properties: dict = LITPOP_PROPERTIES):
+    """
+    Load the pre-aggregated exposures of a country.
+
+    Returns
+    -------
+    exp_agg : pd.DataFrame
+        See aggregate_exposure_to_centroids, None if not yet aggregated.
+    value_unit : str
+    """
+    agg_file = make_exposure_agg_file_name(agg_dir, country_iso3, properties)
+    if not os.path.exists(agg_file):
+        return None, None
+
+    with np.load(agg_file) as data:
+        exp_agg = pd.DataFrame({col: data[col] for col in ['centr_idx', 'lat', 'lon', 'value']})
+        return exp_agg, str(data['value_unit'])
+
+def load_population_points(agg_dir: Union[str, Path], properties: dict = LITPOP_PROPERTIES):
+    """
+    Population of all countries pre-aggregated so far for the given LitPop
+    properties, e.g. to rank the storms by their population nearby.
+
+    Returns
+    -------
+    lat, lon, value : np.ndarray
+        Coordinates and population of the centroids with exposure, empty if
+        nothing is aggregated yet.
+    """
+    exp_aggs = []
+    for agg_file in glob.glob(make_exposure_agg_file_name(agg_dir, '*', properties)):
+        with np.load(agg_file) as data:
+            exp_aggs.append((data['lat'], data['lon'], data['value']))
+    if not exp_aggs:
+        return np.empty(0), np.empty(0), np.empty(0)
+    return tuple(np.concatenate(arrays) for arrays in zip(*exp_aggs))
+
+def get_exposure_agg(client, country_code: int, country_iso3: str, agg_dir: Union[str, Path],
+                     properties: dict = LITPOP_PROPERTIES, exp: Exposures = None):
+    """
+    Pre-aggregated LitPop population of a country, aggregated and saved on
+    first use. Raises client.NoResult if the Data API has no exposures for
+    the country.
+
+    Parameters
+    ----------
+    client : climada.util.api_client.Client
+    country_code : int
+        Numeric ISO code of the country.
+    country_iso3 : str
+        Alpha-3 ISO code of the country.
+    agg_dir : str or Path
+        Directory of the pre-aggregated exposures.
+    properties : dict
+        LitPop properties in the Data API. Default: LITPOP_PROPERTIES
+    exp : climada.entity.Exposures
+        LitPop exposures of the country if already retrieved, to aggregate
+        them without retrieving them again. Default: None
+
+    Returns
+    -------
+    exp_agg : pd.DataFrame
+        See aggregate_exposure_to_centroids.
+    value_unit : str
+    """
+    exp_agg, value_unit = load_exposure_agg(agg_dir, country_iso3, properties)
+    if exp_agg is not None:
+        return exp_agg, value_unit
+
+    if exp is None:
+        exp = client.get_exposures(exposures_type='litpop',
+                                   properties={'country_iso3num':[str(country_code).zfill(3)],
+                                               **properties})
+    if 'glob_centroids' not in _glob_centroids:
+        _glob_centroids['glob_centroids'] = client.get_centroids()
+    exp_agg = aggregate_exposure_to_centroids(exp, _glob_centroids['glob_centroids'])
+    save_exposure_agg(agg_dir, country_iso3, exp_agg, exp.value_unit, properties)
+
+    return exp_agg, exp.value_unit
+
+def exposure_agg_on_hazard(exp_agg: pd.DataFrame, value_unit: str, tc_haz: Hazard) -> Exposures:
+    """
+    Exposures of the pre-aggregated population with the hazard centroids
+    assigned (column centr_TC) by joining the exact coordinates. Centroids
+    outside the hazard extent get -1 and are ignored by ImpactCalc, so the
+    exposure points are the same for every storm.
+    """
+    haz_centr = pd.DataFrame({'lat': tc_haz.centroids.lat,
+                              'lon': tc_haz.centroids.lon,
+                              'centr_TC': np.arange(tc_haz.centroids.size)})
+    exp_haz = exp_agg.merge(haz_centr, on=['lat', 'lon'], how='left')
+    exp_haz['centr_TC'] = exp_haz['centr_TC'].fillna(-1).astype(int)
+
+    gdf = gpd.GeoDataFrame(exp_haz[['value', 'centr_TC']],
+                           geometry=gpd.points_from_xy(exp_haz['lon'], exp_haz['lat']),
+                           crs="EPSG:4326")
+    return Exposures(gdf, value_unit=value_unit)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cached Web Mercator coordinates and hexagonal binning of the exposure points
+of a country, for the point-based impact maps (see plot_func._plot_imp_map).
+
+The exposure points of a country are the same for both impact types and for
+every storm, so their Web Mercator coordinates, the map extent and the hexagon
+of every point are computed once (with a vectorized pyproj transform) and
+cached next to the exposure data. A map then only sums the impact per
+hexagon (np.bincount) and hands the occupied hexagons to Axes.hexbin, which
+bins each hexagon centre into its own hexagon, so the map is the same as
+binning all the points.
+
+@author: Pui Man (Mannie) Kam
+"""
+import os
+import hashlib
+import functools
+import numpy as np
+from typing import Union
+from pathlib import Path
+from pyproj import Transformer
+
+from checkpoint_func import atomic_file
+
+HEXBIN_GRIDSIZE = 200
+
+HEXBIN_FILE_NAME = "litpop-pop-hexbin_{country_iso3}_{gridsize}.npz"
+
+# hexbin of the countries used in this process, by coordinate fingerprint
+_hexbin_cache = {}
+
+@functools.lru_cache
+def _web_mercator_transformer() -> Transformer:
+    return Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+
+def to_web_mercator(lat: np.ndarray, lon: np.ndarray):
+    """
+    Web Mercator (EPSG:3857) coordinates of points, in one vectorized transform.
+
+    Returns
+    -------
+    x, y : np.ndarray
+    """
+    return _web_mercator_transformer().transform(np.asarray(lon, float), np.asarray(lat, float))
+
+def coord_fingerprint(coord: np.ndarray) -> str:
+    """SHA1 hex digest of the coordinates (lat, lon) of the exposure points."""
+    return hashlib.sha1(np.ascontiguousarray(coord, dtype=np.float64).tobytes()).hexdigest()
+
+def hexbin_cells(x: np.ndarray, y: np.ndarray, gridsize: int, extent: tuple):
+    """
+    Hexagon of each point on the grid of matplotlib's Axes.hexbin with the
+    given gridsize and extent (xmin, xmax, ymin, ymax).
+
+    Returns
+    -------
+    cell : np.ndarray
+        Hexagon of each point, -1 outside the extent.
+    cell_x, cell_y : np.ndarray
+        Centres of all hexagons.
+    """
+    nx = gridsize
+    ny = int(nx / np.sqrt(3))
+    xmin, xmax, ymin, ymax = extent
+    # same padding as Axes.hexbin, the hexagons exactly cover xmin to xmax
+    padding = 1.e-9 * (xmax - xmin)
+    xmin, xmax = xmin - padding, xmax + padding
+    sx = (xmax - xmin) / nx
+    sy = (ymax - ymin) / ny
+
+    # two interleaved lattices, each point goes to the nearest centre
+    ix, iy = (x - xmin) / sx, (y - ymin) / sy
+    ix1, iy1 = np.round(ix).astype(int), np.round(iy).astype(int)
+    ix2, iy2 = np.floor(ix).astype(int), np.floor(iy).astype(int)
+    nx1, ny1, nx2, ny2 = nx + 1, ny + 1, nx, ny
+    i1 = np.where((0 <= ix1) & (ix1 < nx1) & (0 <= iy1) & (iy1 < ny1), ix1 * ny1 + iy1, -1)
+    i2 = np.where((0 <= ix2) & (ix2 < nx2) & (0 <= iy2) & (iy2 < ny2),
+                  nx1 * ny1 + ix2 * ny2 + iy2, -1)
+    d1 = (ix - ix1) ** 2 + 3.0 * (iy - iy1) ** 2
+    d2 = (ix - ix2 - 0.5) ** 2 + 3.0 * (iy - iy2 - 0.5) ** 2
+    cell = np.where(d1 < d2, i1, i2)
+
+    cell_x = np.concatenate([np.repeat(np.arange(nx1), ny1),
+                             np.repeat(np.arange(nx2) + 0.5, ny2)]) * sx + xmin
+    cell_y = np.concatenate([np.tile(np.arange(ny1), nx1),
+                             np.tile(np.arange(ny2), nx2) + 0.5]) * sy + ymin
+    return cell, cell_x, cell_y
+
+def make_hexbin_file_name(cache_dir: Union[str, Path], country_iso3: str,
+                          gridsize: int = HEXBIN_GRIDSIZE):
+    """File of the cached hexbin of the exposure points of a country."""
+    return os.path.join(cache_dir, HEXBIN_FILE_NAME.format(country_iso3=country_iso3,
+                                                           gridsize=gridsize))
+
+def compute_hexbin(coord: np.ndarray, gridsize: int = HEXBIN_GRIDSIZE) -> dict:
+    """
+    Web Mercator coordinates, map extent and hexagon of the exposure points.
+
+    Parameters
+    ----------
+    coord : np.ndarray
+        Coordinates (lat, lon) of the exposure points, e.g. Impact.coord_exp.
+    gridsize : int
+        Number of hexagons in the x-direction. Default: 200
+
+    Returns
+    -------
+    hexbin : dict
+        x, y (Web Mercator coordinates of the points), extent (xmin, xmax,
+        ymin, ymax), cell (hexagon of each point), cell_x, cell_y (centres
+        of the occupied hexagons, cell indexes into them) and gridsize.
+    """
+    x, y = to_web_mercator(coord[:, 0], coord[:, 1])
+    extent = (x.min(), x.max(), y.min(), y.max())
+    cell, cell_x, cell_y = hexbin_cells(x, y, gridsize, extent)
+    occupied, cell = np.unique(cell, return_inverse=True)
+
+    return {'x': x, 'y': y, 'extent': np.array(extent), 'cell': cell.ravel(),
+            'cell_x': cell_x[occupied], 'cell_y': cell_y[occupied], 'gridsize': gridsize}
+
+def get_country_hexbin(coord: np.ndarray, country_iso3: str,
+                       cache_dir: Union[str, Path] = None,
+                       gridsize: int = HEXBIN_GRIDSIZE) -> dict:
+    """
+    Hexbin of the exposure points of a country (see compute_hexbin), from
+    the memory or file cache if the points are the same, computed and cached
+    otherwise. Without cache_dir, it is only cached in memory.
+    """
+    fingerprint = coord_fingerprint(coord)
+    key = (country_iso3, fingerprint, gridsize)
+    if key in _hexbin_cache:
+        return _hexbin_cache[key]
+
+    hexbin_file = None if cache_dir is None else make_hexbin_file_name(cache_dir, country_iso3,
+                                                                       gridsize)
+    hexbin = None
+    if hexbin_file is not None and os.path.exists(hexbin_file):
+        with np.load(hexbin_file) as data:
+            if str(data['fingerprint']) == fingerprint:
+                hexbin = {name: data[name] for name in data.files if name != 'fingerprint'}
+                hexbin['gridsize'] = int(hexbin['gridsize'])
+
+    if hexbin is None:
+        hexbin = compute_hexbin(coord, gridsize)
+        if hexbin_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with atomic_file(hexbin_file) as tmp_file:
+                np.savez(tmp_file, fingerprint=fingerprint, **hexbin)
+
+    _hexbin_cache[key] = hexbin
+    return hexbin
+
+def hexbin_values(hexbin: dict, values: np.ndarray) -> np.ndarray:
+    """Sum of the values of the points (e.g. Impact.eai_exp) per occupied hexagon."""
+    return np.bincount(hexbin['cell'], weights=values, minlength=hexbin['cell_x'].size)
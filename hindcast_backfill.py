@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jan 13 09:30:00 2025
+
+Hindcast/backfill of archived ECMWF forecast runs, e.g. for verification and
+calibration. Takes a list or glob of run folders with the BUFR track files
+(named by run time, e.g. demo/data/20240825000000), computes the wind field
+of each storm and the impacts in each affected country.
+
+The work is split into units (run x storm for the wind field, run x storm x
+country for the impacts) that are scheduled on a process pool, the longest
+ones first. The cost estimates of both kinds of units are converted to
+seconds with the median runtime per cost of the completed units of the same
+kind. Completed units are recorded in a ledger, so that an interrupted
+backfill resumes where it stopped. Failed units are retried a few times and
+then recorded as failed, so that their run still completes; they are
+retried when the backfill is run again.
+
+Usage: python hindcast_backfill.py "archive/2024*" --output-dir ./hindcast --n-workers 16
+
+Output: per run, the wind field per storm (.hdf5), and the impact forecast
+        summary and impact per ensemble member per country.
+
+@author: Pui Man (Mannie) Kam
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+import glob
+import json
+import time
+import heapq
+import itertools
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from climada.util.coordinates import get_country_code, country_to_iso
+from climada.util.api_client import Client
+
+from tc_tracks_func import (
+    get_forecast_tracks, read_track_cache, track_cache_file,
+    format_run_datetime, adaptive_timestep
+)
+from windfield_func import compute_storm_windfield, make_tc_wind_file_name, N_ENSEMBLE
+from impact_calc_func import (
+    calc_country_impacts, summarize_forecast,
+    save_forecast_summary, save_impact_at_event
+)
+from checkpoint_func import atomic_file
+from codec_func import read_hazard
+
+EXPOSED_TO_WIND_THRESHOLD = 32.92 # threshold for people exposed to wind in m/s
+
+LEDGER_FILE_NAME = "hindcast_ledger.jsonl"
+
+# runtime per unit of cost (s) until runtimes of the kind of unit are known:
+# wind cost is track points x extent area (deg2), impact cost is centroids x members
+DEFAULT_SECONDS_PER_COST = {'wind': 1e-5, 'impact': 1e-4}
+
+# attempts of a unit before it is recorded as failed
+MAX_ATTEMPTS = 3
+
+# Data API client and global centroids, loaded once per worker process
+_worker_state = {}
+
+def _get_client():
+    if 'client' not in _worker_state:
+        _worker_state['client'] = Client()
+    return _worker_state['client']
+
+def _get_glob_centroids():
+    if 'glob_centroids' not in _worker_state:
+        _worker_state['glob_centroids'] = _get_client().get_centroids()
+    return _worker_state['glob_centroids']
+
+def run_datetime_from_folder(run_folder: str) -> np.datetime64:
+    """Run datetime of an archived run folder named e.g. 20240825000000"""
+    return np.datetime64(pd.to_datetime(os.path.basename(os.path.normpath(run_folder)),
+                                        format='%Y%m%d%H%M%S'), 's')
+
+def tracks_unit(run_folder: str, track_cache_dir: str) -> dict:
+    """
+    Decode (or load from the track cache) the tracks of a run and estimate the
+    cost of the wind field of each storm (track points x extent area).
+    """
+    tr_filter, _ = get_forecast_tracks(track_cache_dir,
+                                       run_datetime_from_folder(run_folder),
+                                       path=run_folder)
+    adaptive_timestep(tr_filter)
+
+    storms = {}
+    for tr_name in set([tr.name for tr in tr_filter.data]):
+        tr_one_storm = tr_filter.subset({'name': tr_name})
+        lon_min, lon_max, lat_min, lat_max = tr_one_storm.get_extent(deg_buffer=5.)
+        n_points = sum(tr.time.size for tr in tr_one_storm.data)
+        storms[tr_name] = n_points * (lon_max - lon_min) * (lat_max - lat_min)
+
+    return {'run_folder': run_folder, 'storms': storms}
+
+def wind_unit(run_folder: str, tr_name: str, track_cache_dir: str, output_dir: str) -> dict:
+    """
+    Compute and save the wind field of a storm, and estimate the cost of the
+    impact calculation of each affected country (centroids with wind x members).
+    """
+    run_datetime = run_datetime_from_folder(run_folder)
+    formatted_datetime = format_run_datetime(run_datetime)
+
+    tr_filter = read_track_cache(track_cache_file(track_cache_dir, run_datetime))
+    tr_one_storm = tr_filter.subset({'name': tr_name})
+    adaptive_timestep(tr_one_storm)
+
+    tc_haz = compute_storm_windfield(tr_one_storm, _get_glob_centroids(), N_ENSEMBLE)
+    wind_dir = os.path.join(output_dir, 'tc_wind')
+    os.makedirs(wind_dir, exist_ok=True)
+    with atomic_file(os.path.join(wind_dir, make_tc_wind_file_name(tr_name, formatted_datetime))) as tmp_file:
+        tc_haz.write_hdf5(tmp_file)
+
+    idx_non_zero_wind = tc_haz.intensity.max(axis=0).nonzero()[1]
+    country_code_all = get_country_code(tc_haz.centroids.lat[idx_non_zero_wind],
+                                        tc_haz.centroids.lon[idx_non_zero_wind])
+    country_codes, n_centroids = np.unique(country_code_all, return_counts=True)
+    n_members = tc_haz.intensity.shape[0]
+
+    return {'countries': {str(int(code)): int(n * n_members)
+                          for code, n in zip(country_codes, n_centroids) if code != 0}}
+
+def impact_unit(run_folder: str, tr_name: str, country_code: int, output_dir: str) -> dict:
+    """
+    Compute and save the impacts of a storm in a country.
+    """
+    client = _get_client()
+    formatted_datetime = format_run_datetime(run_datetime_from_folder(run_folder))
+    country_iso3 = country_to_iso(country_code, "alpha3")
+
+    try:
+        exp = client.get_exposures(exposures_type='litpop',
+                                   properties={'country_iso3num':[str(country_code).zfill(3)],
+                                               'exponents':'(0,1)',
+                                               'fin_mode':'pop',
+                                               'version':'v2'
+                                               }
+                                   )
+    except client.NoResult:
+        return {'status': 'no_exposure'}
+
+    tc_haz = read_hazard(os.path.join(output_dir, 'tc_wind',
+                                      make_tc_wind_file_name(tr_name, formatted_datetime)))
+    impacts = calc_country_impacts(exp, country_iso3, tc_haz, EXPOSED_TO_WIND_THRESHOLD)
+
+    save_dir = os.path.join(output_dir, formatted_datetime, '')
+    os.makedirs(save_dir, exist_ok=True)
+    for impact_type, impact in impacts.items():
+        if impact.aai_agg == 0.: # do not save the files if impact is 0.
+            break
+        imp_summary = summarize_forecast(country_iso3=country_iso3,
+                                         forecast_time=formatted_datetime,
+                                         impact_type=impact_type,
+                                         tc_haz=tc_haz,
+                                         tc_name=tr_name,
+                                         impact=impact)
+        save_forecast_summary(save_dir, imp_summary)
+        save_impact_at_event(save_dir, imp_summary, impact)
+
+    return {'status': 'done'}
+
+def _run_unit(unit: tuple, track_cache_dir: str, output_dir: str) -> tuple:
+    """Run a work unit in a worker process, return the unit, result and runtime."""
+    time_start = time.time()
+    kind, run_folder = unit[:2]
+    if kind == 'tracks':
+        result = tracks_unit(run_folder, track_cache_dir)
+    elif kind == 'wind':
+        result = wind_unit(run_folder, unit[2], track_cache_dir, output_dir)
+    else:
+        result = impact_unit(run_folder, unit[2], int(unit[3]), output_dir)
+    return unit, result, time.time() - time_start
+
+def _unit_key(unit: tuple) -> str:
+    return '|'.join([unit[0], os.path.basename(os.path.normpath(unit[1]))]
+                    + [str(part) for part in unit[2:]])
+
+def _read_ledger_records(ledger_file: str) -> list:
+    records = []
+    if os.path.exists(ledger_file):
+        with open(ledger_file) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError: # last line of a crashed run
+                    continue
+    return records
+
+def read_ledger(ledger_file: str) -> dict:
+    """
+    Completed units of a previous (interrupted) backfill, with their results.
+    Units recorded as failed are not completed and are run again.
+    """
+    return {record['key']: record['result'] for record in _read_ledger_records(ledger_file)
+            if 'result' in record}
+
+def read_runtime_ratios(ledger_file: str) -> dict:
+    """Runtime per unit of cost of the completed units in the ledger, per kind of unit."""
+    ratios = {kind: [] for kind in DEFAULT_SECONDS_PER_COST}
+    for record in _read_ledger_records(ledger_file):
+        kind = record['key'].split('|')[0]
+        if 'result' in record and record.get('cost') and kind in ratios:
+            ratios[kind].append(record['seconds'] / record['cost'])
+    return ratios
+
+def backfill(run_folders: list, output_dir: str, n_workers: int = None):
+    """
+    Process the archived runs on a process pool, longest units first (by
+    predicted seconds), and skip the units already recorded in the ledger.
+    """
+    track_cache_dir = os.path.join(output_dir, 'tc_tracks')
+    os.makedirs(output_dir, exist_ok=True)
+    ledger_file = os.path.join(output_dir, LEDGER_FILE_NAME)
+    ledger = read_ledger(ledger_file)
+    runtime_ratios = read_runtime_ratios(ledger_file)
+
+    # queue of units, ordered by predicted runtime (longest first)
+    queue = []
+    counter = itertools.count()
+    n_pending_per_run = {run_folder: 0 for run_folder in run_folders}
+    n_runs_done = 0
+    failed_units = []
+
+    def _predicted_seconds(kind, cost):
+        if kind == 'tracks':
+            return np.inf
+        ratios = runtime_ratios[kind]
+        return cost * (float(np.median(ratios)) if ratios else DEFAULT_SECONDS_PER_COST[kind])
+
+    def _push(unit, cost, attempt=1, new=True):
+        heapq.heappush(queue, (-_predicted_seconds(unit[0], cost), next(counter),
+                               unit, cost, attempt))
+        if new:
+            n_pending_per_run[unit[1]] += 1
+
+    def _follow_up(unit, result):
+        """Units that become available once a unit is done."""
+        if unit[0] == 'tracks':
+            return [(('wind', unit[1], tr_name), cost)
+                    for tr_name, cost in result['storms'].items()]
+        if unit[0] == 'wind':
+            return [(('impact', unit[1], unit[2], code), cost)
+                    for code, cost in result['countries'].items()]
+        return []
+
+    def _complete(unit, result):
+        """Queue the follow-up units (or complete them from the ledger)."""
+        nonlocal n_runs_done
+        for next_unit, cost in (_follow_up(unit, result) if result is not None else []):
+            if _unit_key(next_unit) in ledger:
+                n_pending_per_run[next_unit[1]] += 1
+                _complete(next_unit, ledger[_unit_key(next_unit)])
+            else:
+                _push(next_unit, cost)
+        n_pending_per_run[unit[1]] -= 1
+        if n_pending_per_run[unit[1]] == 0:
+            n_runs_done += 1
+
+    # the tracks are always reloaded (from the track cache) to rebuild the queue,
+    # before any other unit since they tell what else there is to do
+    for run_folder in run_folders:
+        _push(('tracks', run_folder), 0.)
+
+    n_workers = n_workers or os.cpu_count()
+    time_start = time.time()
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor, \
+            open(ledger_file, 'a') as ledger_f:
+        n_slots = 2 * n_workers
+        running = {}
+        while queue or running:
+            while queue and len(running) < n_slots:
+                _, _, unit, cost, attempt = heapq.heappop(queue)
+                running[executor.submit(_run_unit, unit, track_cache_dir, output_dir)] = \
+                    (unit, cost, attempt)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                unit, cost, attempt = running.pop(future)
+                try:
+                    _, result, runtime = future.result()
+                except Exception as err:
+                    print(f"Work unit {_unit_key(unit)} failed (attempt {attempt}/{MAX_ATTEMPTS}): {err}")
+                    if attempt < MAX_ATTEMPTS:
+                        _push(unit, cost, attempt + 1, new=False)
+                        continue
+                    # given up: recorded as failed (retried by the next backfill), the run completes
+                    failed_units.append(_unit_key(unit))
+                    ledger_f.write(json.dumps({'key': _unit_key(unit), 'status': 'failed',
+                                               'error': repr(err), 'attempts': attempt}) + '\n')
+                    ledger_f.flush()
+                    os.fsync(ledger_f.fileno())
+                    result = None
+                else:
+                    if unit[0] != 'tracks':
+                        ledger_f.write(json.dumps({'key': _unit_key(unit), 'result': result,
+                                                   'seconds': runtime, 'cost': cost}) + '\n')
+                        ledger_f.flush()
+                        os.fsync(ledger_f.fileno())
+                        if cost > 0:
+                            runtime_ratios[unit[0]].append(runtime / cost)
+
+                n_runs_before = n_runs_done
+                _complete(unit, result)
+                if n_runs_done > n_runs_before:
+                    hours = (time.time() - time_start) / 3600
+                    print(f"{n_runs_done}/{len(run_folders)} runs done, "
+                          f"{n_runs_done / hours:.1f} runs per hour")
+
+    hours = (time.time() - time_start) / 3600
+    print(f"Hindcast complete: {n_runs_done}/{len(run_folders)} runs in {hours:.2f} h "
+          f"({n_runs_done / max(hours, 1e-9):.1f} runs per hour)")
+    if failed_units:
+        print(f"{len(failed_units)} units failed after {MAX_ATTEMPTS} attempts and are retried "
+              f"by the next backfill: {', '.join(failed_units)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hindcast/backfill of archived ECMWF runs")
+    parser.add_argument("run_folders", nargs="+",
+                        help="Run folders with the BUFR files, or glob patterns of them")
+    parser.add_argument("--output-dir", default="./hindcast",
+                        help="Output directory (wind fields, impacts, ledger)")
+    parser.add_argument("--n-workers", type=int, default=None,
+                        help="Number of worker processes. Default: number of CPUs")
+    args = parser.parse_args()
+
+    run_folders = sorted(set(folder for pattern in args.run_folders
+                             for folder in glob.glob(pattern) if os.path.isdir(folder)))
+    backfill(run_folders, args.output_dir, args.n_workers)
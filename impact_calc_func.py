@@ -6,16 +6,24 @@ Useful functions for impact calculations.
 @author: Pui Man (Mannie) Kam
 """
 import os
+import copy
 import glob
+import functools
 import numpy as np
 import pandas as pd
 import json
-from typing import Union, List, Tuple
+from typing import Union, List, Tuple, Dict
 from pathlib import Path
+from scipy import sparse
 
-from climada.hazard import TCTracks
-from climada.entity import ImpactFunc, ImpfTropCyclone, ImpactFuncSet
-from climada.engine import Impact
+from climada.hazard import TCTracks, Hazard
+from climada.entity import ImpactFunc, ImpfTropCyclone, ImpactFuncSet, Exposures
+from climada.engine import Impact, ImpactCalc
+from climada.util.coordinates import country_to_iso
+
+from writer_func import AsyncWriter, write_bytes, file_to_bytes
+from codec_func import intensity_levels
+from tiling_func import spatial_tiles, max_points_per_tile
 
 #  List of regions and the countries
 iso3_to_basin = {'NA1': ['AIA', 'ATG', 'ARG', 'ABW', 'BHS', 'BRB', 'BLZ', 'BMU',
@@ -69,6 +77,63 @@ v_half_per_region = {'NA1': 51.6,
                     'WP4': 93.1,
                     'ROW': 49.5}
 
+# reverse lookup of the region of each country (first region if listed in several)
+iso3_to_basin_reverse = {}
+for basin, list_of_values in iso3_to_basin.items():
+    for iso3 in list_of_values:
+        iso3_to_basin_reverse.setdefault(iso3, basin)
+
+# intensity step of the tabulated impact functions, in m/s
+IMPF_TABLE_STEP = .01
+
+class TabulatedImpactFunc(ImpactFunc):
+    """
+    Impact function whose mean damage ratio (mdd x paa) is tabulated on a
+    fine uniform intensity grid. calc_mdr then looks up the two neighbouring
+    grid points by index and interpolates between them, instead of the
+    interpolation of mdd and paa on the function's own intensity points.
+    The result is exact as long as these intensity points lie on the grid
+    (see tabulate_impf_set).
+
+    Parameters
+    ----------
+    impf : climada.entity.ImpactFunc
+        Impact function to tabulate.
+    step : float
+        Intensity step of the table. Default: 0.01
+    """
+
+    def __init__(self, impf: ImpactFunc, step: float = IMPF_TABLE_STEP):
+        super().__init__(haz_type=impf.haz_type, id=impf.id, intensity=impf.intensity,
+                         mdd=impf.mdd, paa=impf.paa, intensity_unit=impf.intensity_unit,
+                         name=impf.name)
+        self.table_step = step
+        self.table_mdr = impf.calc_mdr(np.arange(0, impf.intensity.max() + 2 * step, step))
+
+    def calc_mdr(self, inten: np.ndarray) -> np.ndarray:
+        """Mean damage ratio of the intensities, from the table"""
+        pos = np.clip(np.asarray(inten) / self.table_step, 0, self.table_mdr.size - 1)
+        idx = np.minimum(pos.astype(np.intp), self.table_mdr.size - 2)
+        return self.table_mdr[idx] + (pos - idx) * (self.table_mdr[idx + 1] - self.table_mdr[idx])
+
+def tabulate_impf_set(impf_set: ImpactFuncSet, step: float = IMPF_TABLE_STEP) -> ImpactFuncSet:
+    """
+    Impact function set with the functions replaced by TabulatedImpactFunc.
+    Only functions whose intensity points are strictly increasing and lie on
+    the grid of the table (e.g. the Emanuel functions) are tabulated, the
+    others (e.g. step functions) are kept, so the impacts are unchanged.
+    """
+    impf_set_tab = ImpactFuncSet()
+    for impf in impf_set.get_func():
+        on_grid = np.allclose(impf.intensity / step, np.round(impf.intensity / step))
+        if on_grid and np.all(np.diff(impf.intensity) > 0):
+            impf_set_tab.append(TabulatedImpactFunc(impf, step))
+        else:
+            impf_set_tab.append(impf)
+
+    return impf_set_tab
+
+@functools.lru_cache(maxsize=None)
 def impf_set_exposed_pop(threshold: np.float64 = 32.92):
     """
     Impact function set that estimate the number of people exposed 
@@ -83,7 +148,8 @@ def impf_set_exposed_pop(threshold: np.float64 = 32.92):
     Returns
     -------
     impf_set : climada.entity.ImpactDuncSet
-        Impact function set that contains a step impact function.
+        Impact function set that contains a step impact function. Built once
+        per threshold, do not modify it.
     """
 
     impf = ImpactFunc.from_step_impf((0,threshold, 100),
@@ -94,7 +160,7 @@ def impf_set_exposed_pop(threshold: np.float64 = 32.92):
 
     return(impf_set)
 
-def impf_set_displacement(country: str):
+def impf_set_displacement(country: str, tabulated: bool = False):
     """
     Impact function set that estimate the number of displacement. The shape of the
     impact function depends on the countries and their respective region. 
@@ -104,22 +170,77 @@ def impf_set_displacement(country: str):
     ----------
     country : str
         Single country in ISO3 alpha.
+    tabulated : bool
+        If True, the impact function is tabulated (see tabulate_impf_set).
+        Default: False
 
     Returns
     -------
     impf_set : climada.entity.ImpactDuncSet
         Impact function set that contains a displacement impact function.
+        Shared by all countries of a region, do not modify it.
     """
 
-    v_half = get_impf_v_half(country)
-
-    impf = ImpfTropCyclone.from_emanuel_usa(v_half=v_half)
+    return impf_set_displacement_basin(iso3_to_basin_reverse[country], tabulated)
 
+@functools.lru_cache(maxsize=None)
+def impf_set_displacement_basin(basin: str, tabulated: bool = False):
+    """
+    Displacement impact function set of a region, built once per region.
+    """
     impf_set = ImpactFuncSet()
-    impf_set.append(impf)
+    impf_set.append(_impf_emanuel(v_half_per_region[basin]))
+
+    if tabulated:
+        impf_set = tabulate_impf_set(impf_set)
 
     return(impf_set)
 
+@functools.lru_cache(maxsize=None)
+def _impf_emanuel(v_half: float, impf_id: int = 1) -> ImpfTropCyclone:
+    """
+    Emanuel-type impact function, built once per v_half and id
+    """
+    return ImpfTropCyclone.from_emanuel_usa(impf_id=impf_id, v_half=v_half)
+
+def impf_set_displacement_regions(exp: Exposures, tabulated: bool = False):
+    """
+    Impact function set for the displacement of exposures that cover several
+    countries. Contains one impact function per region (see iso3_to_basin)
+    and assigns the matching impact function id to each exposure point
+    (column impf_TC) according to its region_id (ISO3 numeric).
+
+    Parameters
+    ----------
+    exp : climada.entity.Exposures
+        Exposures with a region_id column. The column impf_TC is overwritten.
+    tabulated : bool
+        If True, the impact functions are tabulated (see tabulate_impf_set).
+        Default: False
+
+    Returns
+    -------
+    impf_set : climada.entity.ImpactFuncSet
+        Impact function set that contains a displacement impact function per region.
+    """
+    region_ids = exp.gdf['region_id'].values
+    region_ids_unique = np.unique(region_ids)
+    v_half_unique = [get_impf_v_half(country_to_iso(int(region_id), "alpha3"))
+                     for region_id in region_ids_unique]
+
+    impf_set = ImpactFuncSet()
+    impf_id_per_v_half = {}
+    for v_half in sorted(set(v_half_unique)):
+        impf_id_per_v_half[v_half] = len(impf_id_per_v_half) + 1
+        impf_set.append(_impf_emanuel(v_half, impf_id_per_v_half[v_half]))
+
+    impf_id_per_region = np.array([impf_id_per_v_half[v_half] for v_half in v_half_unique])
+    exp.gdf['impf_TC'] = impf_id_per_region[np.searchsorted(region_ids_unique, region_ids)]
+
+    if tabulated:
+        impf_set = tabulate_impf_set(impf_set)
+
+    return(impf_set)
 
 def get_impf_v_half(country: str):
     """
@@ -136,15 +257,459 @@ def get_impf_v_half(country: str):
         The impact function parameter v_half for the respective country.
     """
     # Get basin in which country_iso3 lies
-    basin = [key
-            for key, list_of_values in iso3_to_basin.items()
-            if country in list_of_values]
+    basin = iso3_to_basin_reverse[country]
     
     # Get impf_distr corresponding to basin
-    v_half = v_half_per_region[basin[0]]
+    v_half = v_half_per_region[basin]
     
     return v_half
 
+def min_impact_intensity(impf_set: ImpactFuncSet, haz_type: str = "TC") -> float:
+    """
+    Smallest intensity that can give a non-zero impact with any impact
+    function of the set. The mean damage ratio (mdd x paa) is interpolated
+    linearly, so it is zero up to the last intensity point before its first
+    non-zero value.
+
+    Parameters
+    ----------
+    impf_set : climada.entity.ImpactFuncSet
+        Impact functions.
+    haz_type : str
+        Hazard type. Default: "TC"
+
+    Returns
+    -------
+    min_intensity : float
+        Intensities below it give zero impact (np.inf if no function of the
+        set gives any impact).
+    """
+    min_intensity = np.inf
+    for impf in impf_set.get_func(haz_type=haz_type):
+        [idx_nonzero] = (impf.mdd * impf.paa > 0).nonzero()
+        if idx_nonzero.size == 0:
+            continue
+        if idx_nonzero[0] == 0:
+            return 0.
+        min_intensity = min(min_intensity, impf.intensity[idx_nonzero[0] - 1])
+
+    return min_intensity
+
+def impact_min_intensity_per_type(country_iso3: str,
+                                  exposed_threshold: np.float64 = 32.92) -> Dict[str, float]:
+    """
+    Smallest intensity that can give a non-zero impact for each impact type
+    (exposed population and displacement) in a country.
+    """
+    return {
+        f"exposed_population_{exposed_threshold}ms": min_impact_intensity(
+            impf_set_exposed_pop(threshold=exposed_threshold)),
+        "displacement": min_impact_intensity(impf_set_displacement(country_iso3))
+    }
+
+def screen_hazard(tc_haz: Hazard, min_intensity: float) -> Hazard:
+    """
+    Copy of the hazard without the intensities below min_intensity, which
+    cannot give any impact (see min_impact_intensity). The impacts are
+    unchanged, but ImpactCalc skips the members and centroids that do not
+    reach the impact functions. The tot_value of such an impact only counts
+    the exposure points that can be affected. Only the intensity matrix is
+    copied.
+    """
+    intensity = tc_haz.intensity.copy()
+    intensity.data[intensity.data < min_intensity] = 0
+    intensity.eliminate_zeros()
+
+    tc_haz_screened = copy.copy(tc_haz)
+    tc_haz_screened.intensity = intensity
+    return tc_haz_screened
+
+def _screened(tc_haz: Hazard, impf_set: ImpactFuncSet, intensity_codes: tuple = None) -> Hazard:
+    """Screened hazard for ImpactCalc, the lookup tables on the codes need no screening."""
+    if intensity_codes is not None:
+        return tc_haz
+    return screen_hazard(tc_haz, min_impact_intensity(impf_set))
+
+def concat_country_exposures(exp_per_country: Dict[int, Exposures]) -> Exposures:
+    """
+    Join the exposures of several countries into one Exposures, where each
+    point is tagged with its country in the column region_id (ISO3 numeric).
+    """
+    for country_code, exp in exp_per_country.items():
+        exp.gdf['region_id'] = int(country_code)
+
+    exp_all = Exposures.concat(list(exp_per_country.values()))
+    exp_all.gdf.reset_index(drop=True, inplace=True)
+
+    return exp_all
+
+def cast_impact_inputs(exp: Exposures, tc_haz: Hazard, dtype: type = np.float64) -> None:
+    """
+    Cast the exposure values and the hazard intensity to the given floating
+    point type (e.g. np.float32) before the impact computation. Nothing is
+    copied if they already have that type.
+    """
+    exp.gdf['value'] = exp.gdf['value'].astype(dtype, copy=False)
+    tc_haz.intensity = tc_haz.intensity.astype(dtype, copy=False)
+
+def _cast_impact(impact: Impact, dtype: type = np.float64) -> Impact:
+    """
+    Cast the impact matrix to the given floating point type
+    """
+    impact.imp_mat = impact.imp_mat.astype(dtype, copy=False)
+    return impact
+
+def calc_country_impacts(exp: Exposures,
+                         country_iso3: str,
+                         tc_haz: Hazard,
+                         exposed_threshold: np.float64 = 32.92,
+                         dtype: type = np.float64,
+                         tabulated: bool = False,
+                         intensity_codes: Tuple[sparse.csr_matrix, float, float] = None
+                         ) -> Dict[str, Impact]:
+    """
+    Compute the impacts of a storm in a single country for all impact types
+    (exposed population and displacement). The impact matrix is kept for the
+    aggregation to admin units. With dtype=np.float32 the inputs and the
+    impact matrices are in single precision. With tabulated=True the
+    displacement impact function is evaluated from a table. With the
+    integer codes of the intensity (see codec_func.read_hazard_codes), the
+    impacts are computed on the codes with lookup tables instead.
+
+    Returns
+    -------
+    impacts : Dict[str, climada.engine.Impact]
+        Impact per impact type.
+    """
+    cast_impact_inputs(exp, tc_haz, dtype)
+    impf_exposed = impf_set_exposed_pop(threshold=exposed_threshold)
+    impf_displacement = impf_set_displacement(country_iso3, tabulated)
+
+    if intensity_codes is not None:
+        if 'centr_TC' not in exp.gdf.columns:
+            exp.assign_centroids(tc_haz)
+        _, scale, offset = intensity_codes
+        tc_haz_codes = quantized_hazard(tc_haz, intensity_codes)
+        return {
+            f"exposed_population_{exposed_threshold}ms": _cast_impact(
+                calc_impact_quantized(exp, impf_exposed, tc_haz_codes, scale, offset), dtype),
+            "displacement": _cast_impact(
+                calc_impact_quantized(exp, impf_displacement, tc_haz_codes, scale, offset), dtype)
+        }
+
+    return {
+        f"exposed_population_{exposed_threshold}ms": _cast_impact(
+            ImpactCalc(exp, impf_exposed,
+                       screen_hazard(tc_haz, min_impact_intensity(impf_exposed))
+                       ).impact(save_mat=True), dtype),
+        "displacement": _cast_impact(
+            ImpactCalc(exp, impf_displacement,
+                       screen_hazard(tc_haz, min_impact_intensity(impf_displacement))
+                       ).impact(save_mat=True), dtype)
+    }
+
+def calc_country_impacts_batched(exp_per_country: Dict[int, Exposures],
+                                 tc_haz: Hazard,
+                                 exposed_threshold: np.float64 = 32.92,
+                                 dtype: type = np.float64,
+                                 max_memory_gb: float = None,
+                                 tabulated: bool = False,
+                                 intensity_codes: Tuple[sparse.csr_matrix, float, float] = None
+                                 ) -> Dict[int, Dict[str, Impact]]:
+    """
+    Compute the impacts of a storm in several countries with a single impact
+    computation per impact type. The exposures of all countries are joined,
+    the centroids are assigned only once for the whole storm, and the
+    results are split by country with a sparse aggregation matrix
+    (see split_impact_by_region). The per-country impacts equal the ones
+    of calc_country_impacts.
+
+    Parameters
+    ----------
+    exp_per_country : Dict[int, climada.entity.Exposures]
+        Exposures per country (ISO3 numeric).
+    tc_haz : climada.hazard.Hazard
+        Wind field of the storm.
+    exposed_threshold : np.float64
+        Wind speed threshold that people are exposed to.
+    dtype : type
+        Floating point type of the inputs and of the impact matrices.
+        Default: np.float64
+    max_memory_gb : float
+        If given, the impacts are computed in spatial tiles of exposure
+        points under this memory ceiling (see calc_impact_tiled).
+        Default: None
+    tabulated : bool
+        If True, the displacement impact functions are evaluated from tables
+        (see tabulate_impf_set). Default: False
+    intensity_codes : Tuple[scipy.sparse.csr_matrix, float, float]
+        Integer codes of the intensity, scale and offset (see
+        codec_func.read_hazard_codes). If given, the impacts are computed on
+        the codes with lookup tables (see calc_impact_quantized).
+        Default: None
+
+    Returns
+    -------
+    impacts : Dict[int, Dict[str, climada.engine.Impact]]
+        Impact per country (ISO3 numeric) and impact type, in the order of
+        exp_per_country.
+    """
+    exp_all = concat_country_exposures(exp_per_country)
+    # the exposures may come with the centroids assigned (e.g. pre-aggregated, see exposure_agg_func)
+    if 'centr_TC' not in exp_all.gdf.columns:
+        exp_all.assign_centroids(tc_haz)
+    cast_impact_inputs(exp_all, tc_haz, dtype)
+
+    impf_exposed = impf_set_exposed_pop(threshold=exposed_threshold)
+    exp_all.gdf['impf_TC'] = impf_exposed.get_ids("TC")[0]
+    impact_exposed = _cast_impact(calc_impact_tiled(
+        exp_all, impf_exposed, _screened(tc_haz, impf_exposed, intensity_codes),
+        max_memory_gb, intensity_codes), dtype)
+    impacts_exposed = split_impact_by_region(impact_exposed,
+                                             exp_all.gdf['region_id'].values,
+                                             exp_all.gdf['value'].values)
+
+    impf_displacement = impf_set_displacement_regions(exp_all, tabulated)
+    impact_displacement = _cast_impact(calc_impact_tiled(
+        exp_all, impf_displacement, _screened(tc_haz, impf_displacement, intensity_codes),
+        max_memory_gb, intensity_codes), dtype)
+    impacts_displacement = split_impact_by_region(impact_displacement,
+                                                  exp_all.gdf['region_id'].values,
+                                                  exp_all.gdf['value'].values)
+
+    # in the order of exp_per_country (e.g. by priority), not of the region ids
+    return {
+        country_code: {
+            f"exposed_population_{exposed_threshold}ms": impacts_exposed[country_code],
+            "displacement": impacts_displacement[country_code]
+        }
+        for country_code in exp_per_country if country_code in impacts_exposed
+    }
+
+def calc_impact_tiled(exp: Exposures,
+                      impf_set: ImpactFuncSet,
+                      tc_haz: Hazard,
+                      max_memory_gb: float = None,
+                      intensity_codes: Tuple[sparse.csr_matrix, float, float] = None) -> Impact:
+    """
+    Compute the impact in spatial tiles of exposure points that stay below a
+    memory ceiling, and stitch the impact matrices of the tiles back into the
+    order of the exposure points. The result is the one of a single
+    ImpactCalc (or calc_impact_quantized) over all exposure points. Only the
+    impact matrix is bounded, the (sparse) wind field of the whole storm is
+    shared by all tiles.
+
+    Parameters
+    ----------
+    exp : climada.entity.Exposures
+        Exposures with the centroids (centr_TC) and impact functions (impf_TC)
+        assigned.
+    impf_set : climada.entity.ImpactFuncSet
+        Impact functions.
+    tc_haz : climada.hazard.Hazard
+        Wind field of the storm.
+    max_memory_gb : float
+        Memory ceiling of a tile. Default: None (untiled)
+    intensity_codes : Tuple[scipy.sparse.csr_matrix, float, float]
+        Integer codes of the intensity, scale and offset, to compute the
+        impact on the codes (see calc_impact_quantized). The intensity of
+        tc_haz is not used then. Default: None
+
+    Returns
+    -------
+    impact : climada.engine.Impact
+        Impact with the impact matrix saved.
+    """
+    if intensity_codes is None:
+        def _impact(exp_tile):
+            return ImpactCalc(exp_tile, impf_set, tc_haz).impact(save_mat=True,
+                                                                 assign_centroids=False)
+    else:
+        _, scale, offset = intensity_codes
+        tc_haz_codes = quantized_hazard(tc_haz, intensity_codes)
+        def _impact(exp_tile):
+            return calc_impact_quantized(exp_tile, impf_set, tc_haz_codes, scale, offset)
+
+    lat, lon = exp.gdf.geometry.y.values, exp.gdf.geometry.x.values
+    if max_memory_gb is None:
+        tiles = [np.arange(lat.size)]
+    else:
+        # impact matrix (data and indices) and mean damage ratio per exposure point
+        bytes_per_exp = 2 * 12 * tc_haz.intensity.shape[0]
+        tiles = spatial_tiles(lat, lon, max_points_per_tile(max_memory_gb, bytes_per_exp))
+    if len(tiles) == 1:
+        return _impact(exp)
+
+    imp_mats, tot_value = [], 0.
+    for tile in tiles:
+        impact_tile = _impact(Exposures(exp.gdf.iloc[tile], crs=exp.crs, value_unit=exp.value_unit))
+        imp_mats.append(impact_tile.imp_mat)
+        tot_value += impact_tile.tot_value
+
+    # back to the order of the exposure points
+    order = np.argsort(np.concatenate(tiles))
+    imp_mat = sparse.hstack(imp_mats, format='csc')[:, order].tocsr()
+    imp_mat.sort_indices()
+    at_event, eai_exp, aai_agg = ImpactCalc.risk_metrics(imp_mat, tc_haz.frequency)
+
+    return Impact(
+        event_id=tc_haz.event_id,
+        event_name=tc_haz.event_name,
+        date=tc_haz.date,
+        frequency=tc_haz.frequency,
+        frequency_unit=tc_haz.frequency_unit,
+        coord_exp=np.stack([lat, lon], axis=1),
+        crs=exp.crs,
+        eai_exp=eai_exp,
+        at_event=at_event,
+        tot_value=tot_value,
+        aai_agg=aai_agg,
+        unit=exp.value_unit,
+        imp_mat=imp_mat,
+        haz_type="TC"
+    )
+
+def quantized_hazard(tc_haz: Hazard,
+                     intensity_codes: Tuple[sparse.csr_matrix, float, float]) -> Hazard:
+    """
+    Copy of the hazard with the integer codes as intensity (see
+    codec_func.read_hazard_codes), only the reference to the intensity is
+    replaced.
+    """
+    tc_haz_codes = copy.copy(tc_haz)
+    tc_haz_codes.intensity = intensity_codes[0]
+    return tc_haz_codes
+
+def calc_impact_quantized(exp: Exposures,
+                          impf_set: ImpactFuncSet,
+                          tc_haz: Hazard,
+                          scale: float,
+                          offset: float) -> Impact:
+    """
+    Compute the impact directly on the quantized intensity codes (see
+    codec_func.read_hazard_quantized). The mean damage ratio of every code
+    is tabulated once per impact function, so that the impact matrix is a
+    table lookup of the codes times the exposure values.
+
+    Parameters
+    ----------
+    exp : climada.entity.Exposures
+        Exposures with the centroids (centr_TC) and impact functions (impf_TC)
+        assigned.
+    impf_set : climada.entity.ImpactFuncSet
+        Impact functions.
+    tc_haz : climada.hazard.Hazard
+        Hazard with the integer codes as intensity.
+    scale, offset : float
+        Codec of the intensity (intensity = offset + scale * code).
+
+    Returns
+    -------
+    impact : climada.engine.Impact
+        Impact with the impact matrix saved.
+    """
+    intensity = tc_haz.intensity.tocsc()
+    levels = intensity_levels(scale, offset, intensity.dtype.type)
+    centr_idx = exp.gdf['centr_TC'].values
+    impf_ids = exp.gdf[exp.get_impf_column('TC')].values
+    values = exp.gdf['value'].values
+
+    rows, cols, data = [], [], []
+    for impf_id in np.unique(impf_ids):
+        exp_idx = np.flatnonzero((impf_ids == impf_id) & (centr_idx >= 0))
+        if exp_idx.size == 0:
+            continue
+        mdr_table = impf_set.get_func(haz_type="TC", fun_id=impf_id).calc_mdr(levels)
+        imp_sub = intensity[:, centr_idx[exp_idx]]
+        n_per_exp = np.diff(imp_sub.indptr)
+        rows.append(imp_sub.indices)
+        cols.append(np.repeat(exp_idx, n_per_exp))
+        data.append(mdr_table[imp_sub.data] * np.repeat(values[exp_idx], n_per_exp))
+
+    imp_mat = sparse.csr_matrix(
+        (np.concatenate(data) if data else [],
+         (np.concatenate(rows) if rows else [], np.concatenate(cols) if cols else [])),
+        shape=(intensity.shape[0], values.size))
+    imp_mat.eliminate_zeros()
+
+    at_event = np.asarray(imp_mat.sum(axis=1)).ravel()
+    eai_exp = imp_mat.T @ tc_haz.frequency
+    return Impact(
+        event_id=tc_haz.event_id,
+        event_name=tc_haz.event_name,
+        date=tc_haz.date,
+        frequency=tc_haz.frequency,
+        frequency_unit=tc_haz.frequency_unit,
+        coord_exp=np.stack([exp.gdf.geometry.y.values, exp.gdf.geometry.x.values], axis=1),
+        crs=exp.crs,
+        eai_exp=eai_exp,
+        at_event=at_event,
+        tot_value=values[centr_idx >= 0].sum(),
+        aai_agg=np.sum(eai_exp),
+        unit=exp.value_unit,
+        imp_mat=imp_mat,
+        haz_type="TC"
+    )
+
+def split_impact_by_region(impact: Impact,
+                           region_id: np.ndarray,
+                           value: np.ndarray) -> Dict[int, Impact]:
+    """
+    Split an impact over several regions into one impact per region. The
+    impact of each event per region (at_event) is computed for all regions at
+    once as the product of the impact matrix with a sparse aggregation
+    matrix (exposure point x region).
+
+    Parameters
+    ----------
+    impact : climada.engine.Impact
+        Impact with the impact matrix (imp_mat) saved.
+    region_id : np.ndarray
+        Region of each exposure point.
+    value : np.ndarray
+        Exposure value of each exposure point.
+
+    Returns
+    -------
+    impact_per_region : Dict[int, climada.engine.Impact]
+        Impact per region.
+    """
+    regions, region_idx = np.unique(region_id, return_inverse=True)
+    n_exp = region_id.size
+    agg_mat = sparse.csr_matrix((np.ones(n_exp), (np.arange(n_exp), region_idx)),
+                                shape=(n_exp, regions.size))
+
+    at_event_region = (impact.imp_mat @ agg_mat).toarray()
+    tot_value_region = np.bincount(region_idx, weights=value, minlength=regions.size)
+
+    imp_mat = impact.imp_mat.tocsc()
+    exp_idx_sorted = np.argsort(region_idx, kind='stable')
+    exp_idx_per_region = np.split(exp_idx_sorted,
+                                  np.cumsum(np.bincount(region_idx))[:-1])
+
+    impact_per_region = {}
+    for idx_region, region in enumerate(regions):
+        exp_idx = exp_idx_per_region[idx_region]
+        eai_exp = impact.eai_exp[exp_idx]
+        impact_per_region[int(region)] = Impact(
+            event_id=impact.event_id,
+            event_name=impact.event_name,
+            date=impact.date,
+            frequency=impact.frequency,
+            frequency_unit=impact.frequency_unit,
+            coord_exp=impact.coord_exp[exp_idx],
+            crs=impact.crs,
+            eai_exp=eai_exp,
+            at_event=at_event_region[:, idx_region],
+            tot_value=tot_value_region[idx_region],
+            aai_agg=np.sum(eai_exp),
+            unit=impact.unit,
+            imp_mat=imp_mat[:, exp_idx].tocsr(),
+            haz_type=impact.haz_type
+        )
+
+    return impact_per_region
+
 def round_to_previous_12h_utc(timestamp: pd.Timestamp):
     """
     Rounding the time into 00 or 12 UTC
@@ -173,7 +738,11 @@ def get_forecast_times(current_timestamp: pd.Timestamp) -> Tuple[pd.Timestamp, p
 def get_tc_wind_files(forecast_time: pd.Timestamp, 
                       previous_forecast_time: pd.Timestamp, 
                       tc_wind_dir: str) -> List[str]:
-    """Get the list of TC wind files for the given forecast times."""
+    """
+    Get the list of TC wind files for the given forecast times by scanning
+    tc_wind_dir. impact_calculate.py looks them up in the catalog instead
+    (see catalog_func.get_storm_wind_files).
+    """
     forecast_time_str = forecast_time.strftime('%Y-%m-%d_%HUTC')
     file_pattern = os.path.join(tc_wind_dir, f"*{forecast_time_str}.hdf5")
     tc_wind_files = glob.glob(file_pattern)
@@ -197,8 +766,8 @@ def summarize_forecast(country_iso3: str,
     """
     # check impact event length
     ## incase the TC ensemble number is less than 51
-    # get the array for each event
-    imp_at_event = _check_event_no(impact)
+    # get the array for each event, the statistics are computed in double precision
+    imp_at_event = _check_event_no(impact).astype(np.float64)
 
     imp_summary_dict={
         "countryISO3": country_iso3,
@@ -218,9 +787,11 @@ def summarize_forecast(country_iso3: str,
     return imp_summary_dict
 
 def save_forecast_summary(save_dir: Union[str, Path],
-                          forecast_summary: dict):
+                          forecast_summary: dict,
+                          writer: AsyncWriter = None):
     """
     Save the  summary into a geoJSON feature collection.
+    Written in the background if an AsyncWriter is given.
     """
     # Create a GeoJSON FeatureCollection structure
     geojson_data = {
@@ -235,9 +806,22 @@ def save_forecast_summary(save_dir: Union[str, Path],
     }
 
     # Save the GeoJSON data to a file
-    with open(save_dir+make_save_filename(forecast_summary, save_file_type="summary"),
-              'w') as f:
-        json.dump(geojson_data, f, indent=4)
+    return write_bytes(save_dir+make_save_filename(forecast_summary, save_file_type="summary"),
+                       json.dumps(geojson_data, indent=4).encode(),
+                       writer)
+
+def save_lead_time_summary(save_dir: Union[str, Path],
+                           tc_name: str,
+                           forecast_time: str,
+                           lead_time_df: pd.DataFrame,
+                           writer: AsyncWriter = None):
+    """
+    Save the impact summaries of a storm at each lead-time checkpoint (one row
+    per country, impact type and lead time) into a CSV file.
+    Written in the background if an AsyncWriter is given.
+    """
+    save_file_name = f'impact-leadtime_TC_ECMWF_ens_{tc_name}_{forecast_time}.csv'
+    return write_bytes(save_dir +save_file_name, lead_time_df.to_csv(index=False).encode(), writer)
 
 def make_save_filename(imp_summary_dict: dict,
                         save_file_type: str):
@@ -266,7 +850,8 @@ def make_save_filename(imp_summary_dict: dict,
 def save_average_impact_geospatial_points(save_dir: Union[str, Path],
                                           imp_summary_dict: dict,
                                           impact: Impact,
-                                          include_zeros: bool = False):
+                                          include_zeros: bool = False,
+                                          writer: AsyncWriter = None):
     """
     Save the average impact of each grid points into a geoJSON file.
 
@@ -283,19 +868,27 @@ def save_average_impact_geospatial_points(save_dir: Union[str, Path],
     include_zeros: bool
         Whether inclode grid points with impact equals to 0.
         Default: False
+
+    writer: AsyncWriter
+        Writer for writing the file in the background.
+        Default: None (write synchronously)
     """
 
     imp_gdf = impact._build_exp().gdf
 
-    if include_zeros:
-        imp_gdf.to_file(save_dir+make_save_filename(imp_summary_dict, save_file_type="gdf"))
-    else:
+    if not include_zeros:
         imp_gdf.drop(imp_gdf[imp_gdf['value'] == 0].index, inplace=True)
-        imp_gdf.to_file(save_dir+make_save_filename(imp_summary_dict, save_file_type="gdf"))
+
+    save_file_name = save_dir+make_save_filename(imp_summary_dict, save_file_type="gdf")
+    return write_bytes(save_file_name,
+                       file_to_bytes(lambda tmp_file: imp_gdf.to_file(tmp_file, driver="GeoJSON"),
+                                     save_file_name),
+                       writer)
 
 def save_impact_at_event(save_dir: Union[str, Path],
                         imp_summary_dict: dict,
-                        impact: Impact):
+                        impact: Impact,
+                        writer: AsyncWriter = None):
     """
     Save the impact of each event into a CSV file.
 
@@ -308,6 +901,10 @@ def save_impact_at_event(save_dir: Union[str, Path],
         Summary of the forecast.
 
     impact: climada.engine.Impact
+
+    writer: AsyncWriter
+        Writer for writing the file in the background.
+        Default: None (write synchronously)
     """
     
     at_event_dict = {'ensemble_id': [], 'at_event': []}
@@ -322,7 +919,7 @@ def save_impact_at_event(save_dir: Union[str, Path],
         f'impact-at-event_TC_ECMWF_ens_{imp_summary_dict["eventName"]}_{imp_summary_dict["initializationTime"]}'
         f'_{imp_summary_dict["countryISO3"]}_{imp_summary_dict["impactType"]}.csv'
         )
-    df.to_csv(save_dir +save_file_name)
+    return write_bytes(save_dir +save_file_name, df.to_csv().encode(), writer)
     
 
 def _check_event_no(impact: Impact):
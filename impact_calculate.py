@@ -14,23 +14,53 @@ import warnings
 warnings.filterwarnings("ignore")
 
 import os
-import glob
+import time
+import functools
 import numpy as np
 import pandas as pd
 
-from climada.hazard import Hazard
-from climada.engine import ImpactCalc
 from climada.util.coordinates import get_country_code, country_to_iso
 from climada.util.api_client import Client
 client = Client()
 
 from impact_calc_func import (
-    impf_set_exposed_pop, impf_set_displacement,
+    calc_country_impacts, calc_country_impacts_batched,
     round_to_previous_12h_utc, get_forecast_times,
-    get_tc_wind_files, summarize_forecast,
+    summarize_forecast, impact_min_intensity_per_type,
     save_forecast_summary, save_average_impact_geospatial_points,
-    save_impact_at_event
+    save_impact_at_event, save_lead_time_summary
     )
+from exceedance_func import (
+    wind_exceedance_products, impact_exceedance_products,
+    save_wind_exceedance, save_impact_exceedance
+)
+from raster_func import (
+    storm_raster_layers, write_raster, make_save_raster_file_name, RASTER_RES_DEG
+)
+from tiles_func import make_tile_pyramid, tile_pool
+from codec_func import read_hazard, read_hazard_codes
+from exposure_agg_func import get_exposure_agg, exposure_agg_on_hazard, LITPOP_PROPERTIES
+from writer_func import AsyncWriter, write_bytes, figure_to_bytes, written_files
+from catalog_func import (
+    get_storm_wind_files, get_lead_time_wind_files, register_outputs,
+    register_impact, register_ledger, register_run,
+    get_schedule, register_schedule, register_published, seconds_per_cost,
+    update_schedule_cost
+)
+from checkpoint_func import (
+    make_progress_ledger_file_name, load_progress_ledger,
+    record_progress, is_country_done, completed_summaries
+)
+from delta_func import (
+    hazard_footprint, footprint_changed, load_run_state, save_run_state,
+    carry_over_outputs, save_impact_points, load_impact_points, load_carried_impact,
+    make_change_table, save_change_table
+)
+from admin_agg_func import (
+    get_admin_index, aggregate_impact_admin, save_impact_admin
+)
+from basemap_func import set_tile_cache_dir
+from scheduler_func import schedule_order, country_priority, country_cost, predict_runtime
 from plot_func import (
     plot_imp_map_exposed, plot_imp_map_displacement,
     plot_histogram,
@@ -40,16 +70,79 @@ from plot_func import (
 # Save directories
 SAVE_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/output/{forecast_time_str}/"
 
-# get the wind files
-TC_WIND_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/tc_wind/" # change to a scratch folder
+# catalog of the runs, storms and output files, written by tc_windfield_compute.py and
+# then by this process only (the writer threads share a lock, see catalog_func)
+CATALOG_FILE = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/tc_catalog.sqlite"
 
 EXPOSED_TO_WIND_THRESHOLD = 32.92 # threshold for people exposed to wind in m/s
 
+IMPACT_TYPES = [f"exposed_population_{EXPOSED_TO_WIND_THRESHOLD}ms", "displacement"]
+
+# sub-national aggregation of the impacts
+ADMIN_LEVELS = [1, 2]
+ADMIN_BOUNDARIES_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/admin_boundaries/"
+ADMIN_INDEX_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/admin_index/"
+
+# gridded output of the wind and impact fields of each storm ('tif' or 'nc'), used for the maps
+RASTER_FILE_TYPE = 'tif'
+
+# bin the exposure points of the country into hexagons for the impact maps, with the
+# binning cached next to the exposure data, or draw the maps from the storm raster (True)
+MAP_FROM_RASTER = False
+HEXBIN_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/exposure_agg/"
+
+# basemap of the maps from the local tile store (filled by basemap_prefetch.py),
+# None fetches the tiles online
+BASEMAP_TILE_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/basemap_tiles/"
+
+# XYZ tile pyramid of the storm rasters for the web viewer
+TILE_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/output/tiles/"
+TILE_ZOOM_RANGE = (3, 10)
+
+# worker processes rendering the tiles, one pool for all storms of the run
+TILE_WORKERS = 4
+
+# background writer for the outputs on NFS
+WRITER_THREADS = 4
+WRITER_MAX_QUEUE = 64
+
+# only recompute the (storm, country) pairs whose hazard footprint changed since the previous run
+DELTA_MODE = True
+
+# compute the impacts of all affected countries of a storm at once, instead of one country at a time
+BATCH_COUNTRIES = True
+
+# floating point type of the hazard intensity, the exposure values and the impact
+# matrices (np.float32 halves their memory, see demo/validate_float32.py)
+IMPACT_DTYPE = np.float32
+
+# memory ceiling of the tiled computation for storms with very large extents,
+# None computes each storm at once
+MAX_MEMORY_GB = 8.
+
+# evaluate the displacement impact functions from fine lookup tables
+TABULATED_IMPF = True
+
+# compute the impacts on the integer intensity codes with lookup tables when the
+# tc_wind files hold them ('uint16', 'uint8', see INTENSITY_CODEC in tc_windfield_compute.py)
+QUANTIZED_IMPACT = True
+
+# LitPop population summed onto the wind field centroids once per country, and
+# joined to the hazard centroids by their coordinates instead of assign_centroids.
+# Opt-in: the impact points, maps and admin aggregates are then at the resolution
+# of the centroids instead of LitPop. The aggregates are saved in either case, to
+# rank the storms by their population (see tc_windfield_compute)
+PREAGGREGATE_EXPOSURES = False
+EXPOSURE_AGG_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/exposure_agg/"
+
+set_tile_cache_dir(BASEMAP_TILE_DIR)
+
 # Get the current timestamp
 current_timestamp = pd.Timestamp.now().tz_localize('UTC')
 
 forecast_time, previous_forecast_time = get_forecast_times(current_timestamp)
-forecast_time_str, tc_wind_files = get_tc_wind_files(forecast_time, previous_forecast_time, TC_WIND_DIR)
+forecast_time_str, tc_wind_files = get_storm_wind_files(CATALOG_FILE, forecast_time,
+                                                        previous_forecast_time)
 
 # stop running if there is no active storm.
 if not tc_wind_files:
@@ -57,16 +150,99 @@ if not tc_wind_files:
     print("End impact calculation script")
     exit()
 
+# state of the previous run, for the delta processing and the change table
+prev_forecast_time_str = (pd.to_datetime(forecast_time_str, format='%Y-%m-%d_%HUTC')
+                          - pd.Timedelta(hours=12)).strftime('%Y-%m-%d_%HUTC')
+prev_run_state = load_run_state(SAVE_DIR.format(forecast_time_str=prev_forecast_time_str),
+                                prev_forecast_time_str)
+run_state = {"storms": {}}
+
+# progress ledger of this run: a restart skips the completed (storm, country, impact type) units
+os.makedirs(SAVE_DIR.format(forecast_time_str=forecast_time_str), exist_ok=True)
+ledger_file = make_progress_ledger_file_name(SAVE_DIR.format(forecast_time_str=forecast_time_str),
+                                             forecast_time_str)
+ledger = load_progress_ledger(ledger_file)
+
+# work avoided by the pre-screen of the countries and members before loading the exposures
+n_screened_total = {"countries": 0, "pairs": 0}
+
+# forked before the writer starts its threads (see tiles_func.tile_pool)
+tile_executor = tile_pool(TILE_WORKERS)
+
+# all outputs are handed over to the background writer, flushed at the end of the run
+writer = AsyncWriter(n_threads=WRITER_THREADS, max_queue=WRITER_MAX_QUEUE)
+
+# the storms in the order of the wind stage: highest expected population near the
+# track first (see scheduler_func), storms missing from the wind schedule last. The
+# impact cost of a storm (exposure points times members of its countries, see
+# country_cost) is recorded once its exposures are loaded
+wind_schedule = get_schedule(CATALOG_FILE, forecast_time_str, 'wind').set_index('storm_name')
+storm_units = {tc_name: (float(wind_schedule.at[tc_name, 'priority']),
+                         float(wind_schedule.at[tc_name, 'cost']))
+               if tc_name in wind_schedule.index else (0., 0.)
+               for tc_name, _ in tc_wind_files}
+tc_wind_files = [(tc_name, dict(tc_wind_files)[tc_name])
+                 for tc_name in schedule_order(storm_units)]
+sec_per_cost = seconds_per_cost(CATALOG_FILE, 'impact')
+register_schedule(CATALOG_FILE, forecast_time_str, 'impact',
+                  [(tc_name, storm_units[tc_name][0], None, None)
+                   for tc_name, _ in tc_wind_files])
+
+def load_admin_indexes(exp, country_iso3: str) -> dict:
+    """Admin index (aggregation matrix, admin units) of a country per admin level."""
+    admin_indexes = {}
+    for admin_level in ADMIN_LEVELS:
+        try:
+            agg_mat, admin_units = get_admin_index(exp, country_iso3, admin_level,
+                                                   ADMIN_BOUNDARIES_DIR, ADMIN_INDEX_DIR)
+        except FileNotFoundError:
+            print(f"there is no admin{admin_level} boundary file for {country_iso3}")
+            continue
+        if admin_units.empty:
+            print(f"there are no admin{admin_level} units for {country_iso3}")
+            continue
+        admin_indexes[admin_level] = agg_mat, admin_units
+    return admin_indexes
+
+def save_impact_figures(imp_summary: dict, impact, raster_file: str,
+                        hexbin_dir: str = HEXBIN_DIR) -> list:
+    """Render and save the impact map and the histogram, returns the write futures."""
+    map_raster_file = raster_file if MAP_FROM_RASTER else None
+    if imp_summary["impactType"] == "displacement":
+        ax_map = plot_imp_map_displacement(imp_summary, impact, map_raster_file, hexbin_dir)
+    else:
+        ax_map = plot_imp_map_exposed(imp_summary, impact, map_raster_file, hexbin_dir)
+    ax_hist = plot_histogram(imp_summary, impact)
+    return [write_bytes(SAVE_DIR.format(forecast_time_str=forecast_time_str)
+                        + make_save_map_file_name(imp_summary),
+                        figure_to_bytes(ax_map.figure), writer),
+            write_bytes(SAVE_DIR.format(forecast_time_str=forecast_time_str)
+                        + make_save_histogram_file_name(imp_summary),
+                        figure_to_bytes(ax_hist.figure), writer)]
+
+def publish_storm(tc_name: str, time_start_storm: float):
+    """Record a storm of the impact stage as published, with its runtime."""
+    register_published(CATALOG_FILE, forecast_time_str, 'impact', tc_name,
+                       time.time() - time_start_storm)
+
 # Now start the impact calculation for all the storms
-for tc_file in tc_wind_files:
+for tc_name, tc_file in tc_wind_files:
 
+    time_start_storm = time.time()
 
-    # extract the tc_name from the hdf file
-    tc_base_file_name = os.path.basename(tc_file)
-    tc_name = tc_base_file_name.split('_')[2]
+    # read the hdf file, with the integer codes of the intensity if any
+    if QUANTIZED_IMPACT:
+        tc_haz, intensity_codes = read_hazard_codes(tc_file)
+    else:
+        tc_haz, intensity_codes = read_hazard(tc_file), None
 
-    # read the hdf file
-    tc_haz = Hazard.from_hdf5(tc_file)
+    # save the wind exceedance probabilities of the storm
+    storm_futures = [save_wind_exceedance(
+        SAVE_DIR.format(forecast_time_str=forecast_time_str),
+        tc_name,
+        forecast_time.strftime('%Y-%m-%d_%HUTC'),
+        wind_exceedance_products(tc_haz),
+        writer)]
 
     # get the country code where the wind speed >0
     idx_non_zero_wind = tc_haz.intensity.max(axis=0).nonzero()[1]
@@ -76,90 +252,319 @@ for tc_file in tc_wind_files:
                         )
     country_code_unique = np.trim_zeros(np.unique(country_code_all))
 
-    # now run impact for each country
+    # compare the hazard footprint in each country with the previous run
+    storm_state = run_state["storms"].setdefault(
+        tc_name, {"n_members": int(tc_haz.intensity.shape[0]), "countries": {}})
+    prev_storm_state = prev_run_state["storms"].get(tc_name, {"countries": {}})
+    country_code_unchanged = []
+    for country_code in country_code_unique:
+        country_iso3 = country_to_iso(country_code, "alpha3")
+        footprint = hazard_footprint(tc_haz, idx_non_zero_wind[country_code_all == country_code],
+                                     EXPOSED_TO_WIND_THRESHOLD)
+        prev_country_state = prev_storm_state["countries"].get(country_iso3)
+
+        # compared with the footprint of the run that computed the outputs
+        if DELTA_MODE and prev_country_state is not None \
+                and not footprint_changed(footprint, prev_country_state.get("footprint")):
+            carried_files = carry_over_outputs(SAVE_DIR.format(forecast_time_str=prev_forecast_time_str),
+                                               SAVE_DIR.format(forecast_time_str=forecast_time_str),
+                                               tc_name, country_iso3, prev_forecast_time_str,
+                                               forecast_time.strftime('%Y-%m-%d_%HUTC'))
+            storm_state["countries"][country_iso3] = {
+                "footprint": prev_country_state["footprint"], "carried_over": True,
+                "summaries": {impact_type: {**imp_summary,
+                                            "initializationTime": forecast_time.strftime('%Y-%m-%d_%HUTC')}
+                              for impact_type, imp_summary in prev_country_state["summaries"].items()}}
+            register_outputs(CATALOG_FILE, forecast_time_str, tc_name, carried_files, country_iso3)
+            for impact_type, imp_summary in storm_state["countries"][country_iso3]["summaries"].items():
+                register_impact(CATALOG_FILE, forecast_time_str, tc_name, country_iso3,
+                                impact_type, "carried_over", imp_summary)
+            country_code_unchanged.append(country_code)
+        else:
+            storm_state["countries"][country_iso3] = {"footprint": footprint, "summaries": {}}
+
+    print(f"{tc_name}: {len(country_code_unchanged)} of {len(country_code_unique)} "
+          f"countries unchanged since {prev_forecast_time_str}")
+
+    # countries completed before a restart of this run
+    country_code_done = []
     for country_code in country_code_unique:
+        country_iso3 = country_to_iso(country_code, "alpha3")
+        if country_code not in country_code_unchanged \
+                and is_country_done(ledger, tc_name, country_iso3, IMPACT_TYPES):
+            storm_state["countries"][country_iso3]["summaries"] = completed_summaries(
+                ledger, tc_name, country_iso3)
+            country_code_done.append(country_code)
 
+    if country_code_done:
+        print(f"{tc_name}: {len(country_code_done)} countries already completed, skipping them")
+
+    # pre-screen: the impact types are computed in order and stop at the first zero
+    # impact, so a country whose wind stays below the smallest intensity with a
+    # non-zero impact of the first type gives zero impact, without any exposure
+    country_code_screened = []
+    n_pairs, n_pairs_screened = 0, 0
+    for country_code in country_code_unique:
+        if country_code in country_code_unchanged or country_code in country_code_done:
+            continue
         country_iso3 = country_to_iso(country_code, "alpha3")
+        min_intensity = impact_min_intensity_per_type(country_iso3, EXPOSED_TO_WIND_THRESHOLD)
+        max_wind_member = tc_haz.intensity[
+            :, idx_non_zero_wind[country_code_all == country_code]].max(axis=1).toarray().ravel()
+        n_members_reached = np.count_nonzero(max_wind_member >= min_intensity[IMPACT_TYPES[0]])
+        n_pairs += max_wind_member.size
+        n_pairs_screened += max_wind_member.size - n_members_reached
+
+        if n_members_reached == 0:
+            record_progress(ledger_file, ledger, tc_name, country_iso3, IMPACT_TYPES[0], "zero")
+            for impact_type in IMPACT_TYPES[1:]:
+                record_progress(ledger_file, ledger, tc_name, country_iso3, impact_type, "skipped")
+            country_code_screened.append(country_code)
+
+    n_screened_total["countries"] += len(country_code_screened)
+    n_screened_total["pairs"] += n_pairs_screened
+    print(f"{tc_name}: pre-screen skipped {len(country_code_screened)} countries and "
+          f"{n_pairs_screened} of {n_pairs} (country, member) pairs below the impact thresholds")
+
+    # retrieve the exposures of each country
+    exp_per_country = {}
+    for country_code in country_code_unique:
+        if country_code in country_code_unchanged or country_code in country_code_done \
+                or country_code in country_code_screened:
+            continue
         try:
-            exp = client.get_exposures(exposures_type='litpop',
+            if PREAGGREGATE_EXPOSURES:
+                exp_agg, value_unit = get_exposure_agg(client, country_code,
+                                                       country_to_iso(country_code, "alpha3"),
+                                                       EXPOSURE_AGG_DIR)
+                exp_per_country[country_code] = exposure_agg_on_hazard(exp_agg, value_unit, tc_haz)
+            else:
+                exp_per_country[country_code] = client.get_exposures(
+                                    exposures_type='litpop',
                                     properties={'country_iso3num':[str(country_code).zfill(3)],
-                                                'exponents':'(0,1)',
-                                                'fin_mode':'pop',
-                                                'version':'v2'
-                                                }
+                                                **LITPOP_PROPERTIES}
                                     )
+                get_exposure_agg(client, country_code, country_to_iso(country_code, "alpha3"),
+                                 EXPOSURE_AGG_DIR, exp=exp_per_country[country_code])
         except client.NoResult:
             print(f"there is no matching dataset in Data API. Country code: {country_code}")
+            for impact_type in IMPACT_TYPES:
+                record_progress(ledger_file, ledger, tc_name, country_to_iso(country_code, "alpha3"),
+                                impact_type, "no_exposure")
             continue
 
-        # run impact calc for people exposed to cat. 1 wind speed or above
-        impf_exposed = impf_set_exposed_pop(threshold=EXPOSED_TO_WIND_THRESHOLD)
+    # centroids of the LitPop exposures, assigned once for the priority and the impacts
+    # (the pre-aggregated exposures come with them)
+    for exp in exp_per_country.values():
+        if 'centr_TC' not in exp.gdf.columns:
+            exp.assign_centroids(tc_haz)
 
-        impact_exposed = ImpactCalc(exp, impf_exposed, tc_haz).impact()
+    # the most exposed countries first, so that their outputs are queued first
+    exp_per_country = dict(sorted(
+        exp_per_country.items(),
+        key=lambda item: -country_priority(item[1], tc_haz, EXPOSED_TO_WIND_THRESHOLD)))
+    storm_cost_impact = sum(country_cost(exp, tc_haz) for exp in exp_per_country.values())
+    predicted = predict_runtime(storm_cost_impact, sec_per_cost)
+    update_schedule_cost(CATALOG_FILE, forecast_time_str, 'impact', tc_name,
+                         storm_cost_impact, predicted)
+    print(f"{tc_name}: {len(exp_per_country)} countries to compute, predicted runtime "
+          f"{'n/a' if predicted is None else f'{predicted:.1f} s'}")
 
-        if impact_exposed.aai_agg == 0.: # do not save the files if impact is 0.
-            continue
+    # run impact calc for people exposed to cat. 1 wind speed or above, and displacement
+    if not exp_per_country:
+        impacts_per_country = {}
+    elif BATCH_COUNTRIES:
+        impacts_per_country = calc_country_impacts_batched(exp_per_country, tc_haz,
+                                                           EXPOSED_TO_WIND_THRESHOLD,
+                                                           IMPACT_DTYPE, MAX_MEMORY_GB,
+                                                           TABULATED_IMPF, intensity_codes)
+    else:
+        impacts_per_country = {
+            country_code: calc_country_impacts(exp, country_to_iso(country_code, "alpha3"),
+                                               tc_haz, EXPOSED_TO_WIND_THRESHOLD,
+                                               IMPACT_DTYPE, TABULATED_IMPF, intensity_codes)
+            for country_code, exp in exp_per_country.items()
+        }
 
-        imp_exposed_summary = summarize_forecast(country_iso3=country_to_iso(country_code, 
-                                                                     "alpha3"),
-                                        forecast_time=forecast_time.strftime('%Y-%m-%d_%HUTC'),
-                                        impact_type="exposed_population_32.92ms",
-                                        tc_haz=tc_haz,
-                                        tc_name=tc_name,
-                                        impact=impact_exposed)
- 
-        save_forecast_summary(
-            SAVE_DIR.format(forecast_time_str=forecast_time_str),
-            imp_exposed_summary)
-        save_average_impact_geospatial_points(
-            SAVE_DIR.format(forecast_time_str=forecast_time_str),
-            imp_exposed_summary,
-            impact_exposed)
-        save_impact_at_event(
-            SAVE_DIR.format(forecast_time_str=forecast_time_str),
-            imp_exposed_summary,
-            impact_exposed)
-        
-        # save the impact map
-        ax_map_exposed = plot_imp_map_exposed(imp_exposed_summary, impact_exposed)
-        ax_map_exposed.figure.savefig(SAVE_DIR.format(forecast_time_str=forecast_time_str) +make_save_map_file_name(imp_exposed_summary))
-
-        # save the histogram
-        ax_hist_exposed = plot_histogram(imp_exposed_summary, impact_exposed)
-        ax_hist_exposed.figure.savefig(SAVE_DIR.format(forecast_time_str=forecast_time_str) +make_save_histogram_file_name(imp_exposed_summary))
-
-        # run the same impact calc but for displacement
-        impf_displacement = impf_set_displacement(country_iso3)
-
-        impact_displacement = ImpactCalc(exp, impf_displacement, tc_haz).impact()
-
-        if impact_displacement.aai_agg == 0.: # do not save the files if impact is 0.
-            continue
-        imp_displacement_summary = summarize_forecast(country_iso3=country_to_iso(country_code, 
-                                                                     "alpha3"),
-                                                    forecast_time=forecast_time.strftime('%Y-%m-%d_%HUTC'),
-                                                    impact_type="displacement",
-                                                    tc_haz=tc_haz,
-                                                    tc_name=tc_name,
-                                                    impact=impact_displacement)
-
-        save_forecast_summary(
-            SAVE_DIR.format(forecast_time_str=forecast_time_str),
-            imp_displacement_summary)
-        
-        save_average_impact_geospatial_points(
-            SAVE_DIR.format(forecast_time_str=forecast_time_str),
-            imp_displacement_summary,
-            impact_displacement)
-        save_impact_at_event(
-            SAVE_DIR.format(forecast_time_str=forecast_time_str),
-            imp_displacement_summary,
-            impact_displacement)
-        
-        # save the impact map
-        ax_map_displacement = plot_imp_map_displacement(imp_displacement_summary, impact_displacement)
-        ax_map_displacement.figure.savefig(SAVE_DIR.format(forecast_time_str=forecast_time_str) +make_save_map_file_name(imp_displacement_summary))
-
-        # save the histogram
-        ax_hist_displacement = plot_histogram(imp_displacement_summary, impact_displacement)
-        ax_hist_displacement.figure.savefig(SAVE_DIR.format(forecast_time_str=forecast_time_str) +make_save_histogram_file_name(imp_displacement_summary))
\ No newline at end of file
+    # impacts up to each lead-time checkpoint, from the cumulative maximum wind fields
+    # (same centroids as the storm hazard, so the assigned exposures are reused)
+    lead_time_rows = []
+    for lead_time_h, lead_file in get_lead_time_wind_files(CATALOG_FILE, forecast_time_str,
+                                                           tc_name).items():
+        if not exp_per_country:
+            break
+        if QUANTIZED_IMPACT:
+            tc_haz_lead, lead_codes = read_hazard_codes(lead_file)
+        else:
+            tc_haz_lead, lead_codes = read_hazard(lead_file), None
+        impacts_lead = calc_country_impacts_batched(exp_per_country, tc_haz_lead,
+                                                    EXPOSED_TO_WIND_THRESHOLD,
+                                                    IMPACT_DTYPE, MAX_MEMORY_GB,
+                                                    TABULATED_IMPF, lead_codes)
+        for country_code, impacts in impacts_lead.items():
+            for impact_type, impact in impacts.items():
+                imp_summary = summarize_forecast(country_iso3=country_to_iso(country_code, "alpha3"),
+                                                 forecast_time=forecast_time.strftime('%Y-%m-%d_%HUTC'),
+                                                 impact_type=impact_type,
+                                                 tc_haz=tc_haz_lead,
+                                                 tc_name=tc_name,
+                                                 impact=impact)
+                imp_summary["leadTimeHours"] = lead_time_h
+                lead_time_rows.append(imp_summary)
+    if lead_time_rows:
+        storm_futures.append(save_lead_time_summary(SAVE_DIR.format(forecast_time_str=forecast_time_str),
+                               tc_name,
+                               forecast_time.strftime('%Y-%m-%d_%HUTC'),
+                               pd.DataFrame(lead_time_rows),
+                               writer))
+
+    # write the storm raster with the ensemble mean wind, wind exceedance and mean impacts
+    impact_points = {}
+    for impacts in impacts_per_country.values():
+        for impact_type, impact in impacts.items():
+            impact_points.setdefault(impact_type, []).append((impact.coord_exp, impact.eai_exp))
+    for country_code in country_code_unchanged + country_code_done:
+        country_iso3 = country_to_iso(country_code, "alpha3")
+        for impact_type in storm_state["countries"][country_iso3]["summaries"]:
+            impact_points.setdefault(impact_type, []).append(load_impact_points(
+                SAVE_DIR.format(forecast_time_str=forecast_time_str), tc_name,
+                forecast_time.strftime('%Y-%m-%d_%HUTC'), country_iso3, impact_type))
+    raster_layers, (west, north, _, _) = storm_raster_layers(tc_haz, impact_points)
+    raster_file = SAVE_DIR.format(forecast_time_str=forecast_time_str) + make_save_raster_file_name(
+        tc_name, forecast_time.strftime('%Y-%m-%d_%HUTC'), RASTER_FILE_TYPE)
+    raster_future = write_raster(raster_file, raster_layers, west, north, RASTER_RES_DEG, writer)
+    storm_futures.append(raster_future)
+    writer.on_complete(storm_futures, functools.partial(
+        register_outputs, CATALOG_FILE, forecast_time_str, tc_name, written_files(storm_futures)))
+    storm_all_futures = list(storm_futures)
+
+    # the tiles and the maps read the raster
+    raster_future.result()
+
+    # the maps and histograms of the carried-over countries show the forecast time, re-render them;
+    # their impact has the impact points only, not the exposure of the country, so their hexbin
+    # is not written to the file cache of the country (see delta_func.load_carried_impact)
+    for country_code in country_code_unchanged:
+        country_iso3 = country_to_iso(country_code, "alpha3")
+        carried_futures = []
+        for imp_summary in storm_state["countries"][country_iso3]["summaries"].values():
+            carried_futures += save_impact_figures(
+                imp_summary,
+                load_carried_impact(SAVE_DIR.format(forecast_time_str=forecast_time_str), imp_summary),
+                raster_file, hexbin_dir=None)
+        writer.on_complete(carried_futures, functools.partial(
+            register_outputs, CATALOG_FILE, forecast_time_str, tc_name,
+            written_files(carried_futures), country_iso3))
+        storm_all_futures += carried_futures
+
+    tile_stats = make_tile_pyramid(raster_file, list(raster_layers),
+                                   os.path.join(TILE_DIR, tc_name), TILE_ZOOM_RANGE,
+                                   writer=writer, executor=tile_executor)
+    print(f"Tiles of {tc_name}: {tile_stats['written']} written, "
+          f"{tile_stats['reused']} unchanged, {tile_stats['empty']} empty")
+
+    # now save the outputs for each country
+    for country_code, impacts in impacts_per_country.items():
+
+        country_iso3 = country_to_iso(country_code, "alpha3")
+
+        # admin indexes of the country, loaded once for all impact types
+        admin_indexes = None
+
+        # exposed population first: if nobody is exposed, there is no displacement either
+        for idx_type, (impact_type, impact) in enumerate(impacts.items()):
+
+            # saved before a restart of this run
+            if (tc_name, country_iso3, impact_type) in ledger:
+                storm_state["countries"][country_iso3]["summaries"][impact_type] = \
+                    ledger[(tc_name, country_iso3, impact_type)]["summary"]
+                continue
+
+            if impact.aai_agg == 0.: # do not save the files if impact is 0.
+                record_progress(ledger_file, ledger, tc_name, country_iso3, impact_type, "zero")
+                for impact_type_skipped in list(impacts)[idx_type + 1:]:
+                    record_progress(ledger_file, ledger, tc_name, country_iso3,
+                                    impact_type_skipped, "skipped")
+                break
+
+            imp_summary = summarize_forecast(country_iso3=country_iso3,
+                                             forecast_time=forecast_time.strftime('%Y-%m-%d_%HUTC'),
+                                             impact_type=impact_type,
+                                             tc_haz=tc_haz,
+                                             tc_name=tc_name,
+                                             impact=impact)
+
+            save_futures = [
+                save_forecast_summary(
+                    SAVE_DIR.format(forecast_time_str=forecast_time_str),
+                    imp_summary,
+                    writer),
+                save_average_impact_geospatial_points(
+                    SAVE_DIR.format(forecast_time_str=forecast_time_str),
+                    imp_summary,
+                    impact,
+                    writer=writer),
+                save_impact_at_event(
+                    SAVE_DIR.format(forecast_time_str=forecast_time_str),
+                    imp_summary,
+                    impact,
+                    writer),
+                save_impact_points(
+                    SAVE_DIR.format(forecast_time_str=forecast_time_str),
+                    imp_summary,
+                    impact,
+                    writer),
+                save_impact_exceedance(
+                    SAVE_DIR.format(forecast_time_str=forecast_time_str),
+                    imp_summary,
+                    impact_exceedance_products(impact),
+                    writer)
+            ]
+            storm_state["countries"][country_iso3]["summaries"][impact_type] = imp_summary
+
+            # save the impact per admin unit
+            if admin_indexes is None:
+                admin_indexes = load_admin_indexes(exp_per_country[country_code], country_iso3)
+            for admin_level, (agg_mat, admin_units) in admin_indexes.items():
+                save_futures.append(save_impact_admin(
+                    SAVE_DIR.format(forecast_time_str=forecast_time_str),
+                    imp_summary,
+                    aggregate_impact_admin(impact, agg_mat, admin_units),
+                    admin_level,
+                    writer))
+
+            # save the impact map and the histogram
+            save_futures += save_impact_figures(imp_summary, impact, raster_file)
+
+            # the unit is completed once all its outputs are written
+            writer.on_complete(save_futures, functools.partial(
+                record_progress, ledger_file, ledger, tc_name, country_iso3, impact_type,
+                "saved", imp_summary))
+            writer.on_complete(save_futures, functools.partial(
+                register_outputs, CATALOG_FILE, forecast_time_str, tc_name,
+                written_files(save_futures), country_iso3, impact_type))
+            storm_all_futures += save_futures
+
+    # the storm is published once all its outputs are written
+    writer.on_complete(storm_all_futures, functools.partial(publish_storm, tc_name, time_start_storm))
+
+tile_executor.shutdown()
+
+# wait for the background writes: the run state is only saved once all outputs are written
+writer.flush()
+
+print(f"Pre-screen: {n_screened_total['countries']} countries without exposure loading and "
+      f"{n_screened_total['pairs']} (country, member) pairs skipped in the impact calculation")
+
+# save the run state and the change since the previous forecast
+save_run_state(SAVE_DIR.format(forecast_time_str=forecast_time_str), forecast_time_str, run_state,
+               writer)
+save_change_table(SAVE_DIR.format(forecast_time_str=forecast_time_str),
+                  forecast_time.strftime('%Y-%m-%d_%HUTC'),
+                  make_change_table(run_state, prev_run_state),
+                  writer)
+writer.close()
+
+# status and summary statistics of all units of this run in the catalog
+register_ledger(CATALOG_FILE, forecast_time_str, ledger)
+register_run(CATALOG_FILE, forecast_time_str, 'impact')
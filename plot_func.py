@@ -20,13 +20,15 @@ from matplotlib.lines import Line2D
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import cartopy.crs as ccrs
 import cartopy.feature as cf
-import contextily as ctx
 import plotly.graph_objects as go
 
 from climada.hazard import TCTracks
 from climada.engine import Impact
 import climada.util.coordinates as u_coord
 
+from basemap_func import add_basemap
+from hexbin_func import get_country_hexbin, hexbin_values, HEXBIN_GRIDSIZE
+
 SAFFIR_SIM_CAT = [17.49, 32.92, 42.7, 49.39, 58.13, 70.48, 1000]
 
 CAT_NAMES = {
@@ -272,52 +274,116 @@ def make_save_histogram_file_name(imp_summary_dict: dict):
         )
     return forecast_filename
 
-def plot_imp_map_exposed(impact_summary_dict: dict,
-                         impact: Impact):
-    """Plot the ensemble average map for exposed population"""
-
-    impact_exp = impact._build_exp()
-
-    extent = impact_exp.gdf.geometry.to_crs(epsg=3857).total_bounds
-    impact_exp.to_crs("EPSG:3857", inplace=True)
-    gdf = impact_exp.gdf
-
+def _transparent_cmap(vmax: float, threshold: float = 10):
+    """Colormap where values below the threshold are transparent"""
     cmap = plt.get_cmap("YlOrBr")
     n = 256  # Number of discrete colors in the colormap
     vals = cmap(np.linspace(0, 1, n))
     vals[:, -1] = np.linspace(0.0, 1.0, n)  # Gradual transparency
 
-    # Make values below 10 transparent
-    threshold = 10
+    # Make values below the threshold transparent
     alphas = np.ones(n)
-    alphas[:int(threshold / np.max(gdf["value"]) * n)] = 0.0
+    alphas[:int(threshold / vmax * n)] = 0.0
     vals[:, -1] = alphas
 
-    transparent_cmap = ListedColormap(vals)
+    return ListedColormap(vals)
+
+def _raster_window_max(grid: np.ndarray, extent: tuple, west: float, east: float,
+                       south: float, north: float) -> float:
+    """Maximum of a north-up grid with extent (west, east, south, north) within a window."""
+    n_rows, n_cols = grid.shape
+    res_x = (extent[1] - extent[0]) / n_cols
+    res_y = (extent[3] - extent[2]) / n_rows
+    col0 = int(np.clip(np.floor((west - extent[0]) / res_x), 0, n_cols - 1))
+    col1 = int(np.clip(np.floor((east - extent[0]) / res_x), 0, n_cols - 1))
+    row0 = int(np.clip(np.floor((extent[3] - north) / res_y), 0, n_rows - 1))
+    row1 = int(np.clip(np.floor((extent[3] - south) / res_y), 0, n_rows - 1))
+    window = grid[row0:row1 + 1, col0:col1 + 1]
+    return float(np.nanmax(window)) if np.isfinite(window).any() else np.nan
+
+def _plot_imp_map(impact: Impact,
+                  raster_file: Union[str, Path] = None,
+                  raster_layer: str = None,
+                  country_iso3: str = None,
+                  hexbin_dir: Union[str, Path] = None):
+    """
+    Plot the ensemble average impact on a basemap, either binned from the
+    exposure points (hexbin) or drawn from the storm raster (see raster_func).
+    The hexbin of the exposure points of a country is computed once and
+    cached (see hexbin_func), in hexbin_dir if given.
+    """
+    threshold = 10
 
     fig, ax = plt.subplots()
 
-    vmax = np.max(gdf["value"])
-    vmin = threshold  # Start normalization from threshold
-
-    norm = Normalize(vmin=vmin, vmax=vmax)
-
-    hb = ax.hexbin(
-        x=gdf.geometry.x,
-        y=gdf.geometry.y,
-        C=gdf["value"],
-        reduce_C_function=np.sum,
-        norm=norm,
-        gridsize=200,
-        extent=(extent[0], extent[2], extent[1], extent[3]),
-        lw=0.0,
-        cmap=transparent_cmap,
-    )
+    if raster_file is None:
+        hexbin = get_country_hexbin(impact.coord_exp, country_iso3, hexbin_dir, HEXBIN_GRIDSIZE)
+
+        vmax = np.max(impact.eai_exp)
+        norm = Normalize(vmin=threshold, vmax=vmax) # Start normalization from threshold
+
+        # one point per occupied hexagon, at its centre, with the sum of its points
+        mappable = ax.hexbin(
+            x=hexbin["cell_x"],
+            y=hexbin["cell_y"],
+            C=hexbin_values(hexbin, impact.eai_exp),
+            reduce_C_function=np.sum,
+            norm=norm,
+            gridsize=hexbin["gridsize"],
+            extent=tuple(hexbin["extent"]),
+            lw=0.0,
+            cmap=_transparent_cmap(vmax, threshold),
+        )
 
-    ctx.add_basemap(ax, source=ctx.providers.CartoDB.Positron)
+        add_basemap(ax)
+
+    else:
+        # rasterio is only needed for the maps drawn from the raster
+        from raster_func import read_raster_layer, unwrap_lon
+        grid, raster_extent = read_raster_layer(raster_file, raster_layer)
+
+        # the raster covers the whole storm, zoom to the exposure of the country and
+        # scale the colours to the cells of the country window only, as the hexbin
+        lat, lon = impact.coord_exp[:, 0], unwrap_lon(impact.coord_exp[:, 1])
+        # raster and exposure on the same side of the antimeridian
+        shift = 360. * np.round(((lon.min() + lon.max()) - (raster_extent[0] + raster_extent[1]))
+                                / 2. / 360.)
+        raster_extent = (raster_extent[0] + shift, raster_extent[1] + shift,
+                         raster_extent[2], raster_extent[3])
+        vmax = _raster_window_max(grid, raster_extent, lon.min(), lon.max(),
+                                  lat.min(), lat.max())
+        norm = Normalize(vmin=threshold, vmax=vmax)
+
+        mappable = ax.imshow(
+            grid,
+            extent=raster_extent,
+            origin="upper",
+            norm=norm,
+            interpolation="nearest",
+            cmap=_transparent_cmap(vmax, threshold),
+        )
+        ax.set_xlim(lon.min(), lon.max())
+        ax.set_ylim(lat.min(), lat.max())
+
+        add_basemap(ax, crs="EPSG:4326")
 
     ax.tick_params(left=False, labelleft=False, bottom=False, labelbottom=False)
 
+    return ax, mappable
+
+def plot_imp_map_exposed(impact_summary_dict: dict,
+                         impact: Impact,
+                         raster_file: Union[str, Path] = None,
+                         hexbin_dir: Union[str, Path] = None):
+    """
+    Plot the ensemble average map for exposed population. If a raster file
+    of the storm is given, the map is drawn from it instead of the points.
+    """
+
+    ax, hb = _plot_imp_map(impact, raster_file,
+                           f'{impact_summary_dict["impactType"]}_mean',
+                           impact_summary_dict["countryISO3"], hexbin_dir)
+
     plt.colorbar(hb, ax=ax, label="Ensemble Avg. Exposed People", extend='min')
 
     # Main title
@@ -345,50 +411,17 @@ def plot_imp_map_exposed(impact_summary_dict: dict,
     return ax
 
 def plot_imp_map_displacement(impact_summary_dict: dict,
-                              impact: Impact):
-    """Plot the ensemble average map for displacement"""
-
-    impact_exp = impact._build_exp()
-
-    extent = impact_exp.gdf.geometry.to_crs(epsg=3857).total_bounds
-    impact_exp.to_crs("EPSG:3857", inplace=True)
-    gdf = impact_exp.gdf
-
-    cmap = plt.get_cmap("YlOrBr")
-    n = 256  # Number of discrete colors in the colormap
-    vals = cmap(np.linspace(0, 1, n))
-    vals[:, -1] = np.linspace(0.0, 1.0, n)  # Gradual transparency
-
-    # Make values below 10 transparent
-    threshold = 10
-    alphas = np.ones(n)
-    alphas[:int(threshold / np.max(gdf["value"]) * n)] = 0.0
-    vals[:, -1] = alphas
-
-    transparent_cmap = ListedColormap(vals)
-
-    fig, ax = plt.subplots()
-
-    vmax = np.max(gdf["value"])
-    vmin = threshold  # Start normalization from threshold
-
-    norm = Normalize(vmin=vmin, vmax=vmax)
-
-    hb = ax.hexbin(
-        x=gdf.geometry.x,
-        y=gdf.geometry.y,
-        C=gdf["value"],
-        reduce_C_function=np.sum,
-        norm=norm,
-        gridsize=200,
-        extent=(extent[0], extent[2], extent[1], extent[3]),
-        lw=0.0,
-        cmap=transparent_cmap,
-    )
-
-    ctx.add_basemap(ax, source=ctx.providers.CartoDB.Positron)
+                              impact: Impact,
+                              raster_file: Union[str, Path] = None,
+                              hexbin_dir: Union[str, Path] = None):
+    """
+    Plot the ensemble average map for displacement. If a raster file
+    of the storm is given, the map is drawn from it instead of the points.
+    """
 
-    ax.tick_params(left=False, labelleft=False, bottom=False, labelbottom=False)
+    ax, hb = _plot_imp_map(impact, raster_file,
+                           f'{impact_summary_dict["impactType"]}_mean',
+                           impact_summary_dict["countryISO3"], hexbin_dir)
 
     plt.colorbar(hb, ax=ax, label="Ensemble Avg. Displacement", extend='min')
 
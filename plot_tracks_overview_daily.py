@@ -21,26 +21,26 @@ import matplotlib as mpl
 import matplotlib.cm as cm_mp
 from matplotlib.colors import BoundaryNorm, ListedColormap
 
-from climada_petals.hazard import TCForecast
 from climada.hazard import TCTracks
 
-from tc_tracks_func import filter_storm, _correct_max_sustained_wind_speed
+from tc_tracks_func import get_forecast_tracks, format_run_datetime
 from plot_func import (
     plot_global_tracks, plot_empty_base_map, 
     plot_interactive_map, plot_empty_interactive_map
 )
 SAVE_FIG_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/output/{forecast_time}/"
 
-tr_fcast = TCForecast()
-tr_fcast.fetch_ecmwf()
-tr_filter = filter_storm(tr_fcast)
+TRACK_CACHE_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/tc_tracks/" # shared with the wind field computation
+
+# BUFR files of each run, downloaded concurrently (shared with the wind field computation)
+BUFR_CACHE_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/bufr/"
+
+# retrieve the latest forecast (filtered and wind-corrected) from the track cache
+tr_filter, run_datetime = get_forecast_tracks(TRACK_CACHE_DIR, bufr_cache_dir=BUFR_CACHE_DIR)
 tr_filter.equal_timestep(3.)
-_correct_max_sustained_wind_speed(tr_filter)
 
 # extract datetime information
-run_datetime = tr_fcast.data[0].run_datetime
-datetime_temp = run_datetime.astype('datetime64[s]').astype(str)
-formatted_datetime = datetime_temp.replace('T', '_')[:-6] + 'UTC'
+formatted_datetime = format_run_datetime(run_datetime)
 
 # create directory to store the figure
 if not os.path.exists(SAVE_FIG_DIR.format(forecast_time=formatted_datetime)):
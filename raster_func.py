@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for gridded (raster) outputs of the ensemble forecast.
+
+Points (centroids or exposure points) are scattered onto a regular lat/lon
+grid with index arithmetic and written into compressed, tiled GeoTIFF or
+NetCDF files, which are much smaller and faster to load than point GeoJSON.
+The longitudes of a storm are unwrapped around their circular mean, so a
+storm across the antimeridian gets a grid across it (e.g. from 170 to 190)
+instead of one around the globe.
+
+@author: Pui Man (Mannie) Kam
+"""
+import numpy as np
+import xarray as xr
+import rasterio
+from rasterio.transform import from_origin
+from typing import Union, Dict, List, Tuple
+from pathlib import Path
+
+from climada.hazard import Hazard
+
+from exceedance_func import exceedance_probability, KN_TO_MS, WIND_THRESHOLDS_KT, N_ENSEMBLE
+from tiling_func import wrap_lon
+from writer_func import AsyncWriter, write_bytes, file_to_bytes
+
+# resolution of the land centroids (150 arcsec)
+RASTER_RES_DEG = 150 / 3600
+
+# block size of the tiled GeoTIFF and chunk size of the NetCDF
+RASTER_BLOCK_SIZE = 256
+
+def unwrap_lon(lon: np.ndarray) -> np.ndarray:
+    """
+    Longitudes within 180 degree of their circular mean, so that points
+    across the antimeridian are contiguous (e.g. 179 and 181 instead of -179).
+    """
+    lon_rad = np.radians(lon)
+    lon_mid = np.degrees(np.arctan2(np.sin(lon_rad).mean(), np.cos(lon_rad).mean()))
+    return lon_mid + wrap_lon(np.asarray(lon) - lon_mid)
+
+def grid_bounds(lat: np.ndarray, lon: np.ndarray,
+                res: float = RASTER_RES_DEG) -> Tuple[float, float, int, int]:
+    """
+    Bounds of the regular grid that covers all points, aligned to the
+    resolution. The longitudes are unwrapped (see unwrap_lon), so the west
+    edge can be below -180 or the east edge above 180.
+
+    Returns
+    -------
+    west, north : float
+        Coordinates of the upper left corner of the grid.
+    n_rows, n_cols : int
+        Shape of the grid.
+    """
+    lon = unwrap_lon(lon)
+    west = np.floor(np.min(lon) / res) * res
+    north = np.ceil(np.max(lat) / res) * res
+    # points on the east and south edge are in the last column and row
+    n_cols = int(np.floor((np.max(lon) - west) / res + 1e-9)) + 1
+    n_rows = int(np.floor((north - np.min(lat)) / res + 1e-9)) + 1
+    return west, north, n_rows, n_cols
+
+def points_to_grid(lat: np.ndarray, lon: np.ndarray, values: np.ndarray,
+                   west: float, north: float, n_rows: int, n_cols: int,
+                   res: float = RASTER_RES_DEG,
+                   reduce: str = 'sum') -> np.ndarray:
+    """
+    Scatter point values onto a regular grid. Cells without points are NaN.
+
+    Parameters
+    ----------
+    lat, lon, values : np.ndarray
+        Coordinates and values of the points.
+    west, north, n_rows, n_cols : float, float, int, int
+        Grid definition, see grid_bounds.
+    res : float
+        Grid resolution in degree. Default: 150 arcsec
+    reduce : str
+        How points within the same cell are combined: 'sum' (e.g. population),
+        'mean' or 'max' (e.g. wind speed). Default: 'sum'
+
+    Returns
+    -------
+    grid : np.ndarray
+        Gridded values (n_rows x n_cols), north up.
+    """
+    row = np.clip(np.floor((north - lat) / res).astype(int), 0, n_rows - 1)
+    # longitudes within 180 degree of the middle of the grid, for grids across the antimeridian
+    lon_mid = west + n_cols * res / 2
+    col = np.clip(np.floor((lon_mid + wrap_lon(lon - lon_mid) - west) / res).astype(int),
+                  0, n_cols - 1)
+    cell = row * n_cols + col
+
+    counts = np.bincount(cell, minlength=n_rows * n_cols)
+    if reduce == 'max':
+        grid = np.full(n_rows * n_cols, -np.inf)
+        np.maximum.at(grid, cell, values)
+    else:
+        grid = np.bincount(cell, weights=values, minlength=n_rows * n_cols)
+        if reduce == 'mean':
+            grid = grid / np.fmax(counts, 1)
+    grid[counts == 0] = np.nan
+
+    return grid.reshape(n_rows, n_cols)
+
+def storm_raster_layers(tc_haz: Hazard,
+                        impact_points: Dict[str, List[Tuple[np.ndarray, np.ndarray]]],
+                        res: float = RASTER_RES_DEG,
+                        thresholds_kt: List[float] = WIND_THRESHOLDS_KT,
+                        n_members: int = N_ENSEMBLE):
+    """
+    Raster layers of a storm: ensemble mean wind, wind exceedance probabilities
+    and the ensemble mean impact of each impact type.
+
+    Parameters
+    ----------
+    tc_haz : climada.hazard.Hazard
+        Wind field of all ensemble members of the storm.
+    impact_points : Dict[str, List[Tuple[np.ndarray, np.ndarray]]]
+        Per impact type, a list (one per country) of the exposure coordinates
+        (impact.coord_exp) and the ensemble mean impact (impact.eai_exp).
+    res : float
+        Grid resolution in degree. Default: 150 arcsec
+    thresholds_kt : List[float]
+        Wind speed thresholds in knots. Default: 34, 50 and 64 kt
+    n_members : int
+        Number of ensemble members of the forecast, members missing from the
+        hazard count as no wind (as in the other ensemble products).
+        Default: 51
+
+    Returns
+    -------
+    layers : Dict[str, np.ndarray]
+        Gridded layer per name.
+    grid : Tuple[float, float, int, int]
+        Grid definition (west, north, n_rows, n_cols).
+    """
+    lat_all = [tc_haz.centroids.lat] + [coord[:, 0] for points in impact_points.values()
+                                        for coord, _ in points]
+    lon_all = [tc_haz.centroids.lon] + [coord[:, 1] for points in impact_points.values()
+                                        for coord, _ in points]
+    grid = grid_bounds(np.concatenate(lat_all), np.concatenate(lon_all), res)
+
+    n_members = max(n_members, tc_haz.intensity.shape[0], 1)
+    wind_mean = np.asarray(tc_haz.intensity.sum(axis=0)).ravel() / n_members
+    wind_prob = exceedance_probability(tc_haz.intensity, np.asarray(thresholds_kt) * KN_TO_MS,
+                                       n_members=n_members)
+
+    layers = {'wind_mean': points_to_grid(tc_haz.centroids.lat, tc_haz.centroids.lon,
+                                          wind_mean, *grid, res=res, reduce='max')}
+    for thres, prob_thres in zip(sorted(thresholds_kt), wind_prob):
+        layers[f'prob_{thres}kt'] = points_to_grid(tc_haz.centroids.lat, tc_haz.centroids.lon,
+                                                   prob_thres, *grid, res=res, reduce='max')
+
+    for impact_type, points in impact_points.items():
+        if not points:
+            continue
+        coord = np.concatenate([coord for coord, _ in points])
+        values = np.concatenate([values for _, values in points])
+        layers[f'{impact_type}_mean'] = points_to_grid(coord[:, 0], coord[:, 1], values,
+                                                       *grid, res=res, reduce='sum')
+
+    return layers, grid
+
+def write_raster(file_name: Union[str, Path],
+                 layers: Dict[str, np.ndarray],
+                 west: float, north: float,
+                 res: float = RASTER_RES_DEG,
+                 writer: AsyncWriter = None):
+    """
+    Write the layers into a compressed, tiled multi-band GeoTIFF (.tif) or a
+    compressed, chunked NetCDF (.nc), depending on the file extension.
+    Written in the background if an AsyncWriter is given, returns the future.
+    """
+    return write_bytes(file_name,
+                       file_to_bytes(lambda tmp_file: _write_raster(tmp_file, layers, west,
+                                                                     north, res), file_name),
+                       writer)
+
+def _write_raster(file_name: Union[str, Path],
+                  layers: Dict[str, np.ndarray],
+                  west: float, north: float,
+                  res: float = RASTER_RES_DEG):
+    """Write the raster, see write_raster."""
+    n_rows, n_cols = next(iter(layers.values())).shape
+
+    if str(file_name).endswith('.nc'):
+        lat = north - (np.arange(n_rows) + .5) * res
+        lon = west + (np.arange(n_cols) + .5) * res
+        ds = xr.Dataset({name: (('lat', 'lon'), grid.astype(np.float32))
+                         for name, grid in layers.items()},
+                        coords={'lat': lat, 'lon': lon})
+        chunks = (min(RASTER_BLOCK_SIZE, n_rows), min(RASTER_BLOCK_SIZE, n_cols))
+        ds.to_netcdf(file_name, encoding={name: {'zlib': True, 'complevel': 4,
+                                                 'chunksizes': chunks}
+                                          for name in layers})
+        return
+
+    with rasterio.open(file_name, 'w', driver='GTiff',
+                       height=n_rows, width=n_cols, count=len(layers),
+                       dtype='float32', crs='EPSG:4326', nodata=np.nan,
+                       transform=from_origin(west, north, res, res),
+                       compress='deflate', predictor=3, tiled=True,
+                       blockxsize=RASTER_BLOCK_SIZE, blockysize=RASTER_BLOCK_SIZE) as dst:
+        for band, (name, grid) in enumerate(layers.items(), start=1):
+            dst.write(grid.astype(np.float32), band)
+            dst.set_band_description(band, name)
+
+def read_raster_layer(file_name: Union[str, Path],
+                      layer: str) -> Tuple[np.ndarray, Tuple[float, float, float, float]]:
+    """
+    Read a single layer from a raster written by write_raster.
+
+    Returns
+    -------
+    grid : np.ndarray
+        Gridded values, north up.
+    extent : Tuple[float, float, float, float]
+        Extent of the grid (west, east, south, north) in degree.
+    """
+    if str(file_name).endswith('.nc'):
+        with xr.open_dataset(file_name) as ds:
+            grid = ds[layer].values
+            res = float(abs(ds.lon.values[1] - ds.lon.values[0])) if ds.lon.size > 1 else RASTER_RES_DEG
+            extent = (ds.lon.values[0] - res / 2, ds.lon.values[-1] + res / 2,
+                      ds.lat.values[-1] - res / 2, ds.lat.values[0] + res / 2)
+        return grid, extent
+
+    with rasterio.open(file_name) as src:
+        grid = src.read(src.descriptions.index(layer) + 1)
+        extent = (src.bounds.left, src.bounds.right, src.bounds.bottom, src.bounds.top)
+    return grid, extent
+
+def make_save_raster_file_name(tc_name: str,
+                               forecast_time: str,
+                               file_type: str = 'tif'):
+    """
+    Make a file name for saving the raster of a storm
+    """
+    return f'impact-raster_TC_ECMWF_ens_{tc_name}_{forecast_time}.{file_type}'
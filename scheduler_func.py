@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cost and priority of the storms and countries of a run, to process the
+most critical ones first.
+
+The priority of a storm is its expected population near the track where
+the storm is at least a tropical storm (mean over the members), from the
+pre-aggregated LitPop exposures (see exposure_agg_func). The cost of a storm
+is the number of centroids in its extent times the number of track points
+of all members, the cost of a country its exposure points times the members.
+
+Storms are ordered by priority tier (orders of magnitude of the expected
+population), and within a tier the most expensive first, so that a pool of
+workers is balanced (longest processing time first) without letting a small
+ocean storm delay a landfalling one. The predicted runtime is the cost times
+the median runtime per cost of the previous runs (see catalog_func).
+
+@author: Pui Man (Mannie) Kam
+"""
+import heapq
+import itertools
+import numpy as np
+from typing import Dict, List, Tuple
+from scipy.spatial import cKDTree
+
+from climada.hazard import TCTracks, Hazard, Centroids
+from climada.entity import Exposures
+
+EARTH_RADIUS_KM = 6371.
+
+# distance of the population from the track, in km
+NEAR_TRACK_KM = 300.
+
+# wind speed (m/s) from which the population near the track counts
+PRIORITY_WIND_THRES = 17.5
+
+def _unit_xyz(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Points on the unit sphere, for chord distances across the antimeridian."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def population_tree(lat: np.ndarray, lon: np.ndarray) -> cKDTree:
+    """Search tree of the population points (see exposure_agg_func.load_population_points)."""
+    return cKDTree(_unit_xyz(lat, lon))
+
+def storm_priority(tr_one_storm: TCTracks, pop_tree: cKDTree, pop_values: np.ndarray,
+                   near_track_km: float = NEAR_TRACK_KM,
+                   wind_thres: float = PRIORITY_WIND_THRES) -> float:
+    """
+    Expected population within near_track_km of the track points with
+    max_sustained_wind >= wind_thres, mean over the members.
+    """
+    if pop_values.size == 0:
+        return 0.
+    chord = 2 * np.sin(near_track_km / EARTH_RADIUS_KM / 2)
+    pop_members = []
+    for track in tr_one_storm.data:
+        strong = np.asarray(track['max_sustained_wind'].values) >= wind_thres
+        if not strong.any():
+            pop_members.append(0.)
+            continue
+        near = pop_tree.query_ball_point(_unit_xyz(track['lat'].values[strong],
+                                                   track['lon'].values[strong]), chord)
+        idx = np.unique(np.concatenate([np.asarray(i, dtype=int) for i in near]))
+        pop_members.append(float(pop_values[idx].sum()))
+    return float(np.mean(pop_members)) if pop_members else 0.
+
+def storm_cost(tr_one_storm: TCTracks, glob_centroids: Centroids, deg_buffer: float = 5.) -> float:
+    """Centroids in the extent of the storm times the track points of all members."""
+    lon_min, lon_max, lat_min, lat_max = tr_one_storm.get_extent(deg_buffer=deg_buffer)
+    lat, lon = glob_centroids.lat, glob_centroids.lon
+    lon_in = (lon >= lon_min) & (lon <= lon_max) if lon_min <= lon_max else \
+        (lon >= lon_min) | (lon <= lon_max)
+    n_centroids = np.count_nonzero((lat >= lat_min) & (lat <= lat_max) & lon_in)
+    n_points = sum(track.time.size for track in tr_one_storm.data)
+    return float(n_centroids * n_points)
+
+def country_priority(exp: Exposures, tc_haz: Hazard, wind_thres: float) -> float:
+    """
+    Expected population of a country exposed to at least wind_thres (mean
+    over the members), from the exposures with centroids assigned (centr_TC).
+    """
+    centr = exp.gdf['centr_TC'].values
+    assigned = centr >= 0
+    exposed = tc_haz.intensity[:, centr[assigned]] >= wind_thres
+    return float((exposed @ exp.gdf['value'].values[assigned]).mean())
+
+def country_cost(exp: Exposures, tc_haz: Hazard) -> float:
+    """Exposure points times members."""
+    return float(exp.gdf.shape[0] * tc_haz.intensity.shape[0])
+
+def priority_tier(priority: float) -> int:
+    """Order of magnitude of the priority (0 for no population)."""
+    return int(np.floor(np.log10(1. + max(priority, 0.))))
+
+def schedule_order(units: Dict[str, Tuple[float, float]]) -> List[str]:
+    """
+    Order of the units {name: (priority, cost)}: highest priority tier first,
+    and most expensive first within a tier.
+    """
+    queue = []
+    counter = itertools.count()
+    for name, (priority, cost) in units.items():
+        heapq.heappush(queue, (-priority_tier(priority), -cost, next(counter), name))
+    return [heapq.heappop(queue)[-1] for _ in range(len(queue))]
+
+def predict_runtime(cost: float, seconds_per_cost: float) -> float:
+    """Predicted runtime in seconds, None without history."""
+    return None if seconds_per_cost is None else cost * seconds_per_cost
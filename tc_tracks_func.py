@@ -7,11 +7,32 @@ Useful functions for extracting TC tracks from ECMWF.
 
 @author: Pui Man (Mannie) Kam
 """
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+from typing import Tuple, Union
+from pathlib import Path
+
 from climada_petals.hazard import TCForecast
 from climada.hazard import TCTracks
+import climada.util.coordinates as u_coord
+
+from download_func import fetch_latest_run
+from checkpoint_func import atomic_file
 
 WIND_CONVERSION_FACTOR = 1. / 0.88
 
+EARTH_RADIUS_KM = 6371.
+ARCSEC_TO_KM = 2 * np.pi * EARTH_RADIUS_KM / (360. * 3600.)
+
+# resolution of the global centroids from the Data API (client.get_centroids())
+CENTROIDS_RES_LAND_ARCSEC = 150
+CENTROIDS_RES_OCEAN_ARCSEC = 1800
+
+# maximum distance from the eye for which the wind field is computed (H1980)
+MAX_DIST_EYE_KM = 300.
+
 # Function to categorize wind speed
 def categorize_wind(speed):
     if speed < 17.49:
@@ -65,6 +86,116 @@ def filter_storm(fcast: TCForecast):
     
     return fcast_filter
 
+def format_run_datetime(run_datetime: np.datetime64) -> str:
+    """
+    Format the run datetime of a forecast as used in the file names,
+    e.g. 2024-08-25_00UTC
+    """
+    datetime_temp = np.datetime64(run_datetime).astype('datetime64[s]').astype(str)
+    return datetime_temp.replace('T', '_')[:-6] + 'UTC'
+
+def track_cache_file(cache_dir: Union[str, Path],
+                     run_datetime: np.datetime64) -> str:
+    """File in the track cache that holds the tracks of the given run."""
+    return os.path.join(cache_dir, f"tc_tracks_{format_run_datetime(run_datetime)}.h5")
+
+def get_forecast_tracks(cache_dir: Union[str, Path],
+                        run_datetime: np.datetime64 = None,
+                        path: Union[str, Path, list] = None,
+                        bufr_cache_dir: Union[str, Path] = None) -> Tuple[TCTracks, np.datetime64]:
+    """
+    Get the filtered (named storms only) and wind-corrected forecast tracks of
+    a run. The tracks are read from the local track cache if the run has
+    already been fetched, otherwise they are fetched from ECMWF, filtered,
+    corrected and written to the cache. This way only the first script of a
+    run pays for the download and the decoding of the BUFR files.
+
+    The cached tracks are not interpolated, each consumer applies its own
+    time step.
+
+    Parameters
+    ----------
+    cache_dir : Union[str, Path]
+        Directory of the track cache. One file per run.
+    run_datetime : np.datetime64
+        Run to look up in the cache. Default: the latest 00 or 12 UTC run
+    path : Union[str, Path, list]
+        Local BUFR file(s) or folder passed to TCForecast.fetch_ecmwf.
+        Default: None (download the latest forecast)
+    bufr_cache_dir : Union[str, Path]
+        If given (and no path), the BUFR files are downloaded concurrently
+        into this cache (one folder per run, see download_func.fetch_latest_run)
+        instead of by TCForecast.fetch_ecmwf. If a download still fails after
+        its retries, the tracks are fetched by TCForecast.fetch_ecmwf.
+        Default: None
+
+    Returns
+    -------
+    tr_filter : climada.TCTracks
+        Filtered and wind-corrected tracks of the run.
+    run_datetime : np.datetime64
+        Run datetime of the tracks.
+    """
+    if run_datetime is None:
+        run_datetime = np.datetime64(
+            pd.Timestamp.now(tz='UTC').floor('12h').tz_localize(None), 's')
+
+    cache_file = track_cache_file(cache_dir, run_datetime)
+    if os.path.exists(cache_file):
+        return read_track_cache(cache_file), np.datetime64(run_datetime, 's')
+
+    if path is None and bufr_cache_dir is not None:
+        try:
+            path, _ = fetch_latest_run(bufr_cache_dir, run_datetime)
+        except OSError as err:  # incl. urllib.error.URLError, ConnectionError, TimeoutError
+            print(f"Concurrent download of the BUFR files failed ({err}), "
+                  "falling back to TCForecast.fetch_ecmwf")
+            path = None
+
+    tr_fcast = TCForecast()
+    tr_fcast.fetch_ecmwf(path=path)
+    # nothing fetched (e.g. run not yet published): not cached, tried again next time
+    if len(tr_fcast.data) == 0:
+        return TCTracks(), np.datetime64(run_datetime, 's')
+    tr_filter = filter_storm(tr_fcast)
+    _correct_max_sustained_wind_speed(tr_filter)
+
+    # the fetched run may differ from the requested one (e.g. not yet published)
+    run_datetime = np.datetime64(tr_fcast.data[0].run_datetime, 's')
+    write_track_cache(track_cache_file(cache_dir, run_datetime), tr_filter)
+
+    return tr_filter, run_datetime
+
+def write_track_cache(cache_file: Union[str, Path], tc_tracks: TCTracks) -> None:
+    """
+    Write the tracks of one run into a single HDF5 file. An empty file
+    marks a run without any named storm.
+    """
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+
+    # unique temporary file: several scripts may build the cache of a run at the same time
+    with atomic_file(cache_file) as tmp_file:
+        if len(tc_tracks.data) == 0:
+            open(tmp_file, 'w').close()
+        else:
+            # attributes that are not NetCDF compliant are stored as int and str
+            tracks_out = TCTracks([track.copy() for track in tc_tracks.data])
+            for track in tracks_out.data:
+                track.attrs['is_ensemble'] = int(track.attrs['is_ensemble'])
+                track.attrs['run_datetime'] = str(np.datetime64(track.attrs['run_datetime'], 's'))
+            tracks_out.write_hdf5(tmp_file)
+
+def read_track_cache(cache_file: Union[str, Path]) -> TCTracks:
+    """Read the tracks of one run written by write_track_cache."""
+    if os.path.getsize(cache_file) == 0:
+        return TCTracks()
+
+    tc_tracks = TCTracks.from_hdf5(cache_file)
+    for track in tc_tracks.data:
+        track.attrs['is_ensemble'] = bool(track.attrs['is_ensemble'])
+        track.attrs['run_datetime'] = np.datetime64(track.attrs['run_datetime'])
+    return tc_tracks
+
 def _correct_max_sustained_wind_speed(tc_forecast: TCForecast,
                                       wind_conversion_factor: float = WIND_CONVERSION_FACTOR) -> None:
     """
@@ -77,4 +208,117 @@ def _correct_max_sustained_wind_speed(tc_forecast: TCForecast,
     :return:
     """
     for dataset in tc_forecast.data:
-        dataset['max_sustained_wind'] *= wind_conversion_factor
\ No newline at end of file
+        dataset['max_sustained_wind'] *= wind_conversion_factor
+
+def adaptive_timestep(tc_tracks: TCTracks,
+                      res_land_arcsec: float = CENTROIDS_RES_LAND_ARCSEC,
+                      res_ocean_arcsec: float = CENTROIDS_RES_OCEAN_ARCSEC,
+                      spacing_factor: float = 2.,
+                      land_buffer_km: float = MAX_DIST_EYE_KM,
+                      min_time_step_h: float = .5,
+                      max_time_step_h: float = 6.) -> None:
+    """
+    Interpolate the tracks with a time step that is chosen for each segment
+    (between two original track positions) separately. This is an alternative
+    to TCTracks.equal_timestep.
+
+    The time step of a segment is chosen such that two consecutive positions
+    are never further apart than spacing_factor times the spacing of the
+    centroids the wind field is computed on. Segments within land_buffer_km
+    of land use the (fine) land resolution of the centroids, all other
+    segments the (coarse) ocean resolution. Slow storms and storms far from
+    land thus get far fewer track points. Since the closest approach of the
+    eye to a centroid is missed by at most half of the position spacing, the
+    error in the maximum wind swath is bounded by the spacing.
+
+    Parameters
+    ----------
+    tc_tracks : climada.TCTracks
+        Tracks to interpolate. Modified in place.
+    res_land_arcsec : float
+        Resolution of the centroids on land in arcsec.
+        Default: 150 (global centroids from the Data API)
+    res_ocean_arcsec : float
+        Resolution of the centroids over the ocean in arcsec.
+        Default: 1800 (global centroids from the Data API)
+    spacing_factor : float
+        Maximum distance between two consecutive track positions in units of
+        the centroid spacing. Default: 2
+    land_buffer_km : float
+        Segments closer than this to land are treated as near land.
+        Default: 300 (maximum distance from the eye in the wind model)
+    min_time_step_h : float
+        Smallest allowed time step in hours. Default: 0.5
+    max_time_step_h : float
+        Largest allowed time step in hours. Default: 6
+    """
+    max_dist_land_km = spacing_factor * res_land_arcsec * ARCSEC_TO_KM
+    max_dist_ocean_km = spacing_factor * res_ocean_arcsec * ARCSEC_TO_KM
+
+    tc_tracks.data = [
+        _adaptive_interp_track(track, max_dist_land_km, max_dist_ocean_km,
+                               land_buffer_km, min_time_step_h, max_time_step_h)
+        for track in tc_tracks.data
+    ]
+
+def _adaptive_interp_track(track: xr.Dataset,
+                           max_dist_land_km: float,
+                           max_dist_ocean_km: float,
+                           land_buffer_km: float,
+                           min_time_step_h: float,
+                           max_time_step_h: float) -> xr.Dataset:
+    """
+    Interpolate a single track to the adaptive time steps (see adaptive_timestep).
+    """
+    if track.time.size < 2:
+        return track
+
+    lat = track.lat.values
+    # unwrap the longitude to interpolate correctly across the antimeridian
+    lon = np.rad2deg(np.unwrap(np.deg2rad(track.lon.values)))
+    time_h = (track.time.values - track.time.values[0]) / np.timedelta64(1, 'h')
+
+    # maximum position spacing of each segment, depending on the distance to land
+    dist_coast_km = u_coord.dist_to_coast(lat, u_coord.lon_normalize(lon.copy())) / 1000.
+    near_land = u_coord.coord_on_land(lat, u_coord.lon_normalize(lon.copy())) \
+        | (dist_coast_km <= land_buffer_km)
+    seg_near_land = near_land[:-1] | near_land[1:]
+    seg_max_dist = np.where(seg_near_land, max_dist_land_km, max_dist_ocean_km)
+
+    # number of sub-steps per segment from the translation distance
+    seg_dist = _haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    seg_dt = np.diff(time_h)
+    seg_step = seg_dt / np.fmax(1, np.ceil(seg_dist / seg_max_dist))
+    seg_step = np.clip(seg_step, min_time_step_h, max_time_step_h)
+    seg_n_sub = np.fmax(1, np.ceil(seg_dt / seg_step - 1e-9)).astype(int)
+
+    new_time_h = np.concatenate([
+        time_h[i] + np.arange(n_sub) * seg_dt[i] / n_sub
+        for i, n_sub in enumerate(seg_n_sub)
+    ] + [time_h[-1:]])
+    new_time = track.time.values[0] + np.round(new_time_h * 3600).astype('timedelta64[s]')
+
+    track = track.reset_coords(['lat', 'lon']).assign(lon=('time', lon))
+    numeric_vars = [var for var in track.data_vars
+                    if np.issubdtype(track[var].dtype, np.number)]
+    other_vars = [var for var in track.data_vars if var not in numeric_vars]
+
+    track_interp = xr.merge([
+        track[numeric_vars].interp(time=new_time, method='linear'),
+        track[other_vars].reindex(time=new_time, method='ffill'),
+    ])
+    time_step = np.diff(new_time_h)
+    track_interp['time_step'] = ('time', np.concatenate([time_step[:1], time_step]))
+    track_interp['lon'] = ('time', u_coord.lon_normalize(track_interp.lon.values))
+    track_interp = track_interp.set_coords(['lat', 'lon'])
+    track_interp.attrs = track.attrs
+
+    return track_interp
+
+def _haversine_km(lat1: np.ndarray, lon1: np.ndarray,
+                  lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """Great circle distance in km between two sets of points (in degrees)."""
+    lat1, lon1, lat2, lon2 = [np.radians(arr) for arr in (lat1, lon1, lat2, lon2)]
+    hav = np.sin((lat2 - lat1) / 2)**2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(hav))
@@ -9,58 +9,181 @@ Output: climada.hazard.Hazard class in .hdf5 format
 @author: Pui Man (Mannie) Kam
 """
 import time
+import multiprocessing
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import warnings
 warnings.filterwarnings("ignore")
 
-from climada.hazard import TropCyclone
-from climada_petals.hazard import TCForecast
 from climada.util.api_client import Client
 client = Client()
 
-from tc_tracks_func import filter_storm, _correct_max_sustained_wind_speed
+from tc_tracks_func import (
+    get_forecast_tracks, format_run_datetime, adaptive_timestep
+)
+from windfield_func import (
+    compute_storm_windfield, compute_storm_windfield_lead_times,
+    make_tc_wind_file_name, make_tc_wind_lead_time_file_name
+)
+from checkpoint_func import atomic_file
+from codec_func import write_hazard
+from catalog_func import (
+    register_storm, register_lead_time, register_run, wind_file_stats,
+    register_schedule, register_published, seconds_per_cost
+)
+from exposure_agg_func import load_population_points
+from scheduler_func import (
+    population_tree, storm_priority, storm_cost, schedule_order, predict_runtime
+)
 
 time_start = time.time()
 
 SAVE_WIND_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/tc_wind/" # save to the scratch folder
 
+TRACK_CACHE_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/tc_tracks/" # shared with the track plotting
+
+# BUFR files of each run, downloaded concurrently (shared with the track plotting)
+BUFR_CACHE_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/bufr/"
+
+# catalog of the runs, storms and output files, shared with impact_calculate.py; only
+# this process writes to it (not the workers), best on a local disk (see catalog_func)
+CATALOG_FILE = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/tc_catalog.sqlite"
+
 N_ENSEMBLE = 51
 
+# interpolate the tracks with a time step adapted to the translation speed and
+# the centroid spacing instead of a fixed time step of 0.5 h
+ADAPTIVE_TIMESTEP = True
+
+# compute all ensemble members of a storm at once with the batched H1980 kernel
+# instead of TropCyclone.from_tracks
+BATCHED_WINDFIELD = True
+
+# floating point type of the stored wind intensity (np.float32 halves the file size)
+INTENSITY_DTYPE = np.float32
+
+# store the intensity quantized to 0.01 m/s with the HDF5 scale-offset filter, which
+# Hazard.from_hdf5 reads as usual ('scaleoffset'), as integer codes that only
+# read_hazard decodes ('uint16', 'uint8') and on which impact_calculate.py computes
+# the impacts with lookup tables (QUANTIZED_IMPACT), or as written by Hazard.write_hdf5 (None)
+INTENSITY_CODEC = 'scaleoffset'
+
+# memory ceiling of the tiled computation for storms with very large extents,
+# None computes each storm at once
+MAX_MEMORY_GB = 8.
+
+# lead-time checkpoints (hours since the run time) of the cumulative maximum wind,
+# computed in the same pass as the wind field (batched kernel only)
+LEAD_TIMES_H = [24, 48, 72]
+
+# storms computed in parallel (fork), each with a share of the memory ceiling,
+# the most critical storms first (see scheduler_func)
+N_WORKERS = 2
+
+# pre-aggregated population, to rank the storms by their population near the track
+EXPOSURE_AGG_DIR = "/net/n2o/wcr/tc_imp_forecast/TC_imp_forecast/data/exposure_agg/"
+
+def compute_and_save_storm(tr_name: str) -> tuple:
+    """
+    Compute and save the wind field of a storm (in a worker process). The
+    parent registers the files in the catalog, so that it has a single writer.
+
+    Returns
+    -------
+    tr_name : str
+    runtime : float
+    lead_files : List[tuple]
+        Lead time (hours), statistics (see catalog_func.wind_file_stats) and
+        file of each lead-time checkpoint.
+    wind_stats : tuple
+    wind_file : str
+    """
+    time_start_storm = time.time()
+    # select single storm and interpolate the tracks
+    tr_one_storm = tr_filter.subset({'name': tr_name})
+    max_memory_gb = None if MAX_MEMORY_GB is None else MAX_MEMORY_GB / N_WORKERS
+
+    # compute the windfield for each storm
+    if BATCHED_WINDFIELD and LEAD_TIMES_H:
+        tc_wind_one_storm, tc_wind_lead_times = compute_storm_windfield_lead_times(
+            tr_one_storm, glob_centroids, LEAD_TIMES_H, N_ENSEMBLE,
+            dtype=INTENSITY_DTYPE, max_memory_gb=max_memory_gb)
+    else:
+        tc_wind_one_storm = compute_storm_windfield(tr_one_storm, glob_centroids, N_ENSEMBLE,
+                                                    batched=BATCHED_WINDFIELD,
+                                                    dtype=INTENSITY_DTYPE,
+                                                    max_memory_gb=max_memory_gb)
+        tc_wind_lead_times = {}
+
+    lead_files = []
+    for lead_time_h, tc_wind_lead in tc_wind_lead_times.items():
+        lead_file = SAVE_WIND_DIR +make_tc_wind_lead_time_file_name(
+            tr_name, formatted_datetime, lead_time_h)
+        with atomic_file(lead_file) as tmp_file:
+            write_hazard(tc_wind_lead, tmp_file, INTENSITY_CODEC)
+        lead_files.append((lead_time_h, wind_file_stats(tc_wind_lead), lead_file))
+    wind_file = SAVE_WIND_DIR +make_tc_wind_file_name(tr_name, formatted_datetime)
+    with atomic_file(wind_file) as tmp_file:
+        write_hazard(tc_wind_one_storm, tmp_file, INTENSITY_CODEC)
+
+    return (tr_name, time.time() - time_start_storm, lead_files,
+            wind_file_stats(tc_wind_one_storm), wind_file)
+
 # retrieve the Centroids from 
 glob_centroids = client.get_centroids()
 
-# retrieve the latest forecast
-tr_fcast = TCForecast()
-tr_fcast.fetch_ecmwf()
-tr_filter = filter_storm(tr_fcast)
-tr_filter.equal_timestep(.5)
-_correct_max_sustained_wind_speed(tr_filter)
+# retrieve the latest forecast (filtered and wind-corrected) from the track cache
+tr_filter, run_datetime = get_forecast_tracks(TRACK_CACHE_DIR, bufr_cache_dir=BUFR_CACHE_DIR)
+if ADAPTIVE_TIMESTEP:
+    adaptive_timestep(tr_filter)
+else:
+    tr_filter.equal_timestep(.5)
 
 # retrieve dateimt information
-run_datetime = tr_fcast.data[0].run_datetime
-datetime_temp = run_datetime.astype('datetime64[s]').astype(str)
-formatted_datetime = datetime_temp.replace('T', '_')[:-6] + 'UTC'
+formatted_datetime = format_run_datetime(run_datetime)
 
 if len(tr_filter.data) != 0:
 
     tr_name_unique = set([tr.name for tr in tr_filter.data])
 
+    # priority (population near the track) and cost of each storm
+    pop_lat, pop_lon, pop_values = load_population_points(EXPOSURE_AGG_DIR)
+    pop_tree = population_tree(pop_lat, pop_lon)
+    storm_units = {}
     for tr_name in tr_name_unique:
-        # select single storm and interpolate the tracks
         tr_one_storm = tr_filter.subset({'name': tr_name})
-
-        # refine the centroids
-        storm_extent = tr_one_storm.get_extent(deg_buffer=5.)
-        centroids_refine = glob_centroids.select(extent=storm_extent)
-
-        # compute the windfield for each storm
-        tc_wind_one_storm = TropCyclone.from_tracks(tr_one_storm, centroids_refine,
-                                                    model="H1980")
-        tc_wind_one_storm.frequency = np.ones(len(tc_wind_one_storm.event_id))/N_ENSEMBLE
-        tc_wind_one_storm.write_hdf5(SAVE_WIND_DIR +'tc_wind_' +tr_name +'_' +formatted_datetime +'.hdf5')
+        storm_units[tr_name] = (storm_priority(tr_one_storm, pop_tree, pop_values),
+                                storm_cost(tr_one_storm, glob_centroids))
+    storm_order = schedule_order(storm_units)
+    sec_per_cost = seconds_per_cost(CATALOG_FILE, 'wind')
+    register_schedule(CATALOG_FILE, formatted_datetime, 'wind',
+                      [(tr_name, *storm_units[tr_name],
+                        predict_runtime(storm_units[tr_name][1], sec_per_cost))
+                       for tr_name in storm_order])
+
+    # the pool takes the storms in order as workers become free
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=N_WORKERS, mp_context=ctx) as executor:
+        futures = [executor.submit(compute_and_save_storm, tr_name) for tr_name in storm_order]
+        for future in as_completed(futures):
+            tr_name, runtime, lead_files, wind_stats, wind_file = future.result()
+            # the lead-time files first, so that they are complete once the storm is registered
+            for lead_time_h, lead_stats, lead_file in lead_files:
+                register_lead_time(CATALOG_FILE, formatted_datetime, tr_name, lead_time_h,
+                                   lead_stats, lead_file)
+            # published: impact_calculate.py finds the storm in the catalog from now on
+            register_storm(CATALOG_FILE, formatted_datetime, tr_name, wind_stats, wind_file)
+            register_published(CATALOG_FILE, formatted_datetime, 'wind', tr_name, runtime)
+            predicted = predict_runtime(storm_units[tr_name][1], sec_per_cost)
+            print(f"{tr_name}: expected population {storm_units[tr_name][0]:,.0f}, "
+                  f"runtime {runtime:.1f} s (predicted "
+                  f"{'n/a' if predicted is None else f'{predicted:.1f} s'})")
+
+    register_run(CATALOG_FILE, formatted_datetime, 'wind', n_storms=len(tr_name_unique))
 
 else:
     print(f"There is no active storm forecasted at {formatted_datetime}")
+    register_run(CATALOG_FILE, formatted_datetime, 'wind', n_storms=0)
 
 # record the time
 time_end = time.time()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for rendering the storm rasters (see raster_func) into a
+Web Mercator XYZ tile pyramid ({layer}/{z}/{x}/{y}.png) for web display.
+
+Tiles are rendered in parallel across worker processes, in one pool per run
+shared by all storms (see tile_pool), which is forked before the background
+writer starts its threads. A tile is only
+rendered if its source window (the raster cells under the tile, with their
+position on the grid and the layer style) changed since the previous run,
+based on a manifest with the hash of the source window of each tile. Tiles
+without data are skipped, and the highest zoom level is capped so that a
+layer has at most MAX_TILES_PER_ZOOM tiles per zoom level.
+
+@author: Pui Man (Mannie) Kam
+"""
+import io
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+from typing import Union, Dict, List, Tuple
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+from matplotlib.colors import Normalize
+from PIL import Image
+
+from raster_func import read_raster_layer
+from writer_func import AsyncWriter, write_bytes
+
+TILE_SIZE = 256
+
+TILE_ZOOM_RANGE = (3, 10)
+
+# zoom levels with more tiles over the raster extent are not rendered
+MAX_TILES_PER_ZOOM = 4096
+
+# web mercator is defined up to this latitude
+MAX_LAT_MERCATOR = 85.0511
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+# colormap and value range per layer (prefix of the layer name), values
+# below the lower bound are transparent. None means the maximum of the layer.
+LAYER_STYLES = {
+    'wind_mean': ('YlOrRd', 17.5, 70.),
+    'prob_': ('Purples', .05, 1.),
+    'exposed_population': ('YlOrBr', 10., None),
+    'displacement': ('YlOrBr', 10., None),
+}
+
+# raster of the current storm in each worker process, see _init_worker
+_worker_state = {}
+
+def _layer_style(layer: str, grid: np.ndarray):
+    """Colormap and normalization of a layer, see LAYER_STYLES."""
+    for prefix, (cmap_name, vmin, vmax) in LAYER_STYLES.items():
+        if layer.startswith(prefix):
+            break
+    else:
+        cmap_name, vmin, vmax = 'viridis', np.nanmin(grid), None
+    if vmax is None:
+        vmax = max(np.nanmax(grid), vmin + 1)
+    return cmap_name, float(vmin), float(vmax)
+
+def tile_range(extent: Tuple[float, float, float, float],
+               zoom: int) -> Tuple[int, int, int, int]:
+    """
+    Range of the tiles that cover an extent (west, east, south, north) at a
+    zoom level. The x indices of an extent across the antimeridian (see
+    raster_func.grid_bounds) run past the edges of the map (below 0 or from
+    2 ** zoom), the tile is x modulo 2 ** zoom.
+
+    Returns
+    -------
+    x_min, x_max, y_min, y_max : int
+        Tile indices (inclusive).
+    """
+    west, east, south, north = extent
+    n_tiles = 2 ** zoom
+
+    def _tile_x(lon):
+        return int(np.floor((lon + 180.) / 360. * n_tiles))
+
+    def _tile_y(lat):
+        lat_rad = np.radians(np.clip(lat, -MAX_LAT_MERCATOR, MAX_LAT_MERCATOR))
+        y = (1. - np.log(np.tan(lat_rad) + 1. / np.cos(lat_rad)) / np.pi) / 2. * n_tiles
+        return int(np.clip(np.floor(y), 0, n_tiles - 1))
+
+    x_min = _tile_x(west)
+    x_max = min(_tile_x(east), x_min + n_tiles - 1)
+    return x_min, x_max, _tile_y(north), _tile_y(south)
+
+def max_zoom_for_extent(extent: Tuple[float, float, float, float],
+                        zoom_range: Tuple[int, int] = TILE_ZOOM_RANGE,
+                        max_tiles: int = MAX_TILES_PER_ZOOM) -> int:
+    """
+    Highest zoom level of zoom_range at which the extent is covered by at most
+    max_tiles tiles (at least the lowest zoom level).
+    """
+    max_zoom = zoom_range[0]
+    for zoom in range(zoom_range[0], zoom_range[1] + 1):
+        x_min, x_max, y_min, y_max = tile_range(extent, zoom)
+        if (x_max - x_min + 1) * (y_max - y_min + 1) > max_tiles:
+            break
+        max_zoom = zoom
+    return max_zoom
+
+def tile_bounds(zoom: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """Extent (west, east, south, north) of a tile in degree, x may run past the map edges."""
+    n_tiles = 2 ** zoom
+    west, east = x / n_tiles * 360. - 180., (x + 1) / n_tiles * 360. - 180.
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1. - 2. * y / n_tiles))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1. - 2. * (y + 1) / n_tiles))))
+    return west, east, south, north
+
+def source_window(grid: np.ndarray,
+                  extent: Tuple[float, float, float, float],
+                  zoom: int, x: int, y: int) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Raster cells under a tile, NaN outside the raster. All pixels of the tile
+    are sampled from these cells (see render_tile).
+
+    Returns
+    -------
+    window : np.ndarray
+        Cells under the tile, north up.
+    origin : Tuple[int, int]
+        Position of the upper left cell on the global grid of the resolution
+        (the rasters are aligned to it, see raster_func.grid_bounds), so that
+        the windows of two runs with different raster extents compare.
+    """
+    west, east, south, north = extent
+    n_rows, n_cols = grid.shape
+    res_lon, res_lat = (east - west) / n_cols, (north - south) / n_rows
+
+    tile_west, tile_east, tile_south, tile_north = tile_bounds(zoom, x, y)
+    col0 = int(np.floor((tile_west - west) / res_lon))
+    col1 = int(np.floor((tile_east - west) / res_lon))
+    row0 = int(np.floor((north - tile_north) / res_lat))
+    row1 = int(np.floor((north - tile_south) / res_lat))
+
+    window = np.full((row1 - row0 + 1, col1 - col0 + 1), np.nan, dtype=grid.dtype)
+    r0, r1 = max(row0, 0), min(row1, n_rows - 1)
+    c0, c1 = max(col0, 0), min(col1, n_cols - 1)
+    if r0 <= r1 and c0 <= c1:
+        window[r0 - row0:r1 - row0 + 1, c0 - col0:c1 - col0 + 1] = grid[r0:r1 + 1, c0:c1 + 1]
+    origin = (int(round(north / res_lat)) - row0,
+              (int(round(west / res_lon)) + col0) % int(round(360. / res_lon)))
+    return window, origin
+
+def tile_pixel_lonlat(zoom: int, x: int, y: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Longitude and latitude of the pixel centres of a tile.
+
+    Returns
+    -------
+    lon, lat : np.ndarray
+        Coordinates (TILE_SIZE x TILE_SIZE), row 0 is the northern edge.
+    """
+    n_tiles = 2 ** zoom
+    pix = (np.arange(TILE_SIZE) + .5) / TILE_SIZE
+    lon = (x + pix) / n_tiles * 360. - 180.
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1. - 2. * (y + pix) / n_tiles))))
+    return np.broadcast_to(lon[None, :], (TILE_SIZE, TILE_SIZE)), \
+        np.broadcast_to(lat[:, None], (TILE_SIZE, TILE_SIZE))
+
+def render_tile(grid: np.ndarray,
+                extent: Tuple[float, float, float, float],
+                zoom: int, x: int, y: int,
+                cmap_name: str, vmin: float, vmax: float) -> np.ndarray:
+    """
+    Render a tile from a raster layer by nearest-neighbour sampling of the
+    pixel centres.
+
+    Returns
+    -------
+    rgba : np.ndarray
+        Tile image (TILE_SIZE x TILE_SIZE x 4, uint8), or None if the tile
+        has no value above vmin.
+    """
+    west, east, south, north = extent
+    n_rows, n_cols = grid.shape
+    res_lon, res_lat = (east - west) / n_cols, (north - south) / n_rows
+
+    lon, lat = tile_pixel_lonlat(zoom, x, y)
+    col = np.floor((lon - west) / res_lon).astype(int)
+    row = np.floor((north - lat) / res_lat).astype(int)
+    inside = (col >= 0) & (col < n_cols) & (row >= 0) & (row < n_rows)
+
+    values = np.full(lon.shape, np.nan)
+    values[inside] = grid[row[inside], col[inside]]
+    visible = values >= vmin
+    if not visible.any():
+        return None
+
+    rgba = plt.get_cmap(cmap_name)(Normalize(vmin=vmin, vmax=vmax, clip=True)(values), bytes=True)
+    rgba[~visible, 3] = 0
+    return rgba
+
+def tile_pool(n_workers: int) -> ProcessPoolExecutor:
+    """
+    Pool of worker processes for rendering the tiles of all storms of a run
+    (see make_tile_pyramid). The workers are forked, so that the calling
+    scripts (without __main__ guard) are not re-executed: create the pool
+    before any thread is started (e.g. the AsyncWriter), and shut it down at
+    the end of the run.
+    """
+    executor = ProcessPoolExecutor(max_workers=n_workers,
+                                   mp_context=multiprocessing.get_context('fork'))
+    # start all workers now, not lazily once threads are running
+    list(executor.map(int, range(n_workers)))
+    return executor
+
+def _worker_layer(raster_file: str, layer: str):
+    """Layer of the raster, its extent and style, read once per worker process and storm."""
+    if _worker_state.get('raster_file') != raster_file:
+        _worker_state['raster_file'] = raster_file
+        _worker_state['layers'] = {}
+    if layer not in _worker_state['layers']:
+        grid, extent = read_raster_layer(raster_file, layer)
+        _worker_state['layers'][layer] = (grid, extent, _layer_style(layer, grid))
+    return _worker_state['layers'][layer]
+
+def _render_tile_task(task: Tuple[str, str, str, int, int, int, str]) -> Tuple[str, str, str, bytes]:
+    """
+    Render a single tile to PNG in a worker process, unless its source window
+    is the same as in the previous run (hash prev_hash) or has no visible value.
+    The task is (raster_file, tile_dir, layer, zoom, x, y, prev_hash).
+
+    Returns
+    -------
+    key : str
+        Tile key {layer}/{z}/{x}/{y}.
+    source_hash : str
+        Hash of the source window of the tile, None for empty tiles.
+    status : str
+        'written', 'reused' or 'empty'.
+    png : bytes
+        PNG of the tile to write, None unless written.
+    """
+    raster_file, tile_dir, layer, zoom, x, y, prev_hash = task
+    key = f"{layer}/{zoom}/{x % 2 ** zoom}/{y}"
+    grid, extent, (cmap_name, vmin, vmax) = _worker_layer(raster_file, layer)
+
+    window, origin = source_window(grid, extent, zoom, x, y)
+    if not (window >= vmin).any():
+        return key, None, 'empty', None
+
+    res = ((extent[1] - extent[0]) / grid.shape[1], (extent[3] - extent[2]) / grid.shape[0])
+    source_hash = hashlib.sha1(
+        repr((cmap_name, vmin, vmax, np.round(res, 9).tolist(), origin, window.shape)).encode()
+        + np.ascontiguousarray(window).tobytes()).hexdigest()
+    tile_file = os.path.join(tile_dir, key + '.png')
+    if prev_hash == source_hash and os.path.exists(tile_file):
+        return key, source_hash, 'reused', None
+
+    rgba = render_tile(grid, extent, zoom, x, y, cmap_name, vmin, vmax)
+    if rgba is None:
+        return key, None, 'empty', None
+
+    buffer = io.BytesIO()
+    Image.fromarray(rgba).save(buffer, format='PNG', optimize=True)
+    return key, source_hash, 'written', buffer.getvalue()
+
+def make_tile_pyramid(raster_file: Union[str, Path],
+                      layers: List[str],
+                      tile_dir: Union[str, Path],
+                      zoom_range: Tuple[int, int] = TILE_ZOOM_RANGE,
+                      n_workers: int = None,
+                      writer: AsyncWriter = None,
+                      executor: ProcessPoolExecutor = None) -> Dict[str, int]:
+    """
+    Render the layers of a storm raster into a Web Mercator XYZ tile pyramid
+    ({tile_dir}/{layer}/{z}/{x}/{y}.png), which can be served by any static
+    file server. The tile directory of a storm is updated from run to run:
+    tiles with an unchanged source window are kept without rendering them,
+    tiles that became empty are removed.
+
+    Parameters
+    ----------
+    raster_file : Union[str, Path]
+        Storm raster written by raster_func.write_raster.
+    layers : List[str]
+        Layers (band names) of the raster to render.
+    tile_dir : Union[str, Path]
+        Output directory of the tiles of the storm.
+    zoom_range : Tuple[int, int]
+        Lowest and highest zoom level (inclusive), the highest is capped by
+        the extent of the raster (see max_zoom_for_extent). Default: 3 to 10
+    n_workers : int
+        Number of worker processes of a pool for this call only, if no
+        executor is given. Default: number of CPUs
+    writer : AsyncWriter
+        Writer for writing the tiles in the background, the workers only
+        render them. Default: None (write synchronously)
+    executor : ProcessPoolExecutor
+        Pool of the run (see tile_pool). Default: None (a pool of n_workers
+        forked for this call, only safe while no thread is running)
+
+    Returns
+    -------
+    tile_stats : Dict[str, int]
+        Number of tiles written, reused and skipped (empty).
+    """
+    manifest_file = os.path.join(tile_dir, MANIFEST_FILE_NAME)
+    prev_manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            prev_manifest = json.load(f)
+
+    tasks = []
+    for layer in layers:
+        _, extent = read_raster_layer(raster_file, layer)
+        for zoom in range(zoom_range[0], max_zoom_for_extent(extent, zoom_range) + 1):
+            x_min, x_max, y_min, y_max = tile_range(extent, zoom)
+            tasks += [(str(raster_file), str(tile_dir), layer, zoom, x, y,
+                       prev_manifest.get(f"{layer}/{zoom}/{x % 2 ** zoom}/{y}"))
+                      for x in range(x_min, x_max + 1)
+                      for y in range(y_min, y_max + 1)]
+
+    manifest = {}
+    tile_stats = {'written': 0, 'reused': 0, 'empty': 0}
+    own_executor = executor is None
+    if own_executor:
+        executor = tile_pool(n_workers or os.cpu_count())
+    try:
+        for key, source_hash, status, png in executor.map(_render_tile_task, tasks,
+                                                          chunksize=64):
+            tile_stats[status] += 1
+            if source_hash is not None:
+                manifest[key] = source_hash
+            if png is not None:
+                write_bytes(os.path.join(tile_dir, key + '.png'), png, writer)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    # remove the tiles of the previous run that have no data anymore
+    for key in set(prev_manifest) - set(manifest):
+        tile_file = os.path.join(tile_dir, key + '.png')
+        if os.path.exists(tile_file):
+            os.remove(tile_file)
+
+    # a tile of the manifest that is not written (yet) is rendered again by the next run
+    write_bytes(manifest_file, json.dumps(manifest).encode(), writer)
+
+    return tile_stats
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for the tiled (out-of-core) processing of large storm
+extents. The centroids or exposure points are split into spatial tiles of
+bounded size, so that the wind field and the impacts are computed tile by
+tile under a memory ceiling and stitched together afterwards.
+
+@author: Pui Man (Mannie) Kam
+"""
+import numpy as np
+from typing import List
+
+ONE_LAT_KM = 111.12
+
+def max_points_per_tile(max_memory_gb: float, bytes_per_point: float) -> int:
+    """
+    Number of points of a tile such that the tile stays below the memory
+    ceiling, given the memory needed per point.
+    """
+    return max(1, int(max_memory_gb * 1e9 / bytes_per_point))
+
+def spatial_tiles(lat: np.ndarray, lon: np.ndarray, max_points: int) -> List[np.ndarray]:
+    """
+    Split points into spatially compact tiles of at most max_points points,
+    by recursive bisection at the median along the wider side.
+
+    Parameters
+    ----------
+    lat, lon : np.ndarray
+        Coordinates of the points.
+    max_points : int
+        Maximum number of points per tile.
+
+    Returns
+    -------
+    tiles : List[np.ndarray]
+        Indices of the points of each tile.
+    """
+    tiles = []
+    to_split = [np.arange(lat.size)]
+    while to_split:
+        idx = to_split.pop()
+        if idx.size <= max_points:
+            if idx.size > 0:
+                tiles.append(idx)
+            continue
+        lat_range = np.ptp(lat[idx])
+        lon_range = np.ptp(lon[idx]) * np.cos(np.radians(np.median(lat[idx])))
+        coord = lat[idx] if lat_range >= lon_range else lon[idx]
+        order = np.argsort(coord, kind='stable')
+        half = idx.size // 2
+        to_split += [idx[order[:half]], idx[order[half:]]]
+
+    return tiles
+
+def points_near_tile(tile_lat: np.ndarray, tile_lon: np.ndarray,
+                     pt_lat: np.ndarray, pt_lon: np.ndarray,
+                     max_dist_km: float) -> np.ndarray:
+    """
+    Mask of the (track) points within max_dist_km of the bounding box of a
+    tile, i.e. the halo of track points the tile needs. The distance is
+    equirectangular, scaled at the latitude of the track point as in the
+    wind field computation, so the mask is a superset of the points within
+    max_dist_km of any point of the tile.
+    """
+    lat_min, lat_max = tile_lat.min(), tile_lat.max()
+    d_lat = np.fmax(0, np.fmax(lat_min - pt_lat, pt_lat - lat_max))
+
+    # longitudes relative to the tile centre, to handle the antimeridian
+    lon_rad = np.radians(tile_lon)
+    lon_mid = np.degrees(np.arctan2(np.sin(lon_rad).mean(), np.cos(lon_rad).mean()))
+    lon_min = lon_mid + wrap_lon(tile_lon - lon_mid).min()
+    lon_max = lon_mid + wrap_lon(tile_lon - lon_mid).max()
+    pt_lon = lon_mid + wrap_lon(pt_lon - lon_mid)
+    d_lon = np.fmax(0, np.fmax(lon_min - pt_lon, pt_lon - lon_max))
+
+    dist_km = np.hypot(d_lat, d_lon * np.cos(np.radians(pt_lat))) * ONE_LAT_KM
+    return dist_km <= max_dist_km
+
+def wrap_lon(d_lon: np.ndarray) -> np.ndarray:
+    """
+    Wrap longitude differences into [-180, 180]
+    """
+    return d_lon - 360 * np.round(d_lon / 360)
@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Useful functions for computing the TC wind field of the forecast tracks.
+
+@author: Pui Man (Mannie) Kam
+"""
+import itertools
+import numpy as np
+from typing import List, Dict, Tuple
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from climada.hazard import TCTracks, TropCyclone, Centroids
+from climada.hazard.tc_tracks import estimate_rmw
+
+from tiling_func import spatial_tiles, points_near_tile, max_points_per_tile, wrap_lon
+
+N_ENSEMBLE = 51
+
+# buffer around the tracks for selecting the centroids, in degree
+DEG_BUFFER = 5.
+
+# constants of the Holland (1980) model as used in climada
+KN_TO_MS = 0.514444
+NM_TO_M = 1852.
+MBAR_TO_PA = 100.
+H_TO_S = 3600.
+ONE_LAT_KM = 111.12
+EARTH_RADIUS_KM = 6371.
+V_ANG_EARTH = 7.29e-5
+RHO_AIR = 1.15
+GRADIENT_TO_SURFACE_WINDS = 0.9
+MAX_VTRANS_KN = 30.
+MAX_DIST_EYE_KM = 300.
+INTENSITY_THRES = 17.5 # in m/s
+MAX_DIST_INLAND_KM = 1000.
+MAX_LATITUDE = 61.
+
+# conversion of the track units to SI units
+UNIT_TO_SI = {'kn': KN_TO_MS, 'knots': KN_TO_MS, 'm/s': 1., 'ms': 1.,
+              'mb': MBAR_TO_PA, 'mbar': MBAR_TO_PA, 'hPa': MBAR_TO_PA, 'Pa': 1.}
+
+# number of track points for which the neighbouring centroids are processed at once
+TRACK_POINTS_CHUNK = 128
+
+# wind speeds (member, centroid) accumulated before the duplicates are reduced to their maximum
+REDUCE_EVERY = 4_000_000
+
+def compute_storm_windfield(tr_one_storm: TCTracks,
+                            glob_centroids: Centroids,
+                            n_ensemble: int = N_ENSEMBLE,
+                            batched: bool = False,
+                            dtype: type = np.float64,
+                            max_memory_gb: float = None) -> TropCyclone:
+    """
+    Compute the wind field of all ensemble members of a single storm with the
+    Holland (1980) model, on the centroids around the tracks.
+
+    Parameters
+    ----------
+    tr_one_storm : climada.TCTracks
+        Interpolated tracks of all ensemble members of a storm.
+    glob_centroids : climada.hazard.Centroids
+        Global centroids, refined to the storm extent.
+    n_ensemble : int
+        Number of ensemble members, each member gets the frequency 1/n_ensemble.
+        Default: 51
+    batched : bool
+        If True, compute all ensemble members at once with the batched kernel
+        ensemble_windfield_h1980 instead of TropCyclone.from_tracks.
+        Default: False
+    dtype : type
+        Floating point type of the intensity matrix, np.float32 halves the
+        memory and the size of the HDF5 file.
+        Default: np.float64
+    max_memory_gb : float
+        Memory ceiling of the tiled computation of the batched kernel, for
+        storms with very large extents. It bounds the wind field computation,
+        not the selection of the centroids within the storm extent, which
+        stays in memory as a whole. Default: None (untiled)
+
+    Returns
+    -------
+    tc_wind_one_storm : climada.hazard.TropCyclone
+        Wind field of the storm.
+    """
+    # refine the centroids
+    storm_extent = tr_one_storm.get_extent(deg_buffer=DEG_BUFFER)
+    centroids_refine = glob_centroids.select(extent=storm_extent)
+
+    # compute the windfield for each storm
+    if batched:
+        tc_wind_one_storm = ensemble_windfield_h1980(tr_one_storm, centroids_refine,
+                                                     dtype=dtype, max_memory_gb=max_memory_gb)
+    else:
+        tc_wind_one_storm = TropCyclone.from_tracks(tr_one_storm, centroids_refine,
+                                                    model="H1980")
+        tc_wind_one_storm.intensity = tc_wind_one_storm.intensity.astype(dtype)
+    tc_wind_one_storm.frequency = np.ones(len(tc_wind_one_storm.event_id))/n_ensemble
+
+    return tc_wind_one_storm
+
+def compute_storm_windfield_lead_times(tr_one_storm: TCTracks,
+                                       glob_centroids: Centroids,
+                                       lead_times_h: List[float],
+                                       n_ensemble: int = N_ENSEMBLE,
+                                       dtype: type = np.float64,
+                                       max_memory_gb: float = None
+                                       ) -> Tuple[TropCyclone, Dict[float, TropCyclone]]:
+    """
+    Compute the wind field of all ensemble members of a single storm, and
+    the maximum wind up to each lead-time checkpoint, in a single pass of the
+    batched kernel (see ensemble_windfield_h1980_lead_times).
+
+    Returns
+    -------
+    tc_wind_one_storm : climada.hazard.TropCyclone
+        Wind field of the storm.
+    tc_wind_lead_times : Dict[float, climada.hazard.TropCyclone]
+        Wind field up to each lead-time checkpoint (hours).
+    """
+    storm_extent = tr_one_storm.get_extent(deg_buffer=DEG_BUFFER)
+    centroids_refine = glob_centroids.select(extent=storm_extent)
+
+    tc_wind_one_storm, tc_wind_lead_times = ensemble_windfield_h1980_lead_times(
+        tr_one_storm, centroids_refine, lead_times_h, dtype=dtype, max_memory_gb=max_memory_gb)
+    for tc_wind in [tc_wind_one_storm, *tc_wind_lead_times.values()]:
+        tc_wind.frequency = np.ones(len(tc_wind.event_id))/n_ensemble
+
+    return tc_wind_one_storm, tc_wind_lead_times
+
+def stack_ensemble_tracks(tr_one_storm: TCTracks, dtype: type = np.float64) -> dict:
+    """
+    Stack the tracks of all ensemble members into padded (member x time)
+    arrays in SI units. Members shorter than the longest one are padded with
+    NaN at the end.
+
+    Parameters
+    ----------
+    tr_one_storm : climada.TCTracks
+        Interpolated tracks of all ensemble members of a storm.
+    dtype : type
+        Floating point type of the arrays.
+        Default: np.float64
+
+    Returns
+    -------
+    stack : dict
+        Arrays of shape (member, time): 'lat', 'lon' (degree), 'tstep' (s),
+        'vmax' (m/s), 'cen', 'env' (Pa) and 'rad' (m), the lead time
+        'lead_h' (hours since the run time of the forecast, or since the
+        start of the track) and the boolean array 'valid' of the non-padded
+        track points.
+    """
+    n_members = len(tr_one_storm.data)
+    n_times = max(track.time.size for track in tr_one_storm.data)
+    stack = {var: np.full((n_members, n_times), np.nan, dtype=dtype)
+             for var in ['lat', 'lon', 'tstep', 'vmax', 'cen', 'env', 'rad']}
+    stack['lead_h'] = np.full((n_members, n_times), np.nan)
+    stack['valid'] = np.zeros((n_members, n_times), dtype=bool)
+
+    for i_mem, track in enumerate(tr_one_storm.data):
+        n_t = track.time.size
+        wind_fact = UNIT_TO_SI[track.attrs.get('max_sustained_wind_unit', 'kn')]
+        pres_fact = UNIT_TO_SI[track.attrs.get('central_pressure_unit', 'mb')]
+        stack['lat'][i_mem, :n_t] = track.lat.values
+        stack['lon'][i_mem, :n_t] = track.lon.values
+        stack['tstep'][i_mem, :n_t] = track.time_step.values * H_TO_S
+        stack['vmax'][i_mem, :n_t] = track.max_sustained_wind.values * wind_fact
+        stack['cen'][i_mem, :n_t] = track.central_pressure.values * pres_fact
+        stack['env'][i_mem, :n_t] = track.environmental_pressure.values * pres_fact
+        # extrapolate the radius of maximum wind from the pressure if not given
+        stack['rad'][i_mem, :n_t] = estimate_rmw(
+            track.radius_max_wind.values.copy(), stack['cen'][i_mem, :n_t] / MBAR_TO_PA
+        ) * NM_TO_M
+        run_datetime = np.datetime64(track.attrs.get('run_datetime', track.time.values[0]), 's')
+        stack['lead_h'][i_mem, :n_t] = (track.time.values - run_datetime) / np.timedelta64(1, 'h')
+        stack['valid'][i_mem, :n_t] = True
+
+    return stack
+
+def _ensemble_vtrans(stack: dict):
+    """
+    Translational velocity (lat, lon components, in m/s) of all ensemble
+    members, capped at 30 knots. The first step of each member is zero.
+    """
+    lat, lon = stack['lat'], stack['lon']
+    d_lon = wrap_lon(lon[:, 1:] - lon[:, :-1]) * np.cos(np.radians(lat[:, :-1]))
+    d_lat = lat[:, 1:] - lat[:, :-1]
+
+    vtrans = np.zeros(lat.shape + (2,), dtype=lat.dtype)
+    vtrans[:, 1:, 0] = d_lat * ONE_LAT_KM * 1000 / stack['tstep'][:, 1:]
+    vtrans[:, 1:, 1] = d_lon * ONE_LAT_KM * 1000 / stack['tstep'][:, 1:]
+    vtrans[np.isnan(vtrans)] = 0
+    vtrans_norm = np.linalg.norm(vtrans, axis=-1)
+
+    # limit to 30 nautical miles per hour
+    fact = np.fmin(1, MAX_VTRANS_KN * KN_TO_MS / np.fmax(np.spacing(lat.dtype.type(1)), vtrans_norm))
+    return vtrans * fact[..., None], vtrans_norm * fact
+
+def _unit_vectors(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """
+    Cartesian coordinates on the unit sphere, used for the neighbor index
+    """
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)])
+
+def ensemble_windfield_h1980(tr_one_storm: TCTracks,
+                             centroids: Centroids,
+                             max_dist_eye_km: float = MAX_DIST_EYE_KM,
+                             intensity_thres: float = INTENSITY_THRES,
+                             dtype: type = np.float64,
+                             max_memory_gb: float = None) -> TropCyclone:
+    """
+    Compute the Holland (1980) wind field of all ensemble members of a storm
+    at once. The members are stacked into padded (member x time) arrays, the
+    centroids close to any track point are found with a single neighbor index
+    shared by all members, and only the maximum wind speed per member and
+    centroid is kept. Follows the H1980 implementation of
+    TropCyclone.from_tracks.
+
+    Parameters
+    ----------
+    tr_one_storm : climada.TCTracks
+        Interpolated tracks of all ensemble members of a storm.
+    centroids : climada.hazard.Centroids
+        Centroids around the storm.
+    max_dist_eye_km : float
+        Maximum distance from the eye for which the wind is computed.
+        Default: 300
+    intensity_thres : float
+        Wind speeds below this threshold are set to zero, in m/s.
+        Default: 17.5
+    dtype : type
+        Floating point type of the computation and of the intensity matrix.
+        Default: np.float64
+    max_memory_gb : float
+        If given, the centroids are processed in spatial tiles that stay
+        below this memory ceiling, each with the track points within reach.
+        The result is identical to the untiled one.
+        Default: None
+
+    Returns
+    -------
+    tc_wind_one_storm : climada.hazard.TropCyclone
+        Wind field of the storm, one event per ensemble member.
+    """
+    intensity = _ensemble_intensity_h1980(tr_one_storm, centroids, max_dist_eye_km,
+                                          intensity_thres, dtype, max_memory_gb)[-1]
+    return _make_tropcyclone(tr_one_storm, centroids, intensity)
+
+def ensemble_windfield_h1980_lead_times(tr_one_storm: TCTracks,
+                                        centroids: Centroids,
+                                        lead_times_h: List[float],
+                                        max_dist_eye_km: float = MAX_DIST_EYE_KM,
+                                        intensity_thres: float = INTENSITY_THRES,
+                                        dtype: type = np.float64,
+                                        max_memory_gb: float = None
+                                        ) -> Tuple[TropCyclone, Dict[float, TropCyclone]]:
+    """
+    Compute the Holland (1980) wind field of all ensemble members of a storm,
+    together with the cumulative maximum wind up to each lead-time
+    checkpoint, in a single pass over the track points (see
+    ensemble_windfield_h1980). Each track point only updates the maximum of
+    its lead-time bin, and the bins are accumulated at the end.
+
+    Parameters
+    ----------
+    tr_one_storm : climada.TCTracks
+        Interpolated tracks of all ensemble members of a storm.
+    centroids : climada.hazard.Centroids
+        Centroids around the storm.
+    lead_times_h : List[float]
+        Lead-time checkpoints, in hours since the run time of the forecast.
+    max_dist_eye_km, intensity_thres, dtype, max_memory_gb
+        See ensemble_windfield_h1980.
+
+    Returns
+    -------
+    tc_wind_one_storm : climada.hazard.TropCyclone
+        Wind field of the storm over the whole forecast.
+    tc_wind_lead_times : Dict[float, climada.hazard.TropCyclone]
+        Maximum wind up to each lead-time checkpoint.
+    """
+    lead_times_h = sorted(lead_times_h)
+    intensities = _ensemble_intensity_h1980(tr_one_storm, centroids, max_dist_eye_km,
+                                            intensity_thres, dtype, max_memory_gb,
+                                            lead_times_h)
+    return (_make_tropcyclone(tr_one_storm, centroids, intensities[-1]),
+            {lead_time: _make_tropcyclone(tr_one_storm, centroids, intensity)
+             for lead_time, intensity in zip(lead_times_h, intensities[:-1])})
+
+def _ensemble_intensity_h1980(tr_one_storm: TCTracks,
+                              centroids: Centroids,
+                              max_dist_eye_km: float,
+                              intensity_thres: float,
+                              dtype: type,
+                              max_memory_gb: float,
+                              lead_times_h: List[float] = ()) -> List[sparse.csr_matrix]:
+    """
+    Intensity matrices of the cumulative maximum wind up to each of the
+    (sorted) lead-time checkpoints, followed by the one of the whole forecast.
+    """
+    stack = stack_ensemble_tracks(tr_one_storm, dtype)
+    n_members, n_times = stack['valid'].shape
+    vtrans, vtrans_norm = _ensemble_vtrans(stack)
+
+    # convert surface winds to gradient winds without translational influence
+    vgrad = np.fmax(0, stack['vmax'] - vtrans_norm) / GRADIENT_TO_SURFACE_WINDS
+    pdelta = stack['env'] - stack['cen']
+    hol_b = np.clip(vgrad**2 * np.e * RHO_AIR / np.fmax(np.spacing(pdelta.dtype.type(1)), pdelta),
+                    1, 2.5)
+    coriolis = 2 * V_ANG_EARTH * np.sin(np.radians(np.abs(stack['lat'])))
+    latsign = np.where(np.sum(stack['lat'] < 0, axis=1) > np.sum(stack['lat'] > 0, axis=1),
+                       -1., 1.)
+
+    fields = {'lat': stack['lat'], 'lon': stack['lon'], 'rad': stack['rad'],
+              'hol_b': hol_b, 'pdelta': pdelta, 'coriolis': coriolis,
+              'vtrans': vtrans, 'latsign': latsign}
+
+    # centroids within the distance to the coast and the latitude range of from_tracks
+    [centr_idx] = ((centroids.get_dist_coast() <= MAX_DIST_INLAND_KM * 1000)
+                   & (np.abs(centroids.lat) <= MAX_LATITUDE)).nonzero()
+    centr_lat, centr_lon = centroids.lat[centr_idx], centroids.lon[centr_idx]
+
+    # the wind field of the first step of each member is zero
+    valid = stack['valid'].copy()
+    valid[:, 0] = False
+    pt_mem, pt_time = valid.nonzero()
+    # lead-time bin of each track point: checkpoint k covers the bins 0 to k
+    pt_bin = np.searchsorted(lead_times_h, stack['lead_h'][pt_mem, pt_time], side='left')
+    n_bins = len(lead_times_h) + 1
+
+    # spatial tiles of centroids under the memory ceiling, each with the track
+    # points within reach (halo); the maximum per centroid is independent of
+    # the tiling, so the stitched result equals the untiled one
+    if max_memory_gb is None:
+        tiles = [np.arange(centr_idx.size)]
+    else:
+        # worst case of the sparse result (value and index per bin and member)
+        # and the neighbour arrays of a chunk of track points
+        bytes_per_centroid = ((np.dtype(dtype).itemsize + 8) * n_bins * n_members
+                              + np.dtype(dtype).itemsize * 16 * TRACK_POINTS_CHUNK)
+        tiles = spatial_tiles(centr_lat, centr_lon,
+                              max_points_per_tile(max_memory_gb, bytes_per_centroid))
+
+    rows, cols, data = [[] for _ in range(n_bins)], [[] for _ in range(n_bins)], [[] for _ in range(n_bins)]
+    for tile in tiles:
+        if len(tiles) > 1:
+            pt_near = points_near_tile(centr_lat[tile], centr_lon[tile],
+                                       stack['lat'][pt_mem, pt_time],
+                                       stack['lon'][pt_mem, pt_time],
+                                       1.05 * max_dist_eye_km)
+        else:
+            pt_near = slice(None)
+        intensity = _max_windfield_h1980(fields, pt_mem[pt_near], pt_time[pt_near],
+                                         pt_bin[pt_near], n_bins,
+                                         centr_lat[tile], centr_lon[tile],
+                                         max_dist_eye_km, intensity_thres, dtype)
+        for i_bin in range(n_bins):
+            intensity_bin = intensity[i_bin].tocoo()
+            rows[i_bin].append(intensity_bin.row)
+            cols[i_bin].append(centr_idx[tile][intensity_bin.col])
+            data[i_bin].append(intensity_bin.data)
+
+    return [sparse.csr_matrix((np.concatenate(data[i_bin]),
+                               (np.concatenate(rows[i_bin]), np.concatenate(cols[i_bin]))),
+                              shape=(n_members, centroids.size))
+            for i_bin in range(n_bins)]
+
+def _make_tropcyclone(tr_one_storm: TCTracks,
+                      centroids: Centroids,
+                      intensity: sparse.csr_matrix) -> TropCyclone:
+    """
+    TropCyclone with one event per ensemble member, as from_tracks
+    """
+    tracks = tr_one_storm.data
+    n_members = len(tracks)
+    return TropCyclone(
+        intensity=intensity,
+        centroids=centroids,
+        units='m/s',
+        event_id=np.arange(1, n_members + 1),
+        event_name=[str(track.sid) for track in tracks],
+        frequency=np.ones(n_members),
+        date=np.array([pd.Timestamp(track.time.values[0]).toordinal() for track in tracks]),
+        orig=np.array([bool(track.orig_event_flag) for track in tracks]),
+        category=np.array([track.category for track in tracks]),
+        basin=[str(track.basin.values[0]) if 'basin' in track.variables
+               else str(track.attrs.get('basin')) for track in tracks],
+    )
+
+def _reduce_max(keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Unique keys and the maximum of the values of each key."""
+    if keys.size == 0:
+        return keys, values
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    start = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[start], np.maximum.reduceat(values, start)
+
+def _max_windfield_h1980(fields: dict,
+                         pt_mem: np.ndarray,
+                         pt_time: np.ndarray,
+                         pt_bin: np.ndarray,
+                         n_bins: int,
+                         centr_lat: np.ndarray,
+                         centr_lon: np.ndarray,
+                         max_dist_eye_km: float,
+                         intensity_thres: float,
+                         dtype: type) -> List[sparse.csr_matrix]:
+    """
+    Cumulative maximum H1980 wind speed up to each lead-time bin, sparse
+    (member x centroid) matrix per bin with the values of at least
+    intensity_thres, over the given track points (member, time index and
+    lead-time bin), using a neighbor index of the centroids shared by all
+    members.
+
+    The wind speeds of each chunk of track points are kept as (bin, member,
+    centroid) triplets, and duplicates are reduced to their maximum whenever
+    REDUCE_EVERY values are pending, so that memory follows the non-zero
+    wind field instead of members x centroids. Values below intensity_thres
+    are dropped early: a cumulative maximum of at least the threshold is
+    always one of the values of at least the threshold.
+    """
+    n_members, n_centr = fields['lat'].shape[0], centr_lat.size
+    tree = cKDTree(_unit_vectors(centr_lat, centr_lon))
+    # chord length of the maximum distance, with a margin for the
+    # equirectangular distance used below
+    r_chord = 2 * np.sin(1.05 * max_dist_eye_km / (2 * EARTH_RADIUS_KM))
+    pt_xyz = _unit_vectors(fields['lat'][pt_mem, pt_time], fields['lon'][pt_mem, pt_time])
+
+    keys, values, n_pending = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=dtype)], 0
+    for i_start in range(0, pt_mem.size, TRACK_POINTS_CHUNK):
+        chunk = slice(i_start, i_start + TRACK_POINTS_CHUNK)
+        neighbors = tree.query_ball_point(pt_xyz[chunk], r_chord)
+        n_neighbors = np.array([len(idx) for idx in neighbors])
+        if n_neighbors.sum() == 0:
+            continue
+        centr = np.fromiter(itertools.chain.from_iterable(neighbors), dtype=np.intp,
+                            count=n_neighbors.sum())
+        mem = np.repeat(pt_mem[chunk], n_neighbors)
+        tim = np.repeat(pt_time[chunk], n_neighbors)
+        bins = np.repeat(pt_bin[chunk], n_neighbors)
+
+        # distances (in m) and vectors from the eye to the centroids
+        lat = fields['lat'][mem, tim]
+        d_lat = (centr_lat[centr].astype(dtype) - lat) * ONE_LAT_KM * 1000
+        d_lon = (wrap_lon(centr_lon[centr].astype(dtype) - fields['lon'][mem, tim])
+                 * np.cos(np.radians(lat)) * ONE_LAT_KM * 1000)
+        d_centr = np.hypot(d_lat, d_lon)
+        close = (d_centr <= max_dist_eye_km * 1000) & (d_centr > 1)
+        mem, tim, bins, centr = mem[close], tim[close], bins[close], centr[close]
+        d_lat, d_lon, d_centr = d_lat[close], d_lon[close], d_centr[close]
+
+        # angular wind speed of the H1980 model
+        rad = fields['rad'][mem, tim]
+        hol_b = fields['hol_b'][mem, tim]
+        r_max_norm = (rad / np.fmax(1, d_centr))**hol_b
+        sqrt_term = hol_b / RHO_AIR * fields['pdelta'][mem, tim] * r_max_norm * np.exp(-r_max_norm)
+        r_coriolis = 0.5 * d_centr * fields['coriolis'][mem, tim]
+        v_ang = (np.sqrt(r_coriolis**2 + sqrt_term) - r_coriolis) * GRADIENT_TO_SURFACE_WINDS
+
+        # add the translational velocity, decreasing with the distance from the eye
+        v_trans_corr = np.fmin(1, rad / d_centr)
+        latsign = fields['latsign'][mem]
+        wind_lat = latsign * d_lon / d_centr * v_ang + fields['vtrans'][mem, tim, 0] * v_trans_corr
+        wind_lon = -latsign * d_lat / d_centr * v_ang + fields['vtrans'][mem, tim, 1] * v_trans_corr
+        wind = np.hypot(wind_lat, wind_lon)
+        wind[np.isnan(wind)] = 0
+
+        strong = wind >= intensity_thres
+        keys.append((bins[strong].astype(np.int64) * n_members + mem[strong]) * n_centr
+                    + centr[strong])
+        values.append(wind[strong].astype(dtype, copy=False))
+        n_pending += np.count_nonzero(strong)
+        if n_pending > REDUCE_EVERY:
+            reduced_keys, reduced_values = _reduce_max(np.concatenate(keys), np.concatenate(values))
+            keys, values, n_pending = [reduced_keys], [reduced_values], reduced_keys.size
+
+    keys, values = _reduce_max(np.concatenate(keys), np.concatenate(values))
+    bins, member_centr = np.divmod(keys, n_members * n_centr)
+    mem, centr = np.divmod(member_centr, n_centr)
+
+    # cumulative maximum over the lead-time bins
+    intensity = []
+    for i_bin in range(n_bins):
+        in_bin = bins == i_bin
+        intensity_bin = sparse.csr_matrix((values[in_bin], (mem[in_bin], centr[in_bin])),
+                                          shape=(n_members, n_centr))
+        intensity.append(intensity_bin if i_bin == 0 else intensity[-1].maximum(intensity_bin))
+    return intensity
+
+def make_tc_wind_file_name(tr_name: str, formatted_datetime: str):
+    """
+    Make a file name for saving the wind field of a storm
+    """
+    return 'tc_wind_' +tr_name +'_' +formatted_datetime +'.hdf5'
+
+def make_tc_wind_lead_time_file_name(tr_name: str, formatted_datetime: str, lead_time_h: float):
+    """
+    Make a file name for saving the wind field of a storm up to a lead time
+    """
+    return 'tc_wind_' +tr_name +'_' +formatted_datetime +f'_lead{int(lead_time_h):03d}h.hdf5'
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Asynchronous writer for the outputs on the (NFS) output directory.
+
+The save functions serialize their output to bytes and hand them over to
+the writer, which writes them atomically (see checkpoint_func.atomic_file)
+from a background thread pool. A bounded queue keeps the memory of pending
+writes in check: when it is full, the compute thread waits for a free slot.
+
+@author: Pui Man (Mannie) Kam
+"""
+import io
+import os
+import time
+import tempfile
+import threading
+import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Union, List, Callable
+from pathlib import Path
+
+from checkpoint_func import atomic_file
+
+class AsyncWriter:
+    """
+    Background writer with a bounded queue.
+
+    Parameters
+    ----------
+    n_threads : int
+        Number of writer threads. Default: 4
+    max_queue : int
+        Maximum number of pending writes. Default: 64
+    """
+
+    def __init__(self, n_threads: int = 4, max_queue: int = 64):
+        self._executor = ThreadPoolExecutor(max_workers=n_threads,
+                                            thread_name_prefix="output-writer")
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._lock = threading.Lock()
+        self._callback_lock = threading.Lock()
+        self._futures = []
+        self._created_dirs = set()
+        self._queue_depth = 0
+        self.stats = {'files': 0, 'bytes': 0, 'write_seconds': 0.,
+                      'max_queue_depth': 0, 'queue_depth_sum': 0, 'submitted': 0}
+        self._time_start = time.time()
+
+    def write(self, file_name: Union[str, Path], data: bytes) -> Future:
+        """
+        Queue bytes to be written to file_name. Blocks while the queue is full.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Completes once the file is written.
+        """
+        self._slots.acquire()
+        with self._lock:
+            self._queue_depth += 1
+            self.stats['submitted'] += 1
+            self.stats['queue_depth_sum'] += self._queue_depth
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self._queue_depth)
+        future = self._executor.submit(self._write, str(file_name), data)
+        future.file_name = str(file_name)
+        self._futures.append(future)
+        return future
+
+    def _write(self, file_name: str, data: bytes):
+        """Write a file in a writer thread, creating its directory once."""
+        try:
+            time_start = time.time()
+            dir_name = os.path.dirname(file_name)
+            with self._lock:
+                is_new_dir = dir_name not in self._created_dirs
+            if is_new_dir:
+                os.makedirs(dir_name or '.', exist_ok=True)
+                with self._lock:
+                    self._created_dirs.add(dir_name)
+            with atomic_file(file_name) as tmp_file:
+                with open(tmp_file, 'wb') as f:
+                    f.write(data)
+            with self._lock:
+                self.stats['files'] += 1
+                self.stats['bytes'] += len(data)
+                self.stats['write_seconds'] += time.time() - time_start
+        finally:
+            with self._lock:
+                self._queue_depth -= 1
+            self._slots.release()
+
+    def on_complete(self, futures: List[Future], callback: Callable[[], None]):
+        """
+        Call callback (in a writer thread) once all futures are written
+        successfully, e.g. to record a unit in the progress ledger.
+        """
+        futures = [future for future in futures if future is not None]
+        remaining = [len(futures)]
+
+        def _done(_):
+            with self._lock:
+                remaining[0] -= 1
+                all_done = remaining[0] == 0
+            if all_done and all(future.exception() is None for future in futures):
+                with self._callback_lock:
+                    callback()
+
+        if not futures:
+            callback()
+        for future in futures:
+            future.add_done_callback(_done)
+
+    def flush(self):
+        """Wait until all queued files are written, raise the first error."""
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """Flush, stop the writer threads and print the write statistics."""
+        self.flush()
+        self._executor.shutdown(wait=True)
+        print(self.report())
+
+    def report(self) -> str:
+        """Summary of the write throughput and the queue depth."""
+        elapsed = time.time() - self._time_start
+        mb = self.stats['bytes'] / 1e6
+        mean_depth = self.stats['queue_depth_sum'] / max(self.stats['submitted'], 1)
+        return (f"Output writer: {self.stats['files']} files, {mb:.1f} MB, "
+                f"{mb / max(self.stats['write_seconds'], 1e-9):.1f} MB/s per thread, "
+                f"{mb / max(elapsed, 1e-9):.1f} MB/s overall, "
+                f"queue depth mean {mean_depth:.1f} / max {self.stats['max_queue_depth']}")
+
+def write_bytes(file_name: Union[str, Path], data: bytes,
+                writer: AsyncWriter = None) -> Future:
+    """
+    Write bytes to a file, asynchronously with the writer if given, otherwise
+    synchronously. Both ways write atomically.
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        Completes once the file is written, None for synchronous writes.
+    """
+    if writer is not None:
+        return writer.write(file_name, data)
+
+    os.makedirs(os.path.dirname(str(file_name)) or '.', exist_ok=True)
+    with atomic_file(file_name) as tmp_file:
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+    return None
+
+def written_files(futures: List[Future]) -> List[str]:
+    """Files of the writes of the given futures (synchronous writes are skipped)."""
+    return [future.file_name for future in futures if future is not None]
+
+def file_to_bytes(write: Callable[[str], None], file_name: Union[str, Path]) -> bytes:
+    """
+    Serialize with a function that can only write to a file path (e.g.
+    GeoDataFrame.to_file, rasterio): write(path) is called with a file in a
+    local temporary directory, which has the base name of file_name since
+    some formats store it (e.g. the layer name of a GeoJSON), and its bytes
+    are returned.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_file = os.path.join(tmp_dir, os.path.basename(str(file_name)))
+        write(tmp_file)
+        with open(tmp_file, 'rb') as f:
+            return f.read()
+
+def figure_to_bytes(fig, **kwargs) -> bytes:
+    """Render a matplotlib figure to PNG bytes and close it."""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', **kwargs)
+    plt.close(fig)
+    return buffer.getvalue()